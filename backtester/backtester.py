@@ -8,3 +8,169 @@ General strategy is:
         the excess return, downside risk, and Sortino Ratio of the
         allocations.
 """
+import config
+import numpy as np
+from scipy.stats.mstats import gmean
+
+
+CASH = '_CASH_'
+
+
+def _forwardFill(price_matrix, present_matrix):
+    """Carry each ticker's last known price forward over missing days.
+
+    Args:
+        price_matrix: Rows = dates, columns = tickers, values = prices.
+        present_matrix: Boolean matrix, True where a price is present.
+    Returns:
+        filled_matrix: price_matrix, with missing prices replaced by the last
+            present one, or NaN before the first.
+    """
+    rows = np.where(present_matrix, np.arange(len(price_matrix))[:, np.newaxis], 0)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    # Days before a ticker's first price point at row 0, which is NaN.
+    return np.take_along_axis(price_matrix, rows, axis=0)
+
+
+def _getWeights(allocation_map, ticker_tuple, priced):
+    """Convert an allocation map to normalized weights.
+
+    Args:
+        allocation_map: Map of tickers to allocation percentages.
+        ticker_tuple: Tuple of backtested tickers.
+        priced: Boolean array, True for tickers with a price on this day.
+    Returns:
+        weights: Array of weights for ticker_tuple.
+        cash: Weight held as cash, including tickers without a price.
+    """
+    total = sum(v for v in allocation_map.values() if v > 0)
+    if total <= 0:
+        return (np.zeros(len(ticker_tuple), dtype=np.float64), 1.0)
+
+    weights = np.array(
+        [max(allocation_map.get(ticker, 0), 0) for ticker in ticker_tuple],
+        dtype=np.float64) / total
+    if (weights[~priced] > 0).any():
+        print('Holding unpriced tickers as cash: %s' % ', '.join(
+            ticker_tuple[i] for i in np.flatnonzero(~priced & (weights > 0))))
+    weights[~priced] = 0
+    return (weights, 1.0 - weights.sum())
+
+
+def runBacktest(dated_allocation_list, aligned_data, required_return, end_date=None):
+    """Backtest a series of allocations, with drift, rebalancing and expenses.
+
+    Between rebalances each holding grows with its price and shrinks with its
+    daily expense ratio, so every segment is a single array operation.
+
+    Args:
+        dated_allocation_list: List of (date_int, allocation_map) tuples. Each
+            allocation is rebalanced into at the close of the first date on
+            or after date_int. CASH, or tickers without a price, are held as
+            cash.
+        aligned_data: See data_cleaner.alignTickerData.
+        required_return: What daily return is desired.
+        end_date: Optional date to stop before, otherwise the last date.
+    Returns:
+        results: Dict of:
+            date_array: Array of backtested dates.
+            value_array: Portfolio value on each date, starting at 1.0.
+            return_array: Daily portfolio returns.
+            rebalance_dates: Array of dates rebalanced on.
+            turnover_array: Fraction of the portfolio traded at each
+                rebalance, 0 for the first.
+            expense_drag: Annualized fraction of value lost to expenses.
+            excess_return: Mean daily return less required_return.
+            downside_risk: Root mean square of returns below required_return.
+            sortino_ratio: excess_return / downside_risk, or inf if there
+                are no returns below required_return but excess_return is
+                positive.
+    Raises:
+        ValueError: If there are no allocations, or fewer than 2 dates to
+            backtest.
+    """
+    (ticker_tuple, date_array, price_matrix, present_matrix, expense_array) = aligned_data
+    if not dated_allocation_list:
+        raise ValueError('No allocations to backtest.')
+    dated_allocation_list = sorted(dated_allocation_list, key=lambda x: x[0])
+
+    # Tickers never held can't affect the result, and may lack data such as
+    # an expense ratio.
+    column_map = {ticker: column for column, ticker in enumerate(ticker_tuple)}
+    tickers = tuple(sorted(
+        {ticker for _, allocation_map in dated_allocation_list
+            for ticker, allocation in allocation_map.items()
+            if ticker in column_map and allocation > 0}))
+    columns = [column_map[ticker] for ticker in tickers]
+
+    end_row = len(date_array) if end_date is None else np.searchsorted(date_array, end_date)
+    start_row = np.searchsorted(date_array, dated_allocation_list[0][0])
+    if end_row - start_row < 2:
+        raise ValueError('Not enough dates to backtest.')
+    price_matrix = _forwardFill(
+        price_matrix[:end_row, columns], present_matrix[:end_row, columns])[start_row:]
+    expense_factors = np.power(
+        1 - expense_array[columns], 1 / config.TRADING_DAYS_PER_YEAR)
+
+    # Later allocations for the same day replace earlier ones.
+    rebalances = {}
+    for date_int, allocation_map in dated_allocation_list:
+        row = np.searchsorted(date_array, date_int) - start_row
+        if row < len(price_matrix) - 1:
+            rebalances[row] = allocation_map
+    rebalance_rows = sorted(rebalances)
+
+    value_array = np.empty(len(price_matrix), dtype=np.float64)
+    gross_value_array = np.empty(len(price_matrix), dtype=np.float64)
+    turnover_list = []
+    value = 1.0
+    gross_value = 1.0
+    drifted = None
+    for i, row in enumerate(rebalance_rows):
+        next_row = rebalance_rows[i + 1] if i + 1 < len(rebalance_rows) else len(price_matrix) - 1
+        priced = ~np.isnan(price_matrix[row])
+        (weights, cash) = _getWeights(rebalances[row], tickers, priced)
+
+        if drifted is None:
+            turnover_list.append(0.0)
+        else:
+            turnover_list.append(
+                (np.abs(weights - drifted[0]).sum() + abs(cash - drifted[1])) / 2)
+
+        # Growth of each holding since the rebalance, before expenses.
+        growth = np.nan_to_num(price_matrix[row:next_row + 1] / np.where(
+            priced, price_matrix[row], 1))
+        gross_holdings = growth * weights
+        holdings = gross_holdings * np.power(
+            expense_factors, np.arange(len(growth))[:, np.newaxis])
+
+        segment_values = holdings.sum(axis=1) + cash
+        value_array[row:next_row + 1] = value * segment_values
+        gross_value_array[row:next_row + 1] = gross_value * (
+            gross_holdings.sum(axis=1) + cash)
+        drifted = (holdings[-1] / segment_values[-1], cash / segment_values[-1])
+        value = value_array[next_row]
+        gross_value = gross_value_array[next_row]
+
+    return_array = value_array[1:] / value_array[:-1]
+    mean_return = gmean(return_array)
+    downside_returns = np.clip(return_array - required_return, None, 0)
+    downside_risk = np.sqrt(np.mean(downside_returns * downside_returns))
+    excess_return = mean_return - required_return
+    if downside_risk > 0:
+        sortino_ratio = excess_return / downside_risk
+    else:
+        sortino_ratio = np.inf if excess_return > 0 else 0.0
+
+    return {
+        'date_array': date_array[start_row:end_row],
+        'value_array': value_array,
+        'return_array': return_array,
+        'rebalance_dates': date_array[start_row:end_row][rebalance_rows],
+        'turnover_array': np.array(turnover_list, dtype=np.float64),
+        'expense_drag': 1 - pow(
+            value_array[-1] / gross_value_array[-1],
+            config.TRADING_DAYS_PER_YEAR / len(return_array)),
+        'excess_return': excess_return,
+        'downside_risk': downside_risk,
+        'sortino_ratio': sortino_ratio}
@@ -0,0 +1,100 @@
+"""Tests for the backtester module."""
+
+from . import backtester
+import config
+import numpy as np
+import unittest
+
+
+def _alignedData(price_matrix, expense_array=(0.0, 0.0)):
+    price_matrix = np.array(price_matrix, dtype=np.float64)
+    return (
+        ('fake1', 'fake2'),
+        np.arange(len(price_matrix)) * 10,
+        price_matrix,
+        ~np.isnan(price_matrix),
+        np.array(expense_array, dtype=np.float64))
+
+
+class TestForwardFill(unittest.TestCase):
+
+    def test_basic(self):
+        price_matrix = np.array(
+            [[np.nan, 1.0], [2.0, np.nan], [np.nan, np.nan], [3.0, 4.0]])
+        actual = backtester._forwardFill(price_matrix, ~np.isnan(price_matrix))
+        np.testing.assert_array_equal(
+            actual, [[np.nan, 1.0], [2.0, 1.0], [2.0, 1.0], [3.0, 4.0]])
+
+
+class TestRunBacktest(unittest.TestCase):
+
+    def test_drift(self):
+        aligned_data = _alignedData([[1.0, 1.0], [2.0, 1.0], [2.0, 0.5]])
+        actual = backtester.runBacktest(
+            [(0, {'fake1': 0.5, 'fake2': 0.5})], aligned_data, 1.0)
+
+        np.testing.assert_allclose(actual['value_array'], [1.0, 1.5, 1.25])
+        np.testing.assert_allclose(actual['return_array'], [1.5, 1.25 / 1.5])
+        self.assertAlmostEqual(actual['expense_drag'], 0)
+
+    def test_rebalance(self):
+        aligned_data = _alignedData([[1.0, 1.0], [2.0, 1.0], [2.0, 0.5]])
+        actual = backtester.runBacktest(
+            [(0, {'fake1': 0.5, 'fake2': 0.5}), (5, {'fake2': 1.0})],
+            aligned_data, 1.0)
+
+        np.testing.assert_allclose(actual['value_array'], [1.0, 1.5, 0.75])
+        np.testing.assert_array_equal(actual['rebalance_dates'], [0, 10])
+        # Drifted to 2/3 and 1/3, then moved entirely to fake2.
+        np.testing.assert_allclose(actual['turnover_array'], [0, 2 / 3])
+
+    def test_cash(self):
+        aligned_data = _alignedData([[1.0, np.nan], [2.0, 1.0], [4.0, 2.0]])
+        actual = backtester.runBacktest(
+            [(0, {'fake1': 0.5, 'fake2': 0.5})], aligned_data, 1.0)
+
+        np.testing.assert_allclose(actual['value_array'], [1.0, 1.5, 2.5])
+
+    def test_expenses(self):
+        aligned_data = _alignedData([[1.0, 1.0]] * 3, expense_array=(0.1, 0.0))
+        actual = backtester.runBacktest([(0, {'fake1': 1.0})], aligned_data, 1.0)
+
+        factor = pow(0.9, 1 / config.TRADING_DAYS_PER_YEAR)
+        np.testing.assert_allclose(actual['value_array'], [1.0, factor, factor * factor])
+        self.assertAlmostEqual(actual['expense_drag'], 0.1)
+        self.assertLess(actual['excess_return'], 0)
+        self.assertLess(actual['sortino_ratio'], 0)
+
+    def test_noAllocations(self):
+        aligned_data = _alignedData([[1.0, 1.0]] * 3)
+        with self.assertRaisesRegex(ValueError, 'No allocations'):
+            backtester.runBacktest([], aligned_data, 1.0)
+
+    def test_unheldNanExpense(self):
+        aligned_data = _alignedData(
+            [[1.0, 1.0], [2.0, 1.0], [2.0, 0.5]], expense_array=(0.0, np.nan))
+        actual = backtester.runBacktest(
+            [(0, {'fake1': 1.0, 'fake2': 0.0})], aligned_data, 1.0)
+
+        np.testing.assert_allclose(actual['value_array'], [1.0, 2.0, 2.0])
+        self.assertFalse(np.isnan(actual['sortino_ratio']))
+        self.assertAlmostEqual(actual['expense_drag'], 0)
+
+    def test_noDownside(self):
+        aligned_data = _alignedData([[1.0, 1.0], [2.0, 1.0], [3.0, 1.0]])
+        with np.errstate(all='raise'):
+            actual = backtester.runBacktest([(0, {'fake1': 1.0})], aligned_data, 1.0)
+
+        self.assertEqual(actual['downside_risk'], 0)
+        self.assertEqual(actual['sortino_ratio'], np.inf)
+
+    def test_flat(self):
+        aligned_data = _alignedData([[1.0, 1.0]] * 3)
+        with np.errstate(all='raise'):
+            actual = backtester.runBacktest([(0, {'fake1': 1.0})], aligned_data, 1.0)
+
+        self.assertEqual(actual['sortino_ratio'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,20 @@
 """Module to call other functions, and handle flags."""
 
 import argparse
+from backtester import backtester
 from collections import defaultdict
 from collections import OrderedDict
-from copy import deepcopy
 import config
 from data_cleaner import data_cleaner
 from data_gatherer import data_gatherer
+from data_gatherer import price_store
 import datetime
+from instrumentation import instrumentation
 import math
+import multiprocessing as mp
 import numpy as np
-from optimizer import optimizer
+from optimizer import result_cache
+from optimizer import solvers
 from scipy.stats.mstats import gmean
 import time
 from trader import trader
@@ -36,40 +40,113 @@ parser.add_argument(
 parser.add_argument(
     '--set_date',
     help='A single date to run the optimizer for.')
+parser.add_argument(
+    '--warm_start',
+    action='store_true',
+    help=(
+        'Start each --set_start_date optimization from the previous result, '
+        'or a single date from the current allocation.'))
+parser.add_argument(
+    '--solver',
+    choices=sorted(solvers.SOLVERS),
+    default='swap',
+    help='How to optimize, see optimizer/solvers.py.')
+parser.add_argument(
+    '--start_increment',
+    type=float,
+    default=1.0,
+    help='Allocation the optimizer trades at first, e.g. 0.0625 for warm starts.')
+parser.add_argument(
+    '--min_increment',
+    type=float,
+    default=1 / 128,
+    help='Smallest allocation the optimizer trades.')
+parser.add_argument(
+    '--max_iterations',
+    type=int,
+    help='Max number of optimizer iterations per date.')
+parser.add_argument(
+    '--time_budget',
+    type=float,
+    help='Max number of seconds to optimize per date.')
+parser.add_argument(
+    '--prune_buys',
+    type=int,
+    help='Only fully score trades buying this many screened tickers per iteration.')
+parser.add_argument(
+    '--max_trades_per_scan',
+    type=int,
+    default=1,
+    help='Max number of trades, on distinct tickers, to apply per optimizer scan.')
+parser.add_argument(
+    '--result_cache_folder',
+    default='cache/optimizer',
+    help='Where to reuse optimizer results from, or empty to disable.')
+parser.add_argument(
+    '--num_processes',
+    type=int,
+    default=mp.cpu_count(),
+    help='How many processes the optimizer should use.')
+parser.add_argument(
+    '--read_processes',
+    type=int,
+    help='How many processes to read cache files with, defaults to one per CPU.')
+parser.add_argument(
+    '--report_file',
+    help='Where to write a JSON report of time spent and work done per stage.')
+parser.add_argument(
+    '--profile_span',
+    choices=[
+        'data_gatherer.get',
+        'data_gatherer.read_cache',
+        'data_cleaner.align',
+        'data_cleaner.clean',
+        'optimizer.optimize',
+        'optimizer.scoring',
+        'trader.trades'],
+    help='A stage to run under cProfile, printing the slowest functions.')
+parser.add_argument(
+    '--profile_file',
+    help='Where to dump --profile_span stats, for e.g. snakeviz.')
 
 
 def _printAllocMap(allocation_map, ticker_data):
     filtered_map = {k: v for k, v in allocation_map.items() if v > 0}
     ordered_map = OrderedDict(sorted(filtered_map.items(), key=lambda kv: kv[1], reverse=True))
     for k, v in ordered_map.items():
-        print('{:5.2f}% {}\t{}'.format(v * 100, k, ticker_data[k]['name']))
+        print('{:5.2f}% {}\t{}'.format(v * 100, k, ticker_data[k].name))
 
 
-def _runSingleDay(date_int, ticker_data, daily_return, required_num_days, perform_trades=True, use_downside_correl=True):
+def _runSingleDay(date_int, ticker_data, aligned_data, daily_return, required_num_days, perform_trades=True, use_downside_correl=True, num_processes=1, initial_allocation_map=None, optimizer_options=None, result_cache_folder=None):
     start = time.time()
-    filtered_ticker_data = deepcopy(ticker_data)
-    for ticker in set(filtered_ticker_data.keys()):
-        if ticker not in config.ALLOWED_TICKERS:
-            del filtered_ticker_data[ticker]
-    (ticker_tuple, data_matrix, expense_array) = data_cleaner.cleanAndConvertData(filtered_ticker_data, required_num_days, date_int)
+    (ticker_tuple, data_matrix, expense_array) = data_cleaner.cleanAlignedData(
+            aligned_data, required_num_days, date_int, tickers=config.ALLOWED_TICKERS)
     print('Cleaning data took %.2fs' % (time.time() - start))
     start = time.time()
-    (best_score, allocation_map) = optimizer.findOptimalAllocation(data_matrix, ticker_tuple, daily_return, expense_array, use_downside_correl=use_downside_correl)
+    optimizer_kwargs = dict(
+            optimizer_options or {},
+            use_downside_correl=use_downside_correl,
+            num_processes=num_processes,
+            initial_allocation_map=initial_allocation_map)
+    if result_cache_folder:
+        (best_score, allocation_map) = result_cache.findOptimalAllocation(result_cache_folder, data_matrix, ticker_tuple, daily_return, expense_array, **optimizer_kwargs)
+    else:
+        (best_score, allocation_map) = solvers.findOptimalAllocation(data_matrix, ticker_tuple, daily_return, expense_array, **optimizer_kwargs)
     print('Optimization took %.2fs' % (time.time() - start))
 
     if not perform_trades: return allocation_map
 
     _printAllocMap(allocation_map, ticker_data)
     print('Score: %.4f' % best_score)
-    small_ticker_data = {ticker: data for ticker, data in ticker_data.items() if ticker in allocation_map or ticker in config.CURRENT_ALLOCATION_DICT}
-    (small_ticker_tuple, small_data_matrix, _) = data_cleaner.cleanAndConvertData(small_ticker_data, 1, date_int)
+    small_tickers = set(allocation_map).union(config.CURRENT_ALLOCATION_DICT)
+    (small_ticker_tuple, small_data_matrix, _) = data_cleaner.cleanAlignedData(
+            aligned_data, 1, date_int, tickers=small_tickers)
     trader.calculateTrades(allocation_map, config.CURRENT_ALLOCATION_DICT, small_ticker_tuple, small_data_matrix)
 
 
-def _runBacktest(allocation_map, ticker_data, start_date_int, next_date_int):
-    small_ticker_data = {ticker: data for ticker, data in ticker_data.items() if ticker in allocation_map}
-    (small_ticker_tuple, small_data_matrix, small_expense_array) = data_cleaner.cleanAndConvertData(
-            small_ticker_data, 30, next_date_int, first_date=start_date_int)
+def _runBacktest(allocation_map, aligned_data, start_date_int, next_date_int):
+    (small_ticker_tuple, small_data_matrix, small_expense_array) = data_cleaner.cleanAlignedData(
+            aligned_data, 30, next_date_int, first_date=start_date_int, tickers=allocation_map)
     allocation_map = defaultdict(int, allocation_map)
     small_allocation_array = np.array([allocation_map[ticker] for ticker in small_ticker_tuple], dtype=np.float64)
     performance = gmean(np.matmul(small_data_matrix, small_allocation_array))
@@ -77,6 +154,78 @@ def _runBacktest(allocation_map, ticker_data, start_date_int, next_date_int):
     return performance * expense
 
 
+def _runWalkForward(ticker_data, aligned_data, start_date_int, end_date_int, daily_return, required_num_days, use_downside_correl=False, num_processes=1, warm_start=False, optimizer_options=None, result_cache_folder=None):
+    """Optimize yearly from a start date, backtesting each allocation for the following year.
+
+    Every date reads its training window, and the following holding window,
+    from the same aligned data.
+
+    Args:
+        ticker_data: Data from the data_gatherer module, for names.
+        aligned_data: See data_cleaner.alignTickerData.
+        start_date_int: First date to optimize for.
+        end_date_int: Dates on or after this are not optimized for.
+        daily_return: What daily return is desired.
+        required_num_days: How many days of data each ticker should have.
+        warm_start: Whether to start each optimization from the previous
+            date's allocation.
+        optimizer_options: Optional dict of convergence controls for
+            optimizer.findOptimalAllocation.
+        result_cache_folder: Optional folder to reuse optimizer results from.
+    Returns:
+        performance_list: Backtested daily return for each date.
+        dated_allocation_list: List of (date_int, allocation_map) tuples.
+    """
+    performance_list = []
+    dated_allocation_list = []
+    allocation_map = None
+    while start_date_int < end_date_int:
+        allocation_map = _runSingleDay(
+                start_date_int,
+                ticker_data,
+                aligned_data,
+                daily_return,
+                required_num_days,
+                perform_trades=False,
+                use_downside_correl=use_downside_correl,
+                num_processes=num_processes,
+                initial_allocation_map=allocation_map if warm_start else None,
+                optimizer_options=optimizer_options,
+                result_cache_folder=result_cache_folder)
+        dated_allocation_list.append((start_date_int, allocation_map))
+        print(datetime.date.fromtimestamp(start_date_int * 24 * 3600))
+        _printAllocMap(allocation_map, ticker_data)
+        new_perf = _runBacktest(allocation_map, aligned_data, start_date_int, start_date_int + 365)
+        if not np.isnan(new_perf):
+            performance_list.append(new_perf)
+        else:
+            print('Found nan')
+            print(start_date_int)
+            print(daily_return)
+            print(required_num_days)
+        start_date_int += 365
+
+    return (performance_list, dated_allocation_list)
+
+
+def _printBacktest(dated_allocation_list, aligned_data, daily_return):
+    """Print a day by day backtest of the walk-forward allocations."""
+    try:
+        results = backtester.runBacktest(dated_allocation_list, aligned_data, daily_return)
+    except ValueError as e:
+        print('Skipping backtest: %s' % e)
+        return
+    print('Backtest from %s: value %.4f, excess return %.4f%%, downside risk %.4f%%, Sortino %.4f' % (
+        datetime.date.fromtimestamp(results['date_array'][0] * 24 * 3600),
+        results['value_array'][-1],
+        results['excess_return'] * 100,
+        results['downside_risk'] * 100,
+        results['sortino_ratio']))
+    print('Mean turnover %.2f%%, expense drag %.4f%%' % (
+        results['turnover_array'][1:].mean() * 100 if len(results['turnover_array']) > 1 else 0,
+        results['expense_drag'] * 100))
+
+
 def _roughScore(return_list, required_return):
     print(return_list)
     return_list = np.array(return_list, dtype=np.float64)
@@ -97,61 +246,83 @@ def _roughScore(return_list, required_return):
     return (mean_return - required_return) / downside_risk
 
 
-def actualMain(
-        required_return,
-        refresh_strategy,
-        required_num_days,
-        set_start_date,
-        set_date,
-        use_downside_correl=False):
-    daily_return = math.pow(required_return, 1 / config.TRADING_DAYS_PER_YEAR)
+def _loadData(refresh_strategy, read_processes=None):
+    """Load and align data for all tickers.
 
+    Args:
+        refresh_strategy: See data_gatherer.getTickerData.
+        read_processes: How many processes to read cache files with, see
+            data_gatherer.getTickerData.
+    Returns:
+        ticker_data: Data from the data_gatherer module, with expense ratios.
+        aligned_data: See data_cleaner.alignTickerData.
+    """
     # Load full, unfiltered, and less than 1 month old data.
     start = time.time()
     ticker_data = data_gatherer.getTickerData(
         set(config.TICKER_DICT.keys()),
         config.API_KEY,
         'cache',
-        refresh_strategy)
+        refresh_strategy,
+        num_processes=read_processes,
+        held_tickers=config.CURRENT_ALLOCATION_DICT)
     for ticker in ticker_data:
-        ticker_data[ticker]['expense_ratio'] = config.TICKER_DICT[ticker]
+        ticker_data[ticker].expense_ratio = config.TICKER_DICT[ticker]
     print('Getting data took %.2fs' % (time.time() - start))
 
+    # Align once, every date only reads a window of this.
+    start = time.time()
+    aligned_data = data_cleaner.alignTickerData(
+        ticker_data,
+        price_store.readStore(data_gatherer._getStoreFolder('cache')))
+    print('Aligning data took %.2fs' % (time.time() - start))
+
+    return (ticker_data, aligned_data)
+
+
+def actualMain(
+        required_return,
+        refresh_strategy,
+        required_num_days,
+        set_start_date,
+        set_date,
+        use_downside_correl=False,
+        num_processes=1,
+        warm_start=False,
+        optimizer_options=None,
+        result_cache_folder=None,
+        read_processes=None):
+    daily_return = math.pow(required_return, 1 / config.TRADING_DAYS_PER_YEAR)
+
+    (ticker_data, aligned_data) = _loadData(refresh_strategy, read_processes)
+
     # Run the optimizer for required date(s).
     epoch = datetime.datetime.utcfromtimestamp(0)
-    optimized_list = []
     if set_start_date:
         start_date_int = (datetime.datetime.strptime(set_start_date, '%Y-%m-%d') - epoch).days
         today_int = (datetime.datetime.now() - epoch).days
-        while start_date_int < today_int:
-            allocation_map = _runSingleDay(
-                    start_date_int,
-                    deepcopy(ticker_data),
-                    daily_return,
-                    required_num_days,
-                    perform_trades=False,
-                    use_downside_correl=use_downside_correl)
-            print(datetime.date.fromtimestamp(start_date_int * 24 * 3600))
-            _printAllocMap(allocation_map, ticker_data)
-            new_perf = _runBacktest(allocation_map, deepcopy(ticker_data), start_date_int, start_date_int + 365)
-            if not np.isnan(new_perf):
-                optimized_list.append(new_perf)
-            else:
-                print('Found nan')
-                print(start_date_int)
-                print(required_return)
-                print(required_num_days)
-            # Add ~3 months of trading days.
-            start_date_int += 365
+        (optimized_list, dated_allocation_list) = _runWalkForward(
+                ticker_data,
+                aligned_data,
+                start_date_int,
+                today_int,
+                daily_return,
+                required_num_days,
+                use_downside_correl=use_downside_correl,
+                num_processes=num_processes,
+                warm_start=warm_start,
+                optimizer_options=optimizer_options,
+                result_cache_folder=result_cache_folder)
+        _printBacktest(dated_allocation_list, aligned_data, daily_return)
         rough_score = _roughScore(optimized_list, daily_return)
         print('Score: %.4f' % rough_score)
         return rough_score
-    elif set_date:
+    initial_allocation_map = config.CURRENT_ALLOCATION_DICT if warm_start else None
+    if set_date:
         date_int = (datetime.datetime.strptime(set_date, '%Y-%m-%d') - epoch).days
-        _runSingleDay(date_int, deepcopy(ticker_data), daily_return, required_num_days, use_downside_correl=use_downside_correl)
     else:
         date_int = (datetime.datetime.now() - epoch).days
-        _runSingleDay(date_int, deepcopy(ticker_data), daily_return, required_num_days, use_downside_correl=use_downside_correl)
+    _runSingleDay(date_int, ticker_data, aligned_data, daily_return, required_num_days, use_downside_correl=use_downside_correl, num_processes=num_processes, initial_allocation_map=initial_allocation_map, optimizer_options=optimizer_options, result_cache_folder=result_cache_folder)
 
 
 def main():
@@ -160,12 +331,32 @@ def main():
     if not args.required_return:
         raise ValueError('Need to set required return')
 
-    actualMain(
-            args.required_return,
-            args.refresh_strategy,
-            args.required_num_days,
-            args.set_start_date,
-            args.set_date)
+    if args.profile_span:
+        instrumentation.setProfiledSpan(args.profile_span, args.profile_file)
+    try:
+        actualMain(
+                args.required_return,
+                args.refresh_strategy,
+                args.required_num_days,
+                args.set_start_date,
+                args.set_date,
+                num_processes=args.num_processes,
+                warm_start=args.warm_start,
+                optimizer_options={
+                    'solver': args.solver,
+                    'start_increment': args.start_increment,
+                    'min_increment': args.min_increment,
+                    'max_iterations': args.max_iterations,
+                    'time_budget': args.time_budget,
+                    'prune_buys': args.prune_buys,
+                    'max_trades_per_scan': args.max_trades_per_scan},
+                result_cache_folder=args.result_cache_folder,
+                read_processes=args.read_processes)
+    finally:
+        if args.profile_span:
+            instrumentation.printProfile()
+        if args.report_file:
+            instrumentation.writeReport(args.report_file)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,305 @@
+"""Benchmark each stage of the gather, clean, optimize and trade pipeline.
+
+General strategy is:
+    1) Generate a deterministic synthetic universe for each requested size.
+    2) Write it to a temporary cache folder, as data_gatherer would.
+    3) Time each stage separately, then run it again to measure its memory,
+        so tracing doesn't slow down the timed run.
+    4) Write all results as JSON, optionally comparing to a previous run.
+"""
+import argparse
+import contextlib
+import datetime
+from data_cleaner import data_cleaner
+from data_gatherer import data_gatherer
+import io
+import json
+import multiprocessing as mp
+import numpy as np
+from optimizer import optimizer
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from trader import trader
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--sizes',
+    nargs='+',
+    default=['50x750', '200x1500'],
+    help='Universe sizes to benchmark, as <tickers>x<days>.')
+parser.add_argument(
+    '--seed',
+    type=int,
+    default=0,
+    help='Seed for the synthetic universes.')
+parser.add_argument(
+    '--required_return',
+    type=float,
+    default=1.05,
+    help='Annual return to require from the optimizer.')
+parser.add_argument(
+    '--max_iterations',
+    type=int,
+    help='Max number of optimizer iterations, to bound large sizes.')
+parser.add_argument(
+    '--num_processes',
+    type=int,
+    default=1,
+    help='How many processes the optimizer should use.')
+parser.add_argument(
+    '--output',
+    default='benchmark_results.json',
+    help='Where to write results.')
+parser.add_argument(
+    '--compare',
+    help='Previous results file to compare against.')
+parser.add_argument(
+    '--verbose',
+    action='store_true',
+    help='Show output from the benchmarked stages.')
+
+
+def _makeTickerData(num_tickers, num_days, seed=0):
+    """Generate a deterministic synthetic universe.
+
+    Tickers have random walk prices with varied drift and volatility, and
+    about a quarter of them start partway through the period.
+
+    Args:
+        num_tickers: Number of tickers to generate.
+        num_days: Number of trading days in the period.
+        seed: Random seed.
+    Returns:
+        ticker_data: See data_gatherer._getAllApiData for format, plus
+            'expense_ratio'.
+    """
+    random_state = np.random.RandomState(seed)
+    epoch = datetime.datetime.utcfromtimestamp(0)
+    first_date = (datetime.datetime(2000, 1, 3) - epoch).days
+    # Weekdays only, like trading days.
+    all_dates = np.arange(first_date, first_date + num_days * 7 // 5 + 7)
+    all_dates = all_dates[(all_dates + 3) % 7 < 5][:num_days]
+
+    ticker_data = {}
+    for t in range(num_tickers):
+        start = 0
+        if random_state.uniform() < 0.25:
+            start = random_state.randint(0, num_days // 2)
+        returns = 1 + random_state.normal(
+            random_state.uniform(0, 0.0008),
+            random_state.uniform(0.003, 0.02),
+            num_days - start)
+        prices = 100 * np.cumprod(returns)
+        ticker = 'T%05d' % t
+        ticker_data[ticker] = {
+            'name': 'Synthetic %d' % t,
+            'expense_ratio': round(random_state.uniform(0, 0.01), 4),
+            'price_data': dict(zip(
+                all_dates[start:].tolist(), prices.tolist()))}
+    return ticker_data
+
+
+def _resetPeakRss():
+    """Reset this process's peak resident memory, where Linux allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _getPeakRss(who):
+    """Get peak resident memory in bytes, see resource.getrusage."""
+    # Reported in kilobytes, except on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale
+
+
+def _runQuietly(function, verbose):
+    """Run a function, hiding its output unless verbose."""
+    if verbose:
+        return function()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function()
+
+
+def _timeStage(name, function, verbose=False, reset=None):
+    """Time a stage, then run it again to measure its memory.
+
+    Tracing memory slows allocation heavy code, so the timed run doesn't.
+    Traced memory only covers Python allocations in this process, so peak
+    resident memory is also recorded, which includes memory mapped files.
+
+    Args:
+        name: Name of the stage.
+        function: Function to run, with no arguments.
+        verbose: Whether to show the stage's output.
+        reset: Optional function to undo the stage's side effects between
+            the two runs, with no arguments.
+    Returns:
+        output: What function returned, from the timed run.
+        result: Dict of:
+            stage: Name of the stage.
+            seconds: Wall time of the timed run.
+            peak_bytes: Peak traced Python memory.
+            peak_rss_bytes: Peak resident memory of this process during
+                the stage, or since it started where that can't be reset.
+            child_peak_rss_bytes: Peak resident memory of the largest child
+                process finished so far, as Unix doesn't track it per stage.
+    """
+    start = time.perf_counter()
+    output = _runQuietly(function, verbose)
+    seconds = time.perf_counter() - start
+
+    if reset:
+        reset()
+    _resetPeakRss()
+    tracemalloc.start()
+    _runQuietly(function, verbose)
+    (_, peak_bytes) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_rss_bytes = _getPeakRss(resource.RUSAGE_SELF)
+    child_peak_rss_bytes = _getPeakRss(resource.RUSAGE_CHILDREN)
+
+    print('%-24s %10.3fs %10.1fMB %10.1fMB RSS' % (
+        name, seconds, peak_bytes / 1e6, peak_rss_bytes / 1e6))
+    return (output, {
+        'stage': name,
+        'seconds': seconds,
+        'peak_bytes': peak_bytes,
+        'peak_rss_bytes': peak_rss_bytes,
+        'child_peak_rss_bytes': child_peak_rss_bytes})
+
+
+def _runBenchmark(num_tickers, num_days, seed, required_return, optimizer_options, verbose=False):
+    """Benchmark every stage for one universe size.
+
+    Args:
+        num_tickers: Number of tickers to generate.
+        num_days: Number of trading days in the period.
+        seed: Random seed.
+        required_return: Annual return to require from the optimizer.
+        optimizer_options: Dict of extra optimizer.findOptimalAllocation args.
+        verbose: Whether to show the stages' output.
+    Returns:
+        results: List of dicts, see _timeStage.
+    """
+    print('Universe %dx%d' % (num_tickers, num_days))
+    ticker_data = _makeTickerData(num_tickers, num_days, seed)
+    tickers = sorted(ticker_data)
+    results = []
+
+    with tempfile.TemporaryDirectory() as cache_folder:
+        for ticker in tickers:
+            data = {ticker: {
+                'name': ticker_data[ticker]['name'],
+                'price_data': ticker_data[ticker]['price_data']}}
+            data_gatherer._writeCacheFile(data, ticker, cache_folder)
+
+        # The first read migrates files into the price store, so remove the
+        # store before measuring it again.
+        store_folder = data_gatherer._getStoreFolder(cache_folder)
+        for (stage, reset) in (
+                ('read_cache_files', lambda: shutil.rmtree(store_folder)),
+                ('read_cache_store', None)):
+            (_, result) = _timeStage(
+                stage,
+                lambda: data_gatherer._readCacheFiles(tickers, cache_folder),
+                verbose,
+                reset)
+            results.append(result)
+
+    end_date = max(ticker_data[tickers[0]]['price_data']) + 1
+    ((ticker_tuple, data_matrix, expense_array), result) = _timeStage(
+        'clean_and_convert',
+        lambda: data_cleaner.cleanAndConvertData(ticker_data, num_days // 2, end_date),
+        verbose)
+    results.append(result)
+
+    daily_return = pow(required_return, 1 / 253)
+
+    def findOptimalAllocation():
+        try:
+            return optimizer.findOptimalAllocation(
+                data_matrix, ticker_tuple, daily_return, expense_array,
+                use_downside_correl=False, **optimizer_options)
+        finally:
+            # Workers are only counted once they exit, and shouldn't be
+            # reused by the second run.
+            optimizer.stopWorkers()
+
+    ((_, allocation_map), result) = _timeStage(
+        'find_optimal_allocation', findOptimalAllocation, verbose)
+    results.append(result)
+
+    current_allocation_map = {ticker: 0.1 for ticker in ticker_tuple[:10]}
+    (_, result) = _timeStage(
+        'calculate_trades',
+        lambda: trader.calculateTrades(
+            allocation_map, current_allocation_map, ticker_tuple, data_matrix),
+        verbose)
+    results.append(result)
+
+    for result in results:
+        result.update({'num_tickers': num_tickers, 'num_days': num_days})
+    return results
+
+
+def _compare(results, previous_results):
+    """Print each stage's time relative to a previous run."""
+    previous = {
+        (r['num_tickers'], r['num_days'], r['stage']): r
+        for r in previous_results}
+    print('Stage                    Size          Speedup  Memory     RSS')
+    for result in results:
+        key = (result['num_tickers'], result['num_days'], result['stage'])
+        if key not in previous:
+            continue
+        # Older results have no RSS.
+        rss = '%7.2fx' % (result['peak_rss_bytes'] / previous[key]['peak_rss_bytes']) if (
+            previous[key].get('peak_rss_bytes')) else '      -'
+        print('%-24s %-12s %7.2fx %7.2fx %s' % (
+            result['stage'],
+            '%dx%d' % key[:2],
+            previous[key]['seconds'] / max(result['seconds'], 1e-9),
+            result['peak_bytes'] / max(previous[key]['peak_bytes'], 1),
+            rss))
+
+
+def main():
+    args = parser.parse_args()
+
+    optimizer_options = {'num_processes': args.num_processes}
+    if args.max_iterations is not None:
+        optimizer_options['max_iterations'] = args.max_iterations
+
+    results = []
+    for size in args.sizes:
+        (num_tickers, num_days) = (int(x) for x in size.split('x'))
+        results.extend(_runBenchmark(
+            num_tickers, num_days, args.seed, args.required_return,
+            optimizer_options, args.verbose))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'time': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': mp.cpu_count(),
+            'args': vars(args),
+            'results': results}, f, indent=2)
+    print('Wrote %s' % args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            _compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
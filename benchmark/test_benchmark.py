@@ -0,0 +1,73 @@
+"""Tests for the benchmark module."""
+
+from . import benchmark
+import multiprocessing as mp
+import numpy as np
+import tracemalloc
+import unittest
+from unittest import mock
+
+
+class TestMakeTickerData(unittest.TestCase):
+
+    def test_deterministic(self):
+        self.assertDictEqual(
+            benchmark._makeTickerData(5, 50, seed=1),
+            benchmark._makeTickerData(5, 50, seed=1))
+
+    def test_shape(self):
+        ticker_data = benchmark._makeTickerData(5, 50)
+
+        self.assertEqual(len(ticker_data), 5)
+        self.assertLessEqual(
+            max(len(data['price_data']) for data in ticker_data.values()), 50)
+
+
+class TestRunBenchmark(unittest.TestCase):
+
+    def test_allStages(self):
+        results = benchmark._runBenchmark(5, 100, 0, 1.05, {'max_iterations': 5})
+
+        self.assertListEqual(
+            [result['stage'] for result in results],
+            ['read_cache_files', 'read_cache_store', 'clean_and_convert',
+             'find_optimal_allocation', 'calculate_trades'])
+        for result in results:
+            self.assertGreaterEqual(result['seconds'], 0)
+            self.assertGreater(result['peak_bytes'], 0)
+            self.assertGreater(result['peak_rss_bytes'], 0)
+            self.assertGreaterEqual(result['child_peak_rss_bytes'], 0)
+            self.assertEqual(result['num_tickers'], 5)
+
+
+class TestTimeStage(unittest.TestCase):
+
+    def test_untracedTiming(self):
+        traced = []
+        reset = mock.Mock()
+
+        def stage():
+            traced.append(tracemalloc.is_tracing())
+            return len(traced)
+
+        (output, result) = benchmark._timeStage('stage', stage, reset=reset)
+
+        self.assertListEqual(traced, [False, True])
+        self.assertEqual(output, 1)
+        reset.assert_called_once_with()
+        self.assertEqual(result['stage'], 'stage')
+
+    def test_childProcesses(self):
+        def stage():
+            with mp.get_context('fork').Pool(1) as pool:
+                pool.map(np.ones, [1000000])
+                pool.close()
+                pool.join()
+
+        (_, result) = benchmark._timeStage('stage', stage)
+
+        self.assertGreater(result['child_peak_rss_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
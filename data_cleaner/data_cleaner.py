@@ -1,5 +1,7 @@
 """Convert ticker_data to a data_matrix for processing."""
+from data_gatherer import ticker_series
 import functools
+from instrumentation import instrumentation
 import numpy as np
 from scipy.stats.mstats import gmean
 
@@ -39,122 +41,153 @@ def _getRatios(ticker_data):
     print('Removed %d tickers' % len(removed_tickers))
     print(removed_tickers)
 
-def _removeFutureData(ticker_data, end_date):
-    """Remove data on or after a given date in place.
+def _alignStore(universe, ticker_tuple, store):
+    """Use a price store directly as aligned data, where it matches.
 
     Args:
-        ticker_data: Data from the data_gatherer module.
-        end_date: Data on or after this date should be discarded.
+        universe: A ticker_series.Universe.
+        ticker_tuple: Tuple of the universe's tickers, sorted alphabetically.
+        store: See data_gatherer.price_store.readStore.
+    Returns:
+        aligned_data: See alignTickerData, or None if the store is missing
+            tickers or disagrees with the universe.
     """
-    for ticker in ticker_data:
-        for date_int in set(ticker_data[ticker]['price_data'].keys()):
-            if date_int >= end_date:
-                del ticker_data[ticker]['price_data'][date_int]
+    (store_ticker_tuple, _, date_array, price_matrix) = store
+    if not set(ticker_tuple).issubset(store_ticker_tuple):
+        return None
 
+    # The store is already aligned, so only take columns when it has extra
+    # tickers, and otherwise share its memory map.
+    if ticker_tuple != store_ticker_tuple:
+        price_matrix = price_matrix[:, np.searchsorted(store_ticker_tuple, ticker_tuple)]
+    present_matrix = ~np.isnan(price_matrix)
+    num_days = [len(universe[ticker].date_array) for ticker in ticker_tuple]
+    if not np.array_equal(present_matrix.sum(axis=0), num_days):
+        return None
 
-def _removePastData(ticker_data, start_date):
-    if not start_date:
-        return
+    rows = present_matrix.any(axis=1)
+    if not rows.all():
+        (date_array, price_matrix, present_matrix) = (
+            date_array[rows], price_matrix[rows], present_matrix[rows])
 
-    for ticker in ticker_data:
-        for date_int in set(ticker_data[ticker]['price_data'].keys()):
-            if date_int < start_date:
-                del ticker_data[ticker]['price_data'][date_int]
+    return (ticker_tuple, date_array, price_matrix, present_matrix)
 
 
-def _removeLowDataTickers(ticker_data, required_num_days):
-    """Remove tickers without enough days of data in place.
+@instrumentation.timed('data_cleaner.align')
+def alignTickerData(ticker_data, store=None):
+    """Align ticker data into a single matrix of prices.
 
     Args:
-        ticker_data: Data from the data_gatherer module.
-        required_num_days: How many days of data each ticker should have.
+        ticker_data: A ticker_series.Universe, or data in the older dict
+            format of the data_gatherer module.
+        store: Optional price store, see data_gatherer.price_store.readStore.
+            If it holds the same prices as ticker_data, its matrix and dates
+            are used as is, rather than rebuilt from ticker_data.
+    Returns:
+        aligned_data: Tuple of:
+            ticker_tuple: Tuple of tickers, sorted alphabetically.
+            date_array: Sorted array of every date with any data.
+            price_matrix: Rows = dates, columns = tickers, values = prices,
+                NaN where missing.
+            present_matrix: Boolean matrix, True where a price is present.
+            expense_array: Array of expense ratios, NaN where missing.
     """
-    for ticker in set(ticker_data.keys()):
-        if len(ticker_data[ticker]['price_data']) < required_num_days:
-            del ticker_data[ticker]
-
-
-def _removeLowDataDays(ticker_data):
-    """Remove any days of data with one or more tickers missing, in place."""
-    # Get a set of all known dates.
-    date_set = set()
-    for data in ticker_data.values():
-        date_set = date_set.union(data['price_data'].keys())
-
-    # Determine what dates are common to all tickers.
-    for ticker, data in ticker_data.items():
-        curr_date_set = set(data['price_data'].keys())
-        if len(date_set.intersection(curr_date_set)) < (len(date_set) / 2):
-            print(
-                    'Pathological ticker found: %s %d / %d' % (
-                        ticker,
-                        len(date_set.intersection(curr_date_set)),
-                        len(date_set)))
-        date_set = date_set.intersection(curr_date_set)
-
-    if not date_set:
-        raise ValueError('No common dates left.')
-
-    for ticker, data in ticker_data.items():
-        remove_keys = set(data['price_data'].keys()) - date_set
-        for remove_key in remove_keys:
-            del data['price_data'][remove_key]
-
-
-def _convertToMatrix(ticker_data):
-    """Calculate data matrix from ticker data.
+    universe = ticker_series.Universe.fromTickerData(ticker_data)
+    ticker_tuple = tuple(sorted(universe.keys()))
+    aligned_prices = _alignStore(universe, ticker_tuple, store) if store else None
+    if aligned_prices:
+        (ticker_tuple, date_array, price_matrix, present_matrix) = aligned_prices
+    else:
+        date_arrays = [universe[ticker].date_array for ticker in ticker_tuple]
+        date_array = np.unique(np.concatenate(date_arrays)).astype(np.int64) if date_arrays else np.zeros(0, dtype=np.int64)
+
+        price_matrix = np.full((len(date_array), len(ticker_tuple)), np.nan, dtype=np.float64)
+        present_matrix = np.zeros((len(date_array), len(ticker_tuple)), dtype=bool)
+        for column, ticker in enumerate(ticker_tuple):
+            rows = np.searchsorted(date_array, date_arrays[column])
+            price_matrix[rows, column] = universe[ticker].price_array
+            present_matrix[rows, column] = True
+
+    expense_array = np.array(
+        [universe[ticker].expense_ratio for ticker in ticker_tuple],
+        dtype=np.float64)
+
+    # Shared across many dates, so guard against accidental mutation.
+    for array in (date_array, price_matrix, present_matrix, expense_array):
+        array.flags.writeable = False
+
+    return (ticker_tuple, date_array, price_matrix, present_matrix, expense_array)
+
+
+@instrumentation.timed('data_cleaner.clean')
+def cleanAlignedData(aligned_data, required_num_days, end_date, first_date=None, tickers=None):
+    """Clean aligned data and calculate its return matrix.
+
+    Equivalent to removing future, past, and low data tickers, then low data
+    days, and converting to a matrix. aligned_data is only read, so it can be
+    built once and shared across many dates, and work is proportional to the
+    date window.
 
     Args:
-        ticker_data: Data from the data_gatherer module.
-    Returns:    
-        return_matrix: Rows = days, columns = tickers, values = % price changes.
-            Tickers are ordered alphabetically.
-        ticker_tuple: Tuple of tickers in the matrix, in the same order.
+        aligned_data: See alignTickerData.
+        required_num_days: How many days of data each ticker should have.
+        end_date: Data on or after this date should be discarded.
+        first_date: Data before this date should be discarded.
+        tickers: Optional collection of tickers to limit the output to.
+    Returns:
+        See cleanAndConvertData.
     """
-    ticker_tuple = tuple(sorted(ticker_data.keys()))
-
-    # Generate a 2-d array of raw prices.
-    raw_price_list = []
-    expense_ratio_list = []
-    for ticker in ticker_tuple:
-        new_row = []
-        for date in sorted(ticker_data[ticker]['price_data'].keys()):
-            new_row.append(ticker_data[ticker]['price_data'][date])
-        raw_price_list.append(new_row)
-        expense_ratio_list.append(ticker_data[ticker]['expense_ratio'])
-    raw_price_array = np.array(raw_price_list, dtype=np.float64).transpose()
+    (ticker_tuple, date_array, price_matrix, present_matrix, expense_array) = aligned_data
+
+    columns = np.arange(len(ticker_tuple))
+    if tickers is not None:
+        columns = np.array(
+            [c for c, ticker in enumerate(ticker_tuple) if ticker in tickers],
+            dtype=np.int64)
+
+    # Dates are sorted, so the date window is a slice.
+    start_row = np.searchsorted(date_array, first_date) if first_date else 0
+    end_row = np.searchsorted(date_array, end_date)
+    present_matrix = present_matrix[start_row:end_row, columns]
+
+    enough_data = present_matrix.sum(axis=0) >= required_num_days
+    columns = columns[enough_data]
+    present_matrix = present_matrix[:, enough_data]
+
+    num_dates = np.count_nonzero(present_matrix.any(axis=1))
+    for column, num_days in zip(columns, present_matrix.sum(axis=0)):
+        if num_days < num_dates / 2:
+            print('Pathological ticker found: %s %d / %d' % (
+                ticker_tuple[column], num_days, num_dates))
+
+    rows = np.flatnonzero(present_matrix.all(axis=1))
+    if not len(columns) or not len(rows):
+        raise ValueError('No common dates left.')
 
+    raw_price_array = price_matrix[np.ix_(rows + start_row, columns)]
     return_matrix = raw_price_array[1:] / raw_price_array[:-1]
-    expense_array = np.array(expense_ratio_list, dtype=np.float64)
     print('Days of data %d' % len(return_matrix))
 
-    return (ticker_tuple, return_matrix, expense_array)
+    return (
+        tuple(ticker_tuple[column] for column in columns),
+        return_matrix,
+        expense_array[columns])
 
 
 def cleanAndConvertData(ticker_data, required_num_days, end_date, first_date=None):
     """Convert ticker data to a matrix for numpy processing.
 
     Args:
-        ticker_data: Data from the data_gatherer module.
+        ticker_data: See alignTickerData.
         required_num_days: How many days of data each ticker should have.
         end_date: Data on or after this date should be discarded.
         first_date: Data before this date should be discarded.
 
     Returns:
+        ticker_tuple: Tuple of tickers in the matrix, in the same order.
         data_matrix: Rows = days, columns = tickers, values = % price changes.
             Tickers are ordered alphabetically.
-        ticker_tuple: Tuple of tickers in the matrix, in the same order.
+        expense_array: Array of expense ratios, in the same order.
     """
-    _removeFutureData(ticker_data, end_date)
-
-    _removePastData(ticker_data, first_date)
-
-    # _getRatios(ticker_data)
-
-    _removeLowDataTickers(ticker_data, required_num_days)
-
-    _removeLowDataDays(ticker_data)
-
-    (ticker_tuple, data_matrix, expense_array) = _convertToMatrix(ticker_data)
-
-    return (ticker_tuple, data_matrix, expense_array)
+    return cleanAlignedData(
+        alignTickerData(ticker_data), required_num_days, end_date, first_date)
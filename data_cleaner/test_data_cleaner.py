@@ -2,102 +2,221 @@
 
 from . import data_cleaner
 import config
+from copy import deepcopy
+from data_gatherer import price_store
+from data_gatherer import ticker_series
 import numpy as np
+import tempfile
 import unittest
 
 
-class TestRemoveFutureData(unittest.TestCase):
+def _referenceCleanAndConvert(ticker_data, required_num_days, end_date, first_date):
+    """Clean ticker_data the way the old dict pipeline did, as a reference.
 
-    def test_basic(self):
-        test_data = {
-                'fake': {
-                    'price_data': {
-                        10: 10.1,
-                        11: 11.1,
-                        12: 12.1
-                        }
-                    }
-                }
-        data_cleaner._removeFutureData(test_data, 11)
-        expected = {
-                'fake': {
-                    'price_data': {
-                        10: 10.1
-                        }
-                    }
-                }
-        self.assertDictEqual(test_data['fake']['price_data'], expected['fake']['price_data'])
+    Returns:
+        See data_cleaner.cleanAndConvertData.
+    """
+    price_data = {}
+    for ticker, data in ticker_data.items():
+        prices = {
+            date_int: price for date_int, price in data['price_data'].items()
+            if date_int < end_date and (not first_date or date_int >= first_date)}
+        if len(prices) >= required_num_days:
+            price_data[ticker] = prices
 
+    date_set = set.intersection(*(set(prices) for prices in price_data.values()))
+    ticker_tuple = tuple(sorted(price_data))
+    raw_price_array = np.array(
+        [[price_data[ticker][date_int] for date_int in sorted(date_set)]
+         for ticker in ticker_tuple], dtype=np.float64).transpose()
+    expense_array = np.array(
+        [ticker_data[ticker]['expense_ratio'] for ticker in ticker_tuple],
+        dtype=np.float64)
 
-class TestRemoveLowDataTickers(unittest.TestCase):
+    return (ticker_tuple, raw_price_array[1:] / raw_price_array[:-1], expense_array)
 
-    def test_basic(self):
-        test_data = {
-                'fake1': {
-                    'price_data': {
-                        0: 0
-                        }
-                    },
-                'fake2': {
-                    'price_data': {
-                        0: 0,
-                        1: 1
-                        }
-                    }
-                }
-        data_cleaner._removeLowDataTickers(test_data, 2)
-        
-        self.assertSetEqual(set(test_data.keys()), set(('fake2',)))
 
-
-class TestRemoveLowDataDays(unittest.TestCase):
-    
-    def test_basic(self):
-        test_data = {
-                'fake1': {
-                    'price_data': {
-                        0: 0
-                        }
-                    },
-                'fake2': {
-                    'price_data': {
-                        0: 0,
-                        1: 1
-                        }
-                    }
-                }
-        data_cleaner._removeLowDataDays(test_data)
-
-        self.assertSetEqual(set(test_data['fake1']['price_data'].keys()), set((0,)))
-        self.assertSetEqual(set(test_data['fake2']['price_data'].keys()), set((0,)))
+def _randomTickerData(seed=0):
+    random_state = np.random.RandomState(seed)
+    ticker_data = {}
+    for t in range(6):
+        dates = np.flatnonzero(random_state.uniform(size=200) < 0.9) + 20 * t
+        ticker_data['fake%d' % t] = {
+            'expense_ratio': random_state.uniform(0, 0.01),
+            'price_data': {
+                int(date): float(random_state.uniform(1, 100)) for date in dates}}
+    return ticker_data
 
 
-class TestConvertToMatrix(unittest.TestCase):
+class TestCleanAndConvertData(unittest.TestCase):
 
     def test_basic(self):
         test_data = {
                 'fake1': {
                     'expense_ratio': 0.0001,
-                    'price_data': {
-                        0: 1,
-                        1: 2
-                        }
+                    'price_data': {0: 1, 1: 2, 2: 3}
                     },
                 'fake2': {
                     'expense_ratio': 0.01,
-                    'price_data': {
-                        0: 4,
-                        1: 6
-                        }
+                    'price_data': {0: 4, 1: 6}
+                    },
+                'fake3': {
+                    'expense_ratio': 0.01,
+                    'price_data': {1: 1}
                     }
                 }
-        (ticker_tuple, return_matrix, expense_array) = data_cleaner._convertToMatrix(test_data)
+        (ticker_tuple, return_matrix, expense_array) = data_cleaner.cleanAndConvertData(
+            test_data, 2, 10)
 
         self.assertEqual(ticker_tuple, ('fake1', 'fake2'))
         self.assertEqual(len(return_matrix), 1)
         self.assertTupleEqual(tuple(return_matrix[0]), (2.0, 1.5))
         self.assertTupleEqual(tuple(expense_array), (0.0001, 0.01))
 
+    def _checkMatchesReference(self, required_num_days, end_date, first_date):
+        ticker_data = _randomTickerData()
+        expected = _referenceCleanAndConvert(
+            ticker_data, required_num_days, end_date, first_date)
+
+        actual = data_cleaner.cleanAndConvertData(
+            ticker_data, required_num_days, end_date, first_date)
+
+        self.assertTupleEqual(actual[0], expected[0])
+        np.testing.assert_array_equal(actual[1], expected[1])
+        np.testing.assert_array_equal(actual[2], expected[2])
+        self.assertDictEqual(ticker_data, _randomTickerData())
+
+    def test_endDate(self):
+        self._checkMatchesReference(100, 170, None)
+
+    def test_window(self):
+        self._checkMatchesReference(60, 190, 50)
+
+    def test_universe(self):
+        ticker_data = _randomTickerData()
+        expected = data_cleaner.cleanAndConvertData(ticker_data, 60, 190, 50)
+        actual = data_cleaner.cleanAndConvertData(
+            ticker_series.Universe.fromTickerData(ticker_data), 60, 190, 50)
+
+        self.assertTupleEqual(actual[0], expected[0])
+        np.testing.assert_array_equal(actual[1], expected[1])
+        np.testing.assert_array_equal(actual[2], expected[2])
+
+    def test_noCommonDates(self):
+        with self.assertRaises(ValueError):
+            data_cleaner.cleanAndConvertData(_randomTickerData(), 1000, 100)
+
+
+class TestCleanAlignedData(unittest.TestCase):
+
+    def setUp(self):
+        self.ticker_data = _randomTickerData()
+        self.aligned_data = data_cleaner.alignTickerData(self.ticker_data)
+
+    def _checkMatches(self, actual, expected):
+        self.assertTupleEqual(actual[0], expected[0])
+        np.testing.assert_array_equal(actual[1], expected[1])
+        np.testing.assert_array_equal(actual[2], expected[2])
+
+    def test_tickers(self):
+        tickers = {'fake1', 'fake3', 'fake4', 'missing'}
+        expected = data_cleaner.cleanAndConvertData(
+            {ticker: data for ticker, data in self.ticker_data.items() if ticker in tickers},
+            60, 190, 50)
+        actual = data_cleaner.cleanAlignedData(
+            self.aligned_data, 60, 190, 50, tickers=tickers)
+
+        self._checkMatches(actual, expected)
+
+    def test_firstDate(self):
+        for first_date in (None, 0, 50, 100):
+            expected = data_cleaner.cleanAndConvertData(
+                deepcopy(self.ticker_data), 40, 190, first_date)
+            actual = data_cleaner.cleanAlignedData(
+                self.aligned_data, 40, 190, first_date)
+
+            self._checkMatches(actual, expected)
+
+    def test_firstDateExcludesEarlyTickers(self):
+        # fake0 only has data before date 200.
+        actual = data_cleaner.cleanAlignedData(self.aligned_data, 20, 300, 200)
+
+        self.assertNotIn('fake0', actual[0])
+        self.assertIn('fake5', actual[0])
+
+    def test_readOnly(self):
+        (_, date_array, price_matrix, present_matrix, expense_array) = self.aligned_data
+        with self.assertRaises(ValueError):
+            date_array[0] = 0
+        with self.assertRaises(ValueError):
+            price_matrix[0, 0] = 0.0
+        with self.assertRaises(ValueError):
+            present_matrix[0, 0] = False
+        with self.assertRaises(ValueError):
+            expense_array[0] = 0.0
+
+    def test_readOnlyFromStore(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            price_store.updateStore(temp_dir, self.ticker_data)
+            aligned_data = data_cleaner.alignTickerData(
+                self.ticker_data, price_store.readStore(temp_dir))
+            with self.assertRaises(ValueError):
+                aligned_data[2][0, 0] = 0.0
+            with self.assertRaises(ValueError):
+                aligned_data[1][0] = 0
+            del aligned_data
+
+    def test_unchanged(self):
+        copies = [np.array(array) for array in self.aligned_data[1:]]
+        data_cleaner.cleanAlignedData(self.aligned_data, 40, 190, 50)
+
+        for array, copy in zip(self.aligned_data[1:], copies):
+            np.testing.assert_array_equal(array, copy)
+
+
+class TestAlignTickerData(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store_folder = self.temp_dir.name + '/store'
+        self.ticker_data = _randomTickerData()
+        price_store.updateStore(self.store_folder, self.ticker_data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _checkMatches(self, actual, expected):
+        self.assertTupleEqual(actual[0], expected[0])
+        for actual_array, expected_array in zip(actual[1:], expected[1:]):
+            np.testing.assert_array_equal(actual_array, expected_array)
+
+    def test_store(self):
+        store = price_store.readStore(self.store_folder)
+        expected = data_cleaner.alignTickerData(self.ticker_data)
+        actual = data_cleaner.alignTickerData(self.ticker_data, store)
+
+        self._checkMatches(actual, expected)
+        self.assertTrue(np.shares_memory(actual[2], store[3]))
+
+    def test_storeExtraTickers(self):
+        price_store.updateStore(self.store_folder, {
+            'extra': {'name': 'extra', 'price_data': {1000: 1.0}}})
+        expected = data_cleaner.alignTickerData(self.ticker_data)
+        actual = data_cleaner.alignTickerData(
+            self.ticker_data, price_store.readStore(self.store_folder))
+
+        self._checkMatches(actual, expected)
+
+    def test_staleStore(self):
+        ticker_data = deepcopy(self.ticker_data)
+        del ticker_data['fake0']['price_data'][max(ticker_data['fake0']['price_data'])]
+        store = price_store.readStore(self.store_folder)
+        expected = data_cleaner.alignTickerData(ticker_data)
+        actual = data_cleaner.alignTickerData(ticker_data, store)
+
+        self._checkMatches(actual, expected)
+        self.assertFalse(np.shares_memory(actual[2], store[3]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,232 @@
+"""Encode and decode cache files, with one of several codecs.
+
+Each codec has its own file extension, so a file's codec is known from its
+name, and a cache can mix codecs, e.g. while moving to a faster one:
+    bz2: JSON compressed with bz2, the original format.
+    zlib: JSON compressed with zlib.
+    lzma: JSON compressed with lzma.
+    binary: Uncompressed .npz arrays of dates and prices.
+
+Run this module to compare codecs on a cache folder's files.
+"""
+
+import argparse
+import bz2
+from data_gatherer import ticker_series
+import glob
+import io
+import json
+import lzma
+import numpy as np
+import os
+import time
+import zlib
+
+
+DEFAULT_CODEC = 'bz2'
+BINARY_CODEC = 'binary'
+EXTENSIONS = {
+    'bz2': '.json.bz2',
+    'zlib': '.json.zz',
+    'lzma': '.json.xz',
+    BINARY_CODEC: '.npz'}
+_COMPRESSORS = {
+    'bz2': (bz2.compress, bz2.decompress),
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress)}
+
+
+def getFilename(cache_folder, ticker, codec=DEFAULT_CODEC):
+    """Get the name of a ticker's cache file."""
+    return cache_folder + '/' + ticker + EXTENSIONS[codec]
+
+
+def getCodec(filename):
+    """Get the codec of a cache file from its name.
+
+    Args:
+        filename: String name of a cache file.
+    Returns:
+        codec: Name of the codec, see EXTENSIONS.
+    """
+    for codec, extension in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return codec
+    raise ValueError('Unknown cache file type %s' % filename)
+
+
+def findFile(cache_folder, ticker, codec=None):
+    """Find a ticker's cache file.
+
+    Args:
+        cache_folder: Where cache files are stored.
+        ticker: Ticker string.
+        codec: Codec of the file if known, e.g. from the cache manifest, to
+            avoid looking for every codec's file.
+    Returns:
+        filename: String name of the file, or None if there is none.
+    """
+    codecs = [codec] if codec else list(EXTENSIONS)
+    for codec in codecs:
+        filename = getFilename(cache_folder, ticker, codec)
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+
+def getAllFiles(cache_folder):
+    """Get every cache file in a folder, of any codec, sorted by name."""
+    filenames = []
+    for extension in EXTENSIONS.values():
+        filenames.extend(glob.glob(cache_folder + '/*' + extension))
+    return sorted(filenames)
+
+
+def _encodeArrays(universe):
+    """Encode a universe as uncompressed .npz arrays."""
+    arrays = {
+        'tickers': np.array(list(universe), dtype=np.str_),
+        'names': np.array([series.name for series in universe.values()], dtype=np.str_)}
+    for index, series in enumerate(universe.values()):
+        arrays['dates_%d' % index] = series.date_array
+        arrays['prices_%d' % index] = series.price_array
+    output = io.BytesIO()
+    np.savez(output, **arrays)
+    return output.getvalue()
+
+
+def _decodeArrays(file_bytes):
+    """Decode uncompressed .npz arrays, see _encodeArrays."""
+    universe = ticker_series.Universe()
+    with np.load(io.BytesIO(file_bytes)) as arrays:
+        for index, (ticker, name) in enumerate(zip(arrays['tickers'], arrays['names'])):
+            universe[str(ticker)] = ticker_series.TickerSeries(
+                str(name), arrays['dates_%d' % index], arrays['prices_%d' % index])
+    return universe
+
+
+def _decodeJson(byte_data):
+    """Decode JSON in the data_gatherer._getAllApiData format."""
+    universe = ticker_series.Universe()
+    for ticker, data in json.loads(byte_data.decode()).items():
+        price_data = data['price_data']
+        # JSON cannot have non-string keys, so dates are parsed here.
+        date_array = np.array(list(price_data.keys()), dtype=np.int32)
+        price_array = np.fromiter(
+            price_data.values(), dtype=np.float64, count=len(price_data))
+        order = np.argsort(date_array, kind='stable')
+        universe[ticker] = ticker_series.TickerSeries(
+            data['name'], date_array[order], price_array[order])
+    return universe
+
+
+def encode(ticker_data, codec=DEFAULT_CODEC):
+    """Encode ticker data as the contents of a cache file.
+
+    Args:
+        ticker_data: A ticker_series.Universe, or see
+            data_gatherer._getAllApiData for format.
+        codec: Name of the codec, see EXTENSIONS.
+    Returns:
+        file_bytes: Contents of the file.
+    """
+    if codec == BINARY_CODEC:
+        return _encodeArrays(ticker_series.Universe.fromTickerData(ticker_data))
+    if isinstance(ticker_data, ticker_series.Universe):
+        ticker_data = ticker_data.toTickerData()
+    (compress, _) = _COMPRESSORS[codec]
+    return compress(json.dumps(ticker_data).encode())
+
+
+def decode(file_bytes, codec=DEFAULT_CODEC):
+    """Decode the contents of a cache file.
+
+    Args:
+        file_bytes: Contents of the file.
+        codec: Name of the codec, see EXTENSIONS.
+    Returns:
+        universe: A ticker_series.Universe of the file's tickers.
+        num_bytes: Size of the file's data, once decompressed.
+    """
+    if codec == BINARY_CODEC:
+        return (_decodeArrays(file_bytes), len(file_bytes))
+    (_, decompress) = _COMPRESSORS[codec]
+    byte_data = decompress(file_bytes)
+    return (_decodeJson(byte_data), len(byte_data))
+
+
+def benchmarkCodecs(filenames, codecs=None):
+    """Time writing and reading files with each codec.
+
+    Args:
+        filenames: List of cache file names, of any codec, to use as data.
+        codecs: Names of codecs to compare, or None for all of them.
+    Returns:
+        results: List of dicts of 'codec', 'bytes', 'write_seconds', and
+            'read_seconds', one per codec.
+    """
+    # Files are written from the dict format, as by data_gatherer.
+    ticker_data_list = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            ticker_data_list.append(
+                decode(f.read(), getCodec(filename))[0].toTickerData())
+
+    results = []
+    for codec in codecs or EXTENSIONS:
+        start = time.perf_counter()
+        file_bytes_list = [encode(ticker_data, codec) for ticker_data in ticker_data_list]
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for file_bytes in file_bytes_list:
+            decode(file_bytes, codec)
+        read_seconds = time.perf_counter() - start
+
+        results.append({
+            'codec': codec,
+            'bytes': sum(len(file_bytes) for file_bytes in file_bytes_list),
+            'write_seconds': write_seconds,
+            'read_seconds': read_seconds})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--cache_folder',
+        default='cache',
+        help='Where cache files are.')
+    parser.add_argument(
+        '--max_files',
+        type=int,
+        default=200,
+        help='How many cache files to compare codecs on.')
+    parser.add_argument(
+        '--codecs',
+        nargs='+',
+        choices=sorted(EXTENSIONS),
+        help='Codecs to compare, defaults to all of them.')
+    args = parser.parse_args()
+
+    filenames = getAllFiles(args.cache_folder)[:args.max_files]
+    if not filenames:
+        raise ValueError('No cache files in %s' % args.cache_folder)
+    results = benchmarkCodecs(filenames, args.codecs)
+
+    # Ratios are to the first codec's size. Throughput is in files, as sizes
+    # differ between codecs.
+    print('Compared %d files' % len(filenames))
+    print('%-8s %10s %8s %14s %14s' % (
+        'Codec', 'Size', 'Ratio', 'Write files/s', 'Read files/s'))
+    for result in results:
+        print('%-8s %8.1fMB %7.2fx %14.1f %14.1f' % (
+            result['codec'],
+            result['bytes'] / 1e6,
+            result['bytes'] / results[0]['bytes'],
+            len(filenames) / result['write_seconds'],
+            len(filenames) / result['read_seconds']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,156 @@
 """Control the gathering and caching of stock data.
 
 General strategy is:
-    1) For every given ticker, check the cache folder for that ticker's file.
-    2) Add all tickers to a priority queue, sorted by modification timestamp..
-    3) For all tickers that are outdated (or 1% of tickers, whichever is
-        greater), load them async via the API and re-write them.
-    4) For all other tickers, async load their files.
+    1) For every given ticker, check the cache manifest for that ticker's
+        file.
+    2) Add all stale tickers to a priority queue, by how many trading days
+        of prices they are missing, weighted up for tickers currently held.
+    3) For the highest priority tickers that fit in the run's API call
+        budget, load them concurrently via the API, within a shared rate
+        limit, and re-write each as it completes.
+    4) For all other tickers, load them from the price store, falling back
+        to their files for tickers not yet in the store.
 """
 
-import bz2
+from concurrent import futures
 import datetime
 from copy import deepcopy
+import heapq
+from data_gatherer import cache_codec
+from data_gatherer import price_store
+from data_gatherer import ticker_series
+from instrumentation import instrumentation
 import json
 import math
+import numpy as np
 import os
 import requests
 import sys
+import threading
 import time
-
+import zlib
+
+
+API_URL = 'https://www.alphavantage.co/query'
+MAX_ATTEMPTS = 10
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+NAME_INDEX_FILE = 'names.json'
+NAME_TTL_DAYS = 365
+HELD_STALENESS_WEIGHT = 5
+EMPTY_REFRESH_BACKOFF = 2
+MANIFEST_FILE = 'manifest.json'
+SETTINGS_FILE = 'settings.json'
+READ_PROGRESS_FILES = 500
+NUM_SLOW_FILES = 5
 
 local_cache = {}
+thread_state = threading.local()
+name_index_lock = threading.Lock()
+
+
+class _TokenBucket(object):
+    """Limit how often requests are made, across all threads."""
+
+    def __init__(self, requests_per_minute, burst=1):
+        """Create a bucket.
+
+        Args:
+            requests_per_minute: Sustained number of requests allowed.
+            burst: How many requests may be made back to back.
+        """
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be made."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = _TokenBucket(60)
+
+
+def setRequestsPerMinute(requests_per_minute, burst=1):
+    """Set the API rate limit, e.g. to match an AlphaVantage plan."""
+    global rate_limiter
+    rate_limiter = _TokenBucket(requests_per_minute, burst)
+
+
+def _readSettings(cache_folder):
+    """Read the settings saved in a cache folder.
+
+    Args:
+        cache_folder: Where cache files are stored.
+    Returns:
+        settings: Dict, with 'codec' if set, see setCacheCodec.
+    """
+    filename = cache_folder + '/' + SETTINGS_FILE
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def setCacheCodec(cache_folder, codec):
+    """Set the codec a cache folder's files are written with, see cache_codec.
+
+    The setting is saved in the folder, so every later refresh uses it,
+    whichever script runs it.
+
+    Args:
+        cache_folder: Where cache files are stored.
+        codec: Name of the codec.
+    """
+    if codec not in cache_codec.EXTENSIONS:
+        raise ValueError('Unknown cache codec %s' % codec)
+    settings = _readSettings(cache_folder)
+    settings['codec'] = codec
+    os.makedirs(cache_folder, exist_ok=True)
+    filename = cache_folder + '/' + SETTINGS_FILE
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(settings, f, indent=0, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def _getWriteCodec(settings, entry=None):
+    """Get the codec to write a ticker's cache file with.
+
+    Args:
+        settings: See _readSettings. Its codec is used if set.
+        entry: The ticker's manifest entry, see _readManifest, or None.
+            Otherwise the file keeps its codec.
+    Returns:
+        codec: Name of the codec, DEFAULT_CODEC for new files.
+    """
+    return (
+        settings.get('codec')
+        or (entry or {}).get('codec')
+        or cache_codec.DEFAULT_CODEC)
+
+
+def _getSession():
+    """Get this thread's requests Session, so connections are reused."""
+    if not hasattr(thread_state, 'session'):
+        thread_state.session = requests.Session()
+    return thread_state.session
+
+
+def _getStoreFolder(cache_folder):
+    """Get the price store folder for a cache folder."""
+    return cache_folder + '/store'
 
 
 def _callApi(request, required_key):
@@ -32,19 +163,26 @@ def _callApi(request, required_key):
         result: A partially validated response.
     """
     if request in local_cache:
+        instrumentation.count('data_gatherer.api.local_cache_hits')
         return local_cache[request]
 
     attempts = 0
     aggregated_results = {}
     while True:
-        time.sleep(1)
+        if attempts:
+            instrumentation.count('data_gatherer.api.retries')
+            time.sleep(min(
+                BACKOFF_SECONDS * pow(2, attempts - 1), MAX_BACKOFF_SECONDS))
 
         attempts += 1
-        if attempts >= 120:
+        if attempts > MAX_ATTEMPTS:
             print(aggregated_results)
             raise IOError('Too many attempts for request %s' % request)
 
-        raw_result = requests.get(request)
+        rate_limiter.acquire()
+        with instrumentation.span('data_gatherer.api'):
+            raw_result = _getSession().get(request)
+        instrumentation.count('data_gatherer.api.calls')
 
         # Retry w/o error if server is swamped.
         if raw_result.status_code == 503:
@@ -85,9 +223,9 @@ def _callSearchApi(ticker, api_key):
     Returns:
         name: String name of this ticker.
     """
-    base_request = 'https://www.alphavantage.co/query?function=SYMBOL_SEARCH&keywords=%s&apikey=%s'
+    base_request = '%s?function=SYMBOL_SEARCH&keywords=%s&apikey=%s'
 
-    request = base_request % (ticker, api_key)
+    request = base_request % (API_URL, ticker, api_key)
     result = _callApi(request, 'bestMatches')
 
     for match in result['bestMatches']:
@@ -98,20 +236,83 @@ def _callSearchApi(ticker, api_key):
 
 
 
-def _callDailyAdjustedApi(ticker, api_key):
+def _readNameIndex(cache_folder):
+    """Read the persistent index of ticker names.
+
+    Args:
+        cache_folder: Where cache files are stored.
+    Returns:
+        name_index: Dict of ticker strings to dicts of 'name', and 'verified'
+            (timestamp of the last search call).
+    """
+    filename = cache_folder + '/' + NAME_INDEX_FILE
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def _writeNameIndex(name_index, cache_folder):
+    """Write the persistent index of ticker names, replacing the old one.
+
+    Args:
+        name_index: See _readNameIndex.
+        cache_folder: Where cache files are stored.
+    """
+    filename = cache_folder + '/' + NAME_INDEX_FILE
+    with name_index_lock:
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(name_index, f, indent=0, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+
+
+def _isNameCurrent(entry):
+    """Whether a name index entry was verified recently enough to use."""
+    return bool(entry) and (
+        time.time() - entry['verified'] < NAME_TTL_DAYS * 24 * 60 * 60)
+
+
+def _getName(ticker, api_key, name_index, cached_name=None):
+    """Get a ticker's name, only calling the search API when it is outdated.
+
+    Args:
+        ticker: Ticker string.
+        api_key: String API key for authentication.
+        name_index: See _readNameIndex. Updated in place.
+        cached_name: Optional name from previously cached data, used to seed
+            name_index for tickers cached before it existed.
+    Returns:
+        name: String name of this ticker.
+    """
+    with name_index_lock:
+        if ticker not in name_index and cached_name:
+            name_index[ticker] = {'name': cached_name, 'verified': time.time()}
+        entry = name_index.get(ticker)
+
+    if _isNameCurrent(entry):
+        return entry['name']
+
+    name = _callSearchApi(ticker, api_key)
+    with name_index_lock:
+        name_index[ticker] = {'name': name, 'verified': time.time()}
+    return name
+
+
+def _callDailyAdjustedApi(ticker, api_key, outputsize='full'):
     """Call the AlphaVantage Daily Adjusted API for a list of tickers.
 
     Args:
         ticker: Ticker string.
         api_key: String API key for authentication.
+        outputsize: "full" for all history, or "compact" for ~100 days.
     Returns:
         price_data: Dict of integer dates (days since epoch), to prices
             (floats).
     """
-    base_request = 'https://www.alphavantage.co/query?function=TIME_SERIES_DAILY_ADJUSTED&symbol=%s&outputsize=full&apikey=%s'
+    base_request = '%s?function=TIME_SERIES_DAILY_ADJUSTED&symbol=%s&outputsize=%s&apikey=%s'
     epoch = datetime.datetime.utcfromtimestamp(0)
 
-    request = base_request % (ticker, api_key)
+    request = base_request % (API_URL, ticker, outputsize, api_key)
     result = _callApi(request, 'Time Series (Daily)')
 
     price_data = {}
@@ -123,12 +324,45 @@ def _callDailyAdjustedApi(ticker, api_key):
     return price_data
 
 
-def _getAllApiData(ticker, api_key):
+def _mergePriceData(cached_price_data, new_price_data):
+    """Merge recent prices into cached prices, if they agree.
+
+    Adjusted closes are rewritten for all history after a split or dividend,
+    so any disagreement on overlapping dates means the cache is stale.
+
+    Args:
+        cached_price_data: Dict of integer dates to prices.
+        new_price_data: Dict of integer dates to prices, for recent dates.
+    Returns:
+        price_data: Merged dict of integer dates to prices, or None if the
+            data doesn't overlap, or overlaps inconsistently.
+    """
+    overlap = set(cached_price_data).intersection(new_price_data)
+    if not overlap:
+        return None
+
+    for date in overlap:
+        if not math.isclose(
+                cached_price_data[date], new_price_data[date],
+                rel_tol=1e-6, abs_tol=1e-4):
+            return None
+
+    price_data = dict(cached_price_data)
+    price_data.update(new_price_data)
+    return price_data
+
+
+def _getAllApiData(ticker, api_key, cached_data=None, name_index=None):
     """Get data from AlphaVantage APIs.
 
     Args:
         ticker: Ticker string.
         api_key: String API key for authentication.
+        cached_data: Optional previously cached data for this ticker, in the
+            inner format below. If given, only recent prices are fetched and
+            merged in, unless they disagree with the cache.
+        name_index: Optional persistent name index, see _readNameIndex, to
+            avoid searching for the name.
     Returns:
         ticker_data: Nested dict of data about this ticker.
             {
@@ -140,8 +374,21 @@ def _getAllApiData(ticker, api_key):
                 }
             }
     """
-    name = _callSearchApi(ticker, api_key)
-    price_data = _callDailyAdjustedApi(ticker, api_key)
+    if name_index is None:
+        name = _callSearchApi(ticker, api_key)
+    else:
+        name = _getName(
+            ticker, api_key, name_index, cached_data and cached_data['name'])
+
+    price_data = None
+    if cached_data:
+        price_data = _mergePriceData(
+            cached_data['price_data'],
+            _callDailyAdjustedApi(ticker, api_key, 'compact'))
+        if price_data is None:
+            print('Cache for %s is inconsistent, refetching all data' % ticker)
+    if price_data is None:
+        price_data = _callDailyAdjustedApi(ticker, api_key)
 
     ticker_data = {
         ticker: {
@@ -151,27 +398,211 @@ def _getAllApiData(ticker, api_key):
     return ticker_data
 
 
-def _getAndCacheApiData(tickers, api_key, cache_folder):
+def _readManifest(cache_folder):
+    """Read the manifest of cache files.
+
+    Args:
+        cache_folder: Where cache files are stored.
+    Returns:
+        manifest: Dict of ticker strings to dicts of 'last_date' (integer date
+            of the latest price), 'fetched' (timestamp of the last API call),
+            'rows' (number of prices), 'checksum' (CRC32 of the file),
+            'codec' (see cache_codec), and optionally 'empty_refreshes'
+            (number of refreshes in a row that failed or found no new
+            prices, see _scheduleRefresh).
+    """
+    filename = cache_folder + '/' + MANIFEST_FILE
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def _writeManifest(manifest, cache_folder):
+    """Write the manifest of cache files, replacing the old one.
+
+    Args:
+        manifest: See _readManifest.
+        cache_folder: Where cache files are stored.
+    """
+    filename = cache_folder + '/' + MANIFEST_FILE
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def _getManifestEntry(series, checksum, fetched, codec):
+    """Get a cache file's manifest entry.
+
+    Args:
+        series: The file's ticker_series.TickerSeries.
+        checksum: CRC32 of the file.
+        fetched: Timestamp of when the data was fetched.
+        codec: Name of the file's codec.
+    Returns:
+        entry: See _readManifest.
+    """
+    return {
+        'last_date': int(series.date_array[-1]) if len(series) else None,
+        'fetched': fetched,
+        'rows': len(series),
+        'checksum': checksum,
+        'codec': codec}
+
+
+def _getChecksums(manifest, tickers):
+    """Get the checksums of tickers' cache files, for price_store.updateStore.
+
+    Args:
+        manifest: See _readManifest.
+        tickers: Iterable of ticker strings.
+    Returns:
+        checksums: Dict of tickers to checksums, for tickers in manifest.
+    """
+    return {
+        ticker: manifest[ticker]['checksum']
+        for ticker in tickers if ticker in manifest}
+
+
+def _isStoreCurrent(series, checksum, entry):
+    """Whether a ticker's store column matches its cache file's manifest entry.
+
+    Args:
+        series: The ticker's ticker_series.TickerSeries, from the store.
+        checksum: CRC32 of the cache file the column was built from, or None.
+        entry: The ticker's manifest entry, see _readManifest, or None.
+    Returns:
+        current: Whether the column can be used instead of the file.
+    """
+    last_date = int(series.date_array[-1]) if len(series) else None
+    return bool(entry) and (
+        checksum == entry['checksum']
+        and len(series) == entry['rows']
+        and last_date == entry['last_date'])
+
+
+def _findCacheFile(ticker, cache_folder, manifest):
+    """Find a ticker's cache file, of the codec in its manifest entry if any.
+
+    Args:
+        ticker: Ticker string.
+        cache_folder: Where cache files are stored.
+        manifest: See _readManifest.
+    Returns:
+        filename: String name of the file, or None if there is none.
+    """
+    entry = manifest.get(ticker)
+    if entry:
+        return cache_codec.getFilename(cache_folder, ticker, entry['codec'])
+    return cache_codec.findFile(cache_folder, ticker)
+
+
+def _writeCacheFile(data, ticker, cache_folder, codec=None):
+    """Write a single ticker's data to its cache file.
+
+    Any file for the ticker with another codec is removed.
+
+    Args:
+        data: See _getAllApiData for format.
+        ticker: Ticker string.
+        cache_folder: Where to store cache files.
+        codec: Name of the codec to write, or None for the cache folder's,
+            see _getWriteCodec.
+    Returns:
+        entry: The file's manifest entry, see _readManifest.
+    """
+    codec = codec or _getWriteCodec(_readSettings(cache_folder))
+    file_bytes = cache_codec.encode(data, codec)
+    filename = cache_codec.getFilename(cache_folder, ticker, codec)
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(file_bytes)
+    os.replace(filename + '.tmp', filename)
+    for other_codec in cache_codec.EXTENSIONS:
+        if other_codec != codec:
+            try:
+                os.remove(cache_codec.getFilename(cache_folder, ticker, other_codec))
+            except FileNotFoundError:
+                pass
+
+    series = ticker_series.TickerSeries.fromPriceData(
+        data[ticker]['name'], data[ticker]['price_data'])
+    return _getManifestEntry(series, zlib.crc32(file_bytes), time.time(), codec)
+
+
+def _getAndCacheApiData(tickers, api_key, cache_folder, num_threads=4, cached_data=None):
     """Get API data for all tickers, cache it, and return it.
 
+    Tickers are fetched concurrently, sharing rate_limiter, and each is
+    cached, and added to the manifest, as soon as it completes. Refreshes
+    that fail, or find no new prices, are counted in the manifest. After
+    the first failure no more fetches are started, but those already
+    running are still cached before the error is raised.
+
     Args:
         tickers: Iterable of ticker strings.
         api_key: String API key for authentication.
         cache_folder: Where to store cache files.
+        num_threads: How many tickers to fetch at once.
+        cached_data: Optional previously cached data, to refresh
+            incrementally. See _getAllApiData for format.
     Returns:
         ticker_data: See _getAllApiData for format.
     """
+    tickers = list(tickers)
+    cached_data = cached_data or {}
     ticker_data = {}
-    for t, ticker in enumerate(tickers):
-        print('Getting ticker %s (%d/%d)' % (ticker, t + 1, len(tickers)))
-        data = _getAllApiData(ticker, api_key)
-        data_json = json.dumps(data)
-        filename = cache_folder + '/' + ticker + '.json.bz2'
-        with bz2.BZ2File(filename, 'wb') as f:
-            f.write(data_json.encode())
-        ticker_data.update(data)
-        sys.stdout.flush()
+    if not tickers:
+        return ticker_data
 
+    # Created up front, so writes in the finally block can't mask an error.
+    os.makedirs(cache_folder, exist_ok=True)
+    name_index = _readNameIndex(cache_folder)
+    manifest = _readManifest(cache_folder)
+    settings = _readSettings(cache_folder)
+    executor = futures.ThreadPoolExecutor(num_threads)
+    error = None
+    try:
+        future_to_ticker = {
+            executor.submit(
+                _getAllApiData, ticker, api_key, cached_data.get(ticker),
+                name_index): ticker
+            for ticker in tickers}
+        for future in futures.as_completed(future_to_ticker):
+            if future.cancelled():
+                continue
+            ticker = future_to_ticker[future]
+            old_entry = manifest.get(ticker)
+            try:
+                data = future.result()
+            except Exception as e:
+                if old_entry:
+                    old_entry['empty_refreshes'] = old_entry.get('empty_refreshes', 0) + 1
+                    _writeManifest(manifest, cache_folder)
+                if error is None:
+                    error = e
+                    # Drop queued fetches, but keep draining running ones.
+                    executor.shutdown(wait=False, cancel_futures=True)
+                continue
+            entry = _writeCacheFile(
+                data, ticker, cache_folder, _getWriteCodec(settings, old_entry))
+            if old_entry and entry['last_date'] == old_entry['last_date']:
+                entry['empty_refreshes'] = old_entry.get('empty_refreshes', 0) + 1
+            manifest[ticker] = entry
+            _writeManifest(manifest, cache_folder)
+            ticker_data.update(data)
+            print('Got ticker %s (%d/%d)' % (
+                ticker, len(ticker_data), len(tickers)))
+            sys.stdout.flush()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        _writeNameIndex(name_index, cache_folder)
+        # Keep the store in step with whatever files were written.
+        price_store.updateStore(
+            _getStoreFolder(cache_folder), ticker_data,
+            _getChecksums(manifest, ticker_data))
+
+    if error is not None:
+        raise error
     return ticker_data
 
 
@@ -183,25 +614,118 @@ def _readCacheFile(filename):
     Returns:
         ticker_data: See _getAllApiData for format.
     """
-    with bz2.BZ2File(filename, 'rb') as f:
-        byte_data = f.read()
-    decoded_data = byte_data.decode()
-    ticker_data = json.loads(decoded_data)
-
-    # JSON cannot have non-string keys, so convert dates back to int.
-    for ticker in ticker_data:
-        date_strings = set(ticker_data[ticker]['price_data'].keys())
-        
-        price_data = ticker_data[ticker]['price_data']
-        for date_string in date_strings:
-            price_data[int(date_string)] = price_data[date_string]
-            del price_data[date_string]
+    with open(filename, 'rb') as f:
+        (universe, num_bytes) = cache_codec.decode(
+            f.read(), cache_codec.getCodec(filename))
+    instrumentation.count('data_gatherer.read_cache.files')
+    instrumentation.count('data_gatherer.read_cache.bytes_decompressed', num_bytes)
 
-    return ticker_data
+    return universe.toTickerData()
+
+
+def _readCacheFileSeries(filename):
+    """Read a single cached file as arrays, e.g. in a worker process.
+
+    Args:
+        filename: String name of a file to read.
+    Returns:
+        universe: A ticker_series.Universe of the file's tickers.
+        checksum: CRC32 of the file.
+        num_bytes: Decompressed size of the file.
+        seconds: How long reading took.
+    """
+    start = time.perf_counter()
+    with open(filename, 'rb') as f:
+        file_bytes = f.read()
+    (universe, num_bytes) = cache_codec.decode(
+        file_bytes, cache_codec.getCodec(filename))
+
+    return (
+        universe, zlib.crc32(file_bytes), num_bytes,
+        time.perf_counter() - start)
+
+
+def _checkManifest(manifest, file_universe, checksum, filename):
+    """Check a file just read against its manifest entry.
+
+    Files without an entry, e.g. cached before the manifest existed, are
+    added to it. Files that don't match their entry are marked as never
+    fetched, so they are the first to be refreshed.
+
+    Args:
+        manifest: See _readManifest. Updated in place.
+        file_universe: A ticker_series.Universe of the file's tickers.
+        checksum: CRC32 of the file.
+        filename: String name of the file.
+    """
+    for ticker, series in file_universe.items():
+        entry = manifest.get(ticker)
+        if entry is None:
+            fetched = os.path.getmtime(filename)
+        elif entry['checksum'] != checksum or entry['rows'] != len(series):
+            print('Cache file %s does not match the manifest' % filename)
+            fetched = 0
+        else:
+            continue
+        manifest[ticker] = _getManifestEntry(
+            series, checksum, fetched, cache_codec.getCodec(filename))
+
+
+def _readCacheFileList(filenames, num_processes=None, manifest=None):
+    """Read cached files, decompressing and parsing them in worker processes.
+
+    Workers return only each file's arrays, so little is copied back. The
+    slowest files are printed, to spot any that are pathological.
+
+    Args:
+        filenames: List of file names to read.
+        num_processes: How many processes to use, or None for one per CPU.
+            With 1, files are read in this process.
+        manifest: Optional manifest to check files against, see
+            _checkManifest. Updated in place.
+    Returns:
+        universe: A ticker_series.Universe of every file's tickers.
+    """
+    universe = ticker_series.Universe()
+    if not filenames:
+        return universe
+
+    num_processes = min(num_processes or os.cpu_count(), len(filenames))
+    executor = None
+    if num_processes > 1:
+        executor = futures.ProcessPoolExecutor(num_processes)
+        results = executor.map(
+            _readCacheFileSeries, filenames,
+            chunksize=max(1, len(filenames) // (num_processes * 4)))
+    else:
+        results = map(_readCacheFileSeries, filenames)
+
+    timings = []
+    try:
+        for index, (file_universe, checksum, num_bytes, seconds) in enumerate(results):
+            if manifest is not None:
+                _checkManifest(manifest, file_universe, checksum, filenames[index])
+            universe.update(file_universe)
+            timings.append((seconds, num_bytes, filenames[index]))
+            instrumentation.count('data_gatherer.read_cache.files')
+            instrumentation.count('data_gatherer.read_cache.bytes_decompressed', num_bytes)
+            if (index + 1) % READ_PROGRESS_FILES == 0:
+                print('Read %d/%d files' % (index + 1, len(filenames)))
+                sys.stdout.flush()
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    print('Read %d files with %d processes, slowest:' % (
+        len(filenames), num_processes))
+    for seconds, num_bytes, filename in sorted(timings, reverse=True)[:NUM_SLOW_FILES]:
+        print('    %.3fs %s (%d bytes)' % (seconds, filename, num_bytes))
+
+    return universe
 
 
 def _getCachedFiles(tickers, cache_folder, max_age):
-    """Get a sorted list of cache files newer than max_age.
+    """Get a sorted list of cache files fetched within max_age.
 
     Args:
         tickers: Iterable of ticker strings.
@@ -210,18 +734,23 @@ def _getCachedFiles(tickers, cache_folder, max_age):
     Returns:
         cached_ticker_list: List of ticker strings with a valid cache.
     """
+    manifest = _readManifest(cache_folder)
+    now = time.time()
     unsorted_list = []
     for ticker in tickers:
-        filename = cache_folder + '/' + ticker + '.json.bz2'
+        if ticker in manifest:
+            fetched = manifest[ticker]['fetched']
+        else:
+            # Files cached before the manifest existed.
+            filename = cache_codec.findFile(cache_folder, ticker)
+            if filename is None:
+                continue
+            fetched = os.path.getmtime(filename)
 
-        if not os.path.isfile(filename):
-            continue
-
-        days_since_modified = (
-            time.time() - os.path.getmtime(filename)) / (24 * 60 * 60)
+        days_since_fetched = (now - fetched) / (24 * 60 * 60)
 
-        if max_age == None or days_since_modified < max_age:
-            unsorted_list.append((days_since_modified, ticker))
+        if max_age == None or days_since_fetched < max_age:
+            unsorted_list.append((days_since_fetched, ticker))
 
     sorted_list = sorted(unsorted_list, reverse=True)
 
@@ -232,35 +761,158 @@ def _getCachedFiles(tickers, cache_folder, max_age):
     return cached_ticker_list
 
 
-def _readCacheFiles(tickers, cache_folder):
+def _getStaleness(last_date, today):
+    """Count trading days whose prices are missing, not counting today.
+
+    Weekends are skipped, but holidays are counted as trading days.
+
+    Args:
+        last_date: Integer date of the latest cached price.
+        today: Integer date, as days since epoch.
+    Returns:
+        staleness: Number of trading days after last_date, and before today.
+    """
+    return max(0, int(np.busday_count(
+        np.datetime64(last_date + 1, 'D'), np.datetime64(today, 'D'))))
+
+
+def _scheduleRefresh(tickers, cache_folder, api_call_budget=None, held_tickers=(), today=None):
+    """Choose which tickers to refresh, most valuable first, within a budget.
+
+    Tickers are popped from a heap by priority: uncached tickers first, then
+    by staleness, weighted by HELD_STALENESS_WEIGHT for held tickers, and
+    divided by EMPTY_REFRESH_BACKOFF for each refresh in a row that found
+    nothing new, so e.g. delisted tickers don't take the budget every run.
+    Tickers with no missing trading days are not refreshed. Each refresh
+    costs one API call for prices, plus one if the name must be searched for.
+    An incremental refresh that disagrees with the cache costs one more, so
+    the budget is an estimate.
+
+    Args:
+        tickers: Iterable of ticker strings.
+        cache_folder: Where cache files are stored.
+        api_call_budget: Max number of API calls to make, or None for enough
+            to fetch every uncached ticker, and refresh 1/25 of the tickers,
+            as for a daily run.
+        held_tickers: Iterable of tickers currently held, e.g.
+            config.CURRENT_ALLOCATION_DICT.
+        today: Integer date to measure staleness to, or None for today.
+    Returns:
+        refresh_tickers: Set of ticker strings to refresh.
+    """
+    tickers = list(tickers)
+    manifest = _readManifest(cache_folder)
+    name_index = _readNameIndex(cache_folder)
+    held_tickers = set(held_tickers)
+    if today is None:
+        today = int(time.time() // (24 * 60 * 60))
+
+    heap = []
+    uncached_calls = 0
+    for ticker in tickers:
+        if ticker in manifest:
+            last_date = manifest[ticker]['last_date']
+        else:
+            # Files cached before the manifest existed.
+            filename = cache_codec.findFile(cache_folder, ticker)
+            last_date = None
+            if filename:
+                last_date = int(os.path.getmtime(filename) // (24 * 60 * 60))
+
+        name_entry = name_index.get(ticker)
+        if last_date is None:
+            calls = 1 if _isNameCurrent(name_entry) else 2
+            uncached_calls += calls
+            priority = math.inf
+        else:
+            # Cached names seed the name index, see _getName.
+            calls = 2 if name_entry and not _isNameCurrent(name_entry) else 1
+            priority = _getStaleness(last_date, today)
+            if ticker in held_tickers:
+                priority *= HELD_STALENESS_WEIGHT
+            if not priority:
+                continue
+            priority /= EMPTY_REFRESH_BACKOFF ** manifest.get(ticker, {}).get('empty_refreshes', 0)
+        heapq.heappush(heap, (-priority, ticker, calls))
+
+    if api_call_budget is None:
+        api_call_budget = uncached_calls + math.ceil(len(tickers) / 25)
+
+    num_stale = len(heap)
+    refresh_tickers = set()
+    remaining_calls = api_call_budget
+    while heap and remaining_calls > 0:
+        (_, ticker, calls) = heapq.heappop(heap)
+        if calls <= remaining_calls:
+            refresh_tickers.add(ticker)
+            remaining_calls -= calls
+
+    print('Refreshing %d of %d stale tickers, with %d of %d API calls.' % (
+        len(refresh_tickers), num_stale, api_call_budget - remaining_calls,
+        api_call_budget))
+    return refresh_tickers
+
+
+@instrumentation.timed('data_gatherer.read_cache')
+def _readCacheFiles(tickers, cache_folder, num_processes=None):
     """Read all cached files.
 
     Args:
         tickers: Iterable of ticker strings.
         cache_folder: Where to store cache files.
+        num_processes: How many processes to read files not yet in the store
+            with, see _readCacheFileList.
     Returns:
-        ticker_data: See _getAllApiData for format.
+        universe: A ticker_series.Universe.
     """
-    ticker_data = {}
-    print('Reading %d files from cache.' % len(tickers))
     start = time.time()
-    for ticker in tickers:
-        ticker_data.update(
-            _readCacheFile(cache_folder + '/' + ticker + '.json.bz2'))
+    manifest = _readManifest(cache_folder)
+    old_manifest = dict(manifest)
+    store_folder = _getStoreFolder(cache_folder)
+    store = price_store.readStore(store_folder)
+    stored_tickers = set(store[0]) if store else set()
+    universe = ticker_series.Universe()
+    if store:
+        universe = price_store.toUniverse(
+            store, [ticker for ticker in tickers if ticker in stored_tickers])
+    del store
+
+    # Columns can be stale, e.g. if a refresh wrote a file but crashed before
+    # updating the store, so only use those matching their manifest entry.
+    checksums = price_store.readChecksums(store_folder) if universe else {}
+    for ticker in list(universe):
+        if not _isStoreCurrent(universe[ticker], checksums.get(ticker), manifest.get(ticker)):
+            del universe[ticker]
+    instrumentation.count('data_gatherer.read_cache.store_tickers', len(universe))
+
+    # Migrate any tickers missing from the store, or stale in it.
+    unstored_tickers = [ticker for ticker in tickers if ticker not in universe]
+    print('Reading %d tickers from store, %d files from cache.' % (
+        len(universe), len(unstored_tickers)))
+    file_data = _readCacheFileList(
+        [_findCacheFile(ticker, cache_folder, manifest) for ticker in unstored_tickers],
+        num_processes,
+        manifest)
+    if manifest != old_manifest:
+        _writeManifest(manifest, cache_folder)
+    price_store.updateStore(
+        store_folder, file_data, _getChecksums(manifest, file_data))
+    universe.update(file_data)
     print('Read cached files in %.2fs' % (time.time() - start))
 
-    return ticker_data
+    return universe
 
 
-def _validateData(ticker_data):
-    for ticker, data in ticker_data.items():
-        for date, value in data['price_data'].items():
-            if value < 1:
-                print('Bad data: %s %d %d' % (ticker, date, value))
-                break
+def _validateData(universe):
+    for ticker, series in universe.items():
+        bad = np.flatnonzero(series.price_array < 1)
+        if len(bad):
+            print('Bad data: %s %d %d' % (
+                ticker, series.date_array[bad[0]], series.price_array[bad[0]]))
 
 
-def getTickerData(tickers, api_key, cache_folder, refresh_strategy):
+@instrumentation.timed('data_gatherer.get')
+def getTickerData(tickers, api_key, cache_folder, refresh_strategy, num_threads=4, requests_per_minute=None, incremental=True, num_processes=None, api_call_budget=None, held_tickers=()):
     """Get data from APIs or caches for ticker data.
 
     Args:
@@ -269,36 +921,58 @@ def getTickerData(tickers, api_key, cache_folder, refresh_strategy):
         cache_folder: Where to store cache files.
         refresh_strategy: Whether to updated "outdated", "all", or "none" of
             the tickers.
+        num_threads: How many tickers to fetch from the API at once.
+        requests_per_minute: API rate limit, or None to keep the current one.
+        incremental: Whether to refresh cached tickers by fetching only recent
+            prices, rather than their full history.
+        num_processes: How many processes to read cache files with, or None
+            for one per CPU.
+        api_call_budget: Max number of API calls for an "outdated" refresh,
+            see _scheduleRefresh.
+        held_tickers: Iterable of tickers currently held, which "outdated"
+            refreshes first.
     Returns:
-        ticker_data: See _getAllApiData for format.
+        universe: A ticker_series.Universe. It can also be read as the dict
+            format of _getAllApiData.
     """
+    if requests_per_minute:
+        setRequestsPerMinute(requests_per_minute)
+
     ticker_data = None
     cached_files = []
     if refresh_strategy == 'all':
         cached_files = _getCachedFiles(tickers, cache_folder, None)
         uncached_files = set(tickers) - set(cached_files)
-        ticker_data = _getAndCacheApiData(uncached_files, api_key, cache_folder)
-        ticker_data.update(_getAndCacheApiData(cached_files, api_key, cache_folder))
-        return ticker_data
+        instrumentation.count('data_gatherer.get.refreshed', len(tickers))
+        cached_data = None
+        if incremental and cached_files:
+            cached_data = _readCacheFiles(cached_files, cache_folder, num_processes)
+        ticker_data = _getAndCacheApiData(uncached_files, api_key, cache_folder, num_threads)
+        ticker_data.update(_getAndCacheApiData(
+            cached_files, api_key, cache_folder, num_threads, cached_data))
+        return ticker_series.Universe.fromTickerData(ticker_data)
     elif refresh_strategy == 'none':
         cached_files = _getCachedFiles(tickers, cache_folder, None)
+        uncached_files = set(tickers) - set(cached_files)
     else:
-        cached_files = _getCachedFiles(tickers, cache_folder, 30)
+        uncached_files = _scheduleRefresh(
+            tickers, cache_folder, api_call_budget, held_tickers)
+        cached_files = _getCachedFiles(
+            set(tickers) - uncached_files, cache_folder, None)
 
-        # Assume we will run daily.
-        # Ensure at least 1/25 of tickers are refreshed with each call.
-        min_refresh = math.ceil(len(tickers) / 25)
-        min_refresh -= (len(tickers) - len(cached_files))
-        min_refresh = max(min_refresh, 0)
-        for _ in range(min_refresh):
-            if cached_files:
-                cached_files.pop()
+    instrumentation.count('data_gatherer.get.cache_hits', len(cached_files))
+    instrumentation.count('data_gatherer.get.refreshed', len(uncached_files))
 
-    uncached_files = set(tickers) - set(cached_files)
+    cached_data = None
+    if incremental and uncached_files:
+        cached_data = _readCacheFiles(
+            _getCachedFiles(uncached_files, cache_folder, None), cache_folder,
+            num_processes)
 
-    ticker_data = _getAndCacheApiData(uncached_files, api_key, cache_folder)
-    ticker_data.update(_readCacheFiles(cached_files, cache_folder))
+    universe = ticker_series.Universe.fromTickerData(_getAndCacheApiData(
+        uncached_files, api_key, cache_folder, num_threads, cached_data))
+    universe.update(_readCacheFiles(cached_files, cache_folder, num_processes))
 
-    _validateData(ticker_data)
+    _validateData(universe)
 
-    return ticker_data
+    return universe
@@ -0,0 +1,291 @@
+"""Store price data for all tickers as a single memory mappable matrix.
+
+Layout of a store folder:
+    prices.npy: Rows = dates, columns = tickers, values = prices, with NaN
+        where a ticker has no data for a date.
+    dates.npy: Sorted int32 dates (days since epoch), one per row.
+    tickers.json: Tickers (sorted alphabetically), names, and the CRC32 of
+        the cache file each column was built from, one per column.
+
+Reading the store maps prices.npy into memory rather than parsing it, so
+loading the whole universe costs roughly nothing until prices are used.
+"""
+
+import argparse
+from data_gatherer import cache_codec
+from data_gatherer import ticker_series
+import json
+import numpy as np
+import os
+import time
+
+
+PRICE_FILE = 'prices.npy'
+DATE_FILE = 'dates.npy'
+TICKER_FILE = 'tickers.json'
+
+
+def _writeAtomically(filename, write_function):
+    """Write a file via a temporary file, so readers never see partial data.
+
+    Args:
+        filename: String name of the file to write.
+        write_function: Function accepting an open binary file to write to.
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        write_function(f)
+    os.replace(temp_filename, filename)
+
+
+def _writeIndex(store_folder, ticker_tuple, name_tuple, checksum_tuple):
+    """Write the tickers file, see writeStore."""
+    index = {
+        'tickers': list(ticker_tuple),
+        'names': list(name_tuple),
+        'checksums': list(checksum_tuple)}
+    _writeAtomically(
+        store_folder + '/' + TICKER_FILE,
+        lambda f: f.write(json.dumps(index).encode()))
+
+
+def _readIndex(store_folder):
+    """Read the tickers file, see writeStore."""
+    with open(store_folder + '/' + TICKER_FILE, 'rb') as f:
+        index = json.loads(f.read().decode())
+    # Stores written before checksums were recorded have none.
+    index.setdefault('checksums', [None] * len(index['tickers']))
+    return index
+
+
+def writeStore(store_folder, ticker_tuple, name_tuple, date_array, price_matrix, checksum_tuple=None):
+    """Write a full store, replacing any existing one.
+
+    Prices are written before the tickers file, so an interrupted write
+    never pairs new checksums with old prices.
+
+    Args:
+        store_folder: Where to write the store files.
+        ticker_tuple: Tuple of tickers, sorted alphabetically.
+        name_tuple: Tuple of ticker names, in the same order.
+        date_array: Sorted array of integer dates.
+        price_matrix: Rows = dates, columns = tickers, values = prices.
+        checksum_tuple: Optional tuple of the CRC32 of each ticker's cache
+            file, in the same order, None where unknown.
+    """
+    os.makedirs(store_folder, exist_ok=True)
+    _writeAtomically(
+        store_folder + '/' + PRICE_FILE,
+        lambda f: np.save(f, np.asarray(price_matrix, dtype=np.float64)))
+    _writeAtomically(
+        store_folder + '/' + DATE_FILE,
+        lambda f: np.save(f, np.asarray(date_array, dtype=np.int32)))
+    _writeIndex(
+        store_folder, ticker_tuple, name_tuple,
+        checksum_tuple or (None,) * len(ticker_tuple))
+
+
+def readStore(store_folder, mode='r'):
+    """Memory map a store.
+
+    Args:
+        store_folder: Where to read the store files.
+        mode: Memory map mode for prices, 'r' or 'r+'.
+    Returns:
+        store: Tuple of (ticker_tuple, name_tuple, date_array, price_matrix),
+            or None if there is no complete store.
+    """
+    try:
+        index = _readIndex(store_folder)
+        date_array = np.load(store_folder + '/' + DATE_FILE)
+        price_matrix = np.load(store_folder + '/' + PRICE_FILE, mmap_mode=mode)
+    except FileNotFoundError:
+        return None
+
+    ticker_tuple = tuple(index['tickers'])
+    name_tuple = tuple(index['names'])
+
+    # Files are replaced one at a time, so an interrupted write can leave
+    # them out of step.
+    if price_matrix.shape != (len(date_array), len(ticker_tuple)):
+        print('Ignoring inconsistent price store %s' % store_folder)
+        return None
+
+    return (ticker_tuple, name_tuple, date_array, price_matrix)
+
+
+def readChecksums(store_folder):
+    """Read the CRC32 of the cache file each ticker in a store was built from.
+
+    Args:
+        store_folder: Where to read the store files.
+    Returns:
+        checksums: Dict of tickers to checksums, None where unknown, or an
+            empty dict if there is no store.
+    """
+    try:
+        index = _readIndex(store_folder)
+    except FileNotFoundError:
+        return {}
+    return dict(zip(index['tickers'], index['checksums']))
+
+
+def updateStore(store_folder, ticker_data, checksums=None):
+    """Replace the data for some tickers in a store, creating it if needed.
+
+    If the tickers and their dates are all already in the store, only the
+    prices file is rewritten. Otherwise the store is rewritten with the union
+    of all dates. Either way files are replaced atomically, so readers with
+    the store mapped keep seeing the old, complete prices.
+
+    Args:
+        store_folder: Where the store files are.
+        ticker_data: A ticker_series.Universe, or see
+            data_gatherer._getAllApiData for format.
+        checksums: Optional dict of tickers to the CRC32 of the cache file
+            their data came from, see readChecksums.
+    """
+    if not ticker_data:
+        return
+    universe = ticker_series.Universe.fromTickerData(ticker_data)
+
+    store = readStore(store_folder)
+    if store is None:
+        store = ((), (), np.zeros(0, dtype=np.int32), np.zeros((0, 0)))
+    (ticker_tuple, name_tuple, date_array, price_matrix) = store
+    new_checksums = readChecksums(store_folder) if len(ticker_tuple) else {}
+    for ticker in universe:
+        new_checksums[ticker] = (checksums or {}).get(ticker)
+
+    new_dates = np.unique(np.concatenate(
+        [series.date_array for series in universe.values()])).astype(np.int32)
+    if set(universe).issubset(ticker_tuple) and np.isin(new_dates, date_array).all():
+        new_price_matrix = np.array(price_matrix)
+        del price_matrix
+        for ticker, series in universe.items():
+            column = ticker_tuple.index(ticker)
+            new_price_matrix[:, column] = np.nan
+            _fillColumn(new_price_matrix, column, date_array, series)
+        _writeAtomically(
+            store_folder + '/' + PRICE_FILE,
+            lambda f: np.save(f, new_price_matrix))
+        _writeIndex(
+            store_folder, ticker_tuple, name_tuple,
+            tuple(new_checksums.get(ticker) for ticker in ticker_tuple))
+        return
+
+    names = dict(zip(ticker_tuple, name_tuple))
+    names.update({ticker: series.name for ticker, series in universe.items()})
+    new_ticker_tuple = tuple(sorted(names))
+    new_date_array = np.union1d(date_array, new_dates).astype(np.int32)
+
+    new_price_matrix = np.full(
+        (len(new_date_array), len(new_ticker_tuple)), np.nan, dtype=np.float64)
+    if len(ticker_tuple):
+        rows = np.searchsorted(new_date_array, date_array)
+        columns = np.searchsorted(new_ticker_tuple, ticker_tuple)
+        new_price_matrix[np.ix_(rows, columns)] = price_matrix
+    for ticker, series in universe.items():
+        column = new_ticker_tuple.index(ticker)
+        new_price_matrix[:, column] = np.nan
+        _fillColumn(new_price_matrix, column, new_date_array, series)
+
+    # Release the old mapping before the file is replaced.
+    del price_matrix
+    writeStore(
+        store_folder,
+        new_ticker_tuple,
+        tuple(names[ticker] for ticker in new_ticker_tuple),
+        new_date_array,
+        new_price_matrix,
+        tuple(new_checksums.get(ticker) for ticker in new_ticker_tuple))
+
+
+def _fillColumn(price_matrix, column, date_array, series):
+    """Write a ticker's prices into one column of a matrix.
+
+    Args:
+        price_matrix: Rows = dates, columns = tickers, values = prices.
+        column: Which column to fill.
+        date_array: Sorted array of integer dates, one per row.
+        series: A ticker_series.TickerSeries, with all dates in date_array.
+    """
+    price_matrix[np.searchsorted(date_array, series.date_array), column] = (
+        series.price_array)
+
+
+def toUniverse(store, tickers):
+    """Get tickers from a store as a ticker_series.Universe.
+
+    Args:
+        store: See readStore.
+        tickers: Iterable of ticker strings, all present in the store.
+    Returns:
+        universe: A ticker_series.Universe, with arrays copied from the store.
+    """
+    (ticker_tuple, name_tuple, date_array, price_matrix) = store
+    tickers = list(tickers)
+    columns = [ticker_tuple.index(ticker) for ticker in tickers]
+
+    # Gather every column in one pass over the rows, rather than one strided
+    # pass per ticker, then make each column contiguous.
+    column_matrix = np.asfortranarray(price_matrix[:, columns])
+    universe = ticker_series.Universe()
+    for ticker, column, prices in zip(tickers, columns, column_matrix.T):
+        valid = ~np.isnan(prices)
+        universe[ticker] = ticker_series.TickerSeries(
+            name_tuple[column], date_array[valid], prices[valid])
+    return universe
+
+
+def migrateCache(cache_folder, store_folder, num_processes=None):
+    """Build a store from every cached file, of any codec.
+
+    Files are also checked against, or added to, the cache manifest.
+
+    Args:
+        cache_folder: Where cache files are.
+        store_folder: Where to write the store files.
+        num_processes: How many processes to read files with, or None for one
+            per CPU.
+    """
+    # Imported here, as data_gatherer imports this module.
+    from data_gatherer import data_gatherer
+
+    start = time.time()
+    filenames = cache_codec.getAllFiles(cache_folder)
+    manifest = data_gatherer._readManifest(cache_folder)
+    ticker_data = data_gatherer._readCacheFileList(filenames, num_processes, manifest)
+    data_gatherer._writeManifest(manifest, cache_folder)
+    if os.path.isdir(store_folder):
+        for filename in (PRICE_FILE, DATE_FILE, TICKER_FILE):
+            if os.path.isfile(store_folder + '/' + filename):
+                os.remove(store_folder + '/' + filename)
+    updateStore(
+        store_folder, ticker_data,
+        data_gatherer._getChecksums(manifest, ticker_data))
+    print('Migrated %d files in %.2fs' % (len(filenames), time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--cache_folder',
+        default='cache',
+        help='Where cache files are.')
+    parser.add_argument(
+        '--store_folder',
+        help='Where to write the store, defaults to <cache_folder>/store.')
+    parser.add_argument(
+        '--num_processes',
+        type=int,
+        help='How many processes to read files with, defaults to one per CPU.')
+    args = parser.parse_args()
+
+    migrateCache(
+        args.cache_folder, args.store_folder or args.cache_folder + '/store',
+        args.num_processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Tests for the cache_codec module."""
+
+from . import cache_codec
+from . import ticker_series
+import os
+import tempfile
+import unittest
+
+
+class TestEncodeDecode(unittest.TestCase):
+
+    def test_roundTrip(self):
+        ticker_data = {
+            'fake1': {'name': 'Fake 1', 'price_data': {2: 2.5, 1: 1.5}},
+            'fake2': {'name': 'Fake 2', 'price_data': {3: 3.0}}}
+        for codec in cache_codec.EXTENSIONS:
+            (actual, num_bytes) = cache_codec.decode(
+                cache_codec.encode(ticker_data, codec), codec)
+
+            self.assertIsInstance(actual, ticker_series.Universe)
+            self.assertGreater(num_bytes, 0)
+            self.assertDictEqual(actual.toTickerData(), ticker_data, codec)
+            self.assertListEqual(list(actual['fake1'].date_array), [1, 2], codec)
+
+    def test_universe(self):
+        universe = ticker_series.Universe({
+            'fake': ticker_series.TickerSeries('Fake', [1, 2], [1.5, 2.5])})
+        for codec in cache_codec.EXTENSIONS:
+            (actual, _) = cache_codec.decode(
+                cache_codec.encode(universe, codec), codec)
+
+            self.assertDictEqual(actual.toTickerData(), universe.toTickerData(), codec)
+
+
+class TestFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_folder = self.temp_dir.name
+        for ticker, codec in (('fake1', 'bz2'), ('fake2', 'binary')):
+            with open(cache_codec.getFilename(self.cache_folder, ticker, codec), 'wb') as f:
+                f.write(cache_codec.encode(
+                    {ticker: {'name': ticker, 'price_data': {1: 1.0}}}, codec))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_getCodec(self):
+        self.assertEqual(cache_codec.getCodec('cache/fake.json.bz2'), 'bz2')
+        self.assertEqual(cache_codec.getCodec('cache/fake.json.xz'), 'lzma')
+        self.assertEqual(cache_codec.getCodec('cache/fake.npz'), 'binary')
+        with self.assertRaises(ValueError):
+            cache_codec.getCodec('cache/fake.csv')
+
+    def test_findFile(self):
+        self.assertEqual(
+            cache_codec.findFile(self.cache_folder, 'fake2'),
+            self.cache_folder + '/fake2.npz')
+        self.assertIsNone(cache_codec.findFile(self.cache_folder, 'fake2', 'zlib'))
+        self.assertIsNone(cache_codec.findFile(self.cache_folder, 'fake3'))
+
+    def test_getAllFiles(self):
+        self.assertListEqual(
+            [os.path.basename(filename) for filename in cache_codec.getAllFiles(self.cache_folder)],
+            ['fake1.json.bz2', 'fake2.npz'])
+
+    def test_benchmarkCodecs(self):
+        actual = cache_codec.benchmarkCodecs(
+            cache_codec.getAllFiles(self.cache_folder), ['zlib', 'binary'])
+
+        self.assertListEqual([result['codec'] for result in actual], ['zlib', 'binary'])
+        for result in actual:
+            self.assertGreater(result['bytes'], 0)
+            self.assertGreaterEqual(result['read_seconds'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,19 @@
 """Tests for the data_gatherer module."""
 
+from . import cache_codec
 from . import data_gatherer
+from . import price_store
 import config
+import http.server
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+import zlib
 
 
 def _validateDataFormat(self, data):
@@ -61,5 +71,476 @@ class TestReadCache(unittest.TestCase):
         _validateDataFormat(self, actual)
 
 
+class _StubApiHandler(http.server.BaseHTTPRequestHandler):
+    """Serve canned AlphaVantage responses, after some 503s."""
+
+    def do_GET(self):
+        server = self.server
+        server.num_requests += 1
+        query = parse_qs(urlparse(self.path).query)
+        ticker = (query.get('keywords') or query.get('symbol'))[0]
+        if server.num_failures > 0 or ticker in server.failing_tickers:
+            server.num_failures = max(server.num_failures - 1, 0)
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        if query['function'][0] == 'SYMBOL_SEARCH':
+            result = {'bestMatches': [
+                {'1. symbol': ticker, '2. name': ticker + ' Inc'}]}
+        else:
+            result = {'Time Series (Daily)': {
+                '1970-01-03': {'5. adjusted close': '2.5'},
+                '1970-01-04': {'5. adjusted close': '3.5'}}}
+            if query['outputsize'][0] == 'full':
+                result['Time Series (Daily)']['1970-01-02'] = {
+                    '5. adjusted close': '1.5'}
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubApiTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _StubApiHandler)
+        self.server.num_requests = 0
+        self.server.num_failures = 0
+        self.server.failing_tickers = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.old_settings = (
+            data_gatherer.API_URL, data_gatherer.BACKOFF_SECONDS,
+            data_gatherer.rate_limiter)
+        data_gatherer.API_URL = 'http://127.0.0.1:%d/query' % self.server.server_port
+        data_gatherer.BACKOFF_SECONDS = 0.001
+        data_gatherer.setRequestsPerMinute(60000, burst=10)
+        data_gatherer.local_cache.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        (data_gatherer.API_URL, data_gatherer.BACKOFF_SECONDS,
+            data_gatherer.rate_limiter) = self.old_settings
+        data_gatherer.local_cache.clear()
+
+
+class TestCallApiStub(_StubApiTestCase):
+
+    def test_retriesOn503(self):
+        self.server.num_failures = 2
+        actual = data_gatherer._callSearchApi('FAKE', 'key')
+        self.assertEqual(actual, 'FAKE Inc')
+        self.assertEqual(self.server.num_requests, 3)
+
+    def test_tooManyAttempts(self):
+        self.server.num_failures = data_gatherer.MAX_ATTEMPTS
+        with self.assertRaises(IOError):
+            data_gatherer._callSearchApi('FAKE', 'key')
+
+
+class TestGetAndCacheApiDataStub(_StubApiTestCase):
+
+    def test_concurrent(self):
+        tickers = ['FAKE%d' % i for i in range(5)]
+        with tempfile.TemporaryDirectory() as cache_folder:
+            actual = data_gatherer._getAndCacheApiData(
+                tickers, 'key', cache_folder, num_threads=3)
+            for ticker in tickers:
+                self.assertTrue(os.path.isfile(cache_folder + '/' + ticker + '.json.bz2'))
+            manifest = data_gatherer._readManifest(cache_folder)
+
+        self.assertSetEqual(set(actual), set(tickers))
+        self.assertDictEqual(
+            actual['FAKE0'],
+            {'name': 'FAKE0 Inc', 'price_data': {1: 1.5, 2: 2.5, 3: 3.5}})
+        self.assertSetEqual(set(manifest), set(tickers))
+        self.assertEqual(manifest['FAKE0']['last_date'], 3)
+
+    def test_incremental(self):
+        cached_data = {'FAKE': {'name': 'FAKE Inc', 'price_data': {0: 0.5, 2: 2.5}}}
+        with tempfile.TemporaryDirectory() as cache_folder:
+            actual = data_gatherer._getAndCacheApiData(
+                ['FAKE'], 'key', cache_folder, cached_data=cached_data)
+
+        self.assertDictEqual(actual['FAKE']['price_data'], {0: 0.5, 2: 2.5, 3: 3.5})
+        self.assertEqual(self.server.num_requests, 1)
+
+    def test_incrementalInconsistent(self):
+        cached_data = {'FAKE': {'name': 'FAKE Inc', 'price_data': {0: 0.5, 2: 2.0}}}
+        with tempfile.TemporaryDirectory() as cache_folder:
+            actual = data_gatherer._getAndCacheApiData(
+                ['FAKE'], 'key', cache_folder, cached_data=cached_data)
+
+        self.assertDictEqual(actual['FAKE']['price_data'], {1: 1.5, 2: 2.5, 3: 3.5})
+        self.assertEqual(self.server.num_requests, 2)
+
+    def test_keepsCodec(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            manifest = {'FAKE': data_gatherer._writeCacheFile(
+                {'FAKE': {'name': 'FAKE Inc', 'price_data': {1: 1.5}}},
+                'FAKE', cache_folder, 'binary')}
+            data_gatherer._writeManifest(manifest, cache_folder)
+            data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+
+            self.assertTrue(os.path.isfile(cache_folder + '/FAKE.npz'))
+            self.assertFalse(os.path.isfile(cache_folder + '/FAKE.json.bz2'))
+            self.assertEqual(data_gatherer._readManifest(cache_folder)['FAKE']['codec'], 'binary')
+
+    def test_savedCodec(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+            data_gatherer.setCacheCodec(cache_folder, 'zlib')
+            data_gatherer.local_cache.clear()
+            data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+
+            self.assertListEqual(
+                [os.path.basename(filename)
+                    for filename in cache_codec.getAllFiles(cache_folder)],
+                ['FAKE.json.zz'])
+
+    def test_newCacheFolder(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_folder = temp_dir + '/cache'
+            data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+
+            self.assertTrue(os.path.isfile(cache_folder + '/FAKE.json.bz2'))
+            self.assertIn('FAKE', data_gatherer._readNameIndex(cache_folder))
+
+    def test_errorNotMasked(self):
+        self.server.num_failures = 1000
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.assertRaisesRegex(IOError, 'Too many attempts'):
+                data_gatherer._getAndCacheApiData(['FAKE'], 'key', temp_dir + '/cache')
+
+    def test_errorKeepsRunningFetches(self):
+        self.server.failing_tickers = {'BAD'}
+        with tempfile.TemporaryDirectory() as cache_folder:
+            with self.assertRaisesRegex(IOError, 'Too many attempts'):
+                data_gatherer._getAndCacheApiData(
+                    ['BAD', 'FAKE'], 'key', cache_folder, num_threads=2)
+
+            self.assertTrue(os.path.isfile(cache_folder + '/FAKE.json.bz2'))
+            self.assertEqual(list(data_gatherer._readManifest(cache_folder)), ['FAKE'])
+
+
+class TestNameIndexStub(_StubApiTestCase):
+
+    def test_skipsSearch(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+            data_gatherer.local_cache.clear()
+            actual = data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+            name_index = data_gatherer._readNameIndex(cache_folder)
+
+        self.assertEqual(actual['FAKE']['name'], 'FAKE Inc')
+        self.assertEqual(name_index['FAKE']['name'], 'FAKE Inc')
+        self.assertEqual(self.server.num_requests, 3)
+
+    def test_outdated(self):
+        name_index = {'FAKE': {'name': 'Old Name', 'verified': 0}}
+        actual = data_gatherer._getName('FAKE', 'key', name_index)
+
+        self.assertEqual(actual, 'FAKE Inc')
+        self.assertGreater(name_index['FAKE']['verified'], 0)
+        self.assertEqual(self.server.num_requests, 1)
+
+    def test_seededFromCache(self):
+        name_index = {}
+        actual = data_gatherer._getName('FAKE', 'key', name_index, 'Cached Name')
+
+        self.assertEqual(actual, 'Cached Name')
+        self.assertEqual(self.server.num_requests, 0)
+
+
+class TestGetTickerDataStub(_StubApiTestCase):
+
+    def test_outdatedBudget(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            data_gatherer._getAndCacheApiData(['FAKE0', 'FAKE1'], 'key', cache_folder)
+            num_requests = self.server.num_requests
+            data_gatherer.local_cache.clear()
+            actual = data_gatherer.getTickerData(
+                ['FAKE0', 'FAKE1'], 'key', cache_folder, 'outdated',
+                num_processes=1, api_call_budget=1, held_tickers=['FAKE1'])
+            manifest = data_gatherer._readManifest(cache_folder)
+
+        self.assertSetEqual(set(actual), {'FAKE0', 'FAKE1'})
+        self.assertEqual(self.server.num_requests, num_requests + 1)
+        self.assertGreater(manifest['FAKE1']['fetched'], manifest['FAKE0']['fetched'])
+
+    def test_emptyRefreshes(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+            self.assertNotIn(
+                'empty_refreshes', data_gatherer._readManifest(cache_folder)['FAKE'])
+            for expected in (1, 2):
+                data_gatherer.local_cache.clear()
+                data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+                self.assertEqual(
+                    data_gatherer._readManifest(cache_folder)['FAKE']['empty_refreshes'],
+                    expected)
+
+            self.server.num_failures = 1000
+            data_gatherer.local_cache.clear()
+            with self.assertRaises(IOError):
+                data_gatherer._getAndCacheApiData(['FAKE'], 'key', cache_folder)
+            self.assertEqual(
+                data_gatherer._readManifest(cache_folder)['FAKE']['empty_refreshes'], 3)
+
+
+class TestMergePriceData(unittest.TestCase):
+
+    def test_consistent(self):
+        actual = data_gatherer._mergePriceData({0: 1.0, 1: 2.0}, {1: 2.0, 2: 3.0})
+        self.assertDictEqual(actual, {0: 1.0, 1: 2.0, 2: 3.0})
+
+    def test_inconsistent(self):
+        self.assertIsNone(
+            data_gatherer._mergePriceData({0: 1.0, 1: 2.0}, {1: 1.9, 2: 3.0}))
+
+    def test_noOverlap(self):
+        self.assertIsNone(data_gatherer._mergePriceData({0: 1.0}, {2: 3.0}))
+
+
+class TestReadCacheFileList(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filenames = []
+        for i in range(3):
+            ticker = 'FAKE%d' % i
+            data_gatherer._writeCacheFile(
+                {ticker: {'name': ticker + ' Inc', 'price_data': {2: 2.0 + i, 1: 1.0 + i}}},
+                ticker, self.temp_dir.name)
+            self.filenames.append(self.temp_dir.name + '/' + ticker + '.json.bz2')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_serial(self):
+        actual = data_gatherer._readCacheFileList(self.filenames, num_processes=1)
+
+        self.assertListEqual(sorted(actual), ['FAKE0', 'FAKE1', 'FAKE2'])
+        self.assertEqual(actual['FAKE1'].name, 'FAKE1 Inc')
+        self.assertListEqual(list(actual['FAKE1'].date_array), [1, 2])
+        self.assertListEqual(list(actual['FAKE1'].price_array), [2.0, 3.0])
+
+    def test_parallel(self):
+        expected = data_gatherer._readCacheFileList(self.filenames, num_processes=1)
+        actual = data_gatherer._readCacheFileList(self.filenames, num_processes=2)
+
+        self.assertDictEqual(actual.toTickerData(), expected.toTickerData())
+
+    def test_empty(self):
+        self.assertDictEqual(data_gatherer._readCacheFileList([]), {})
+
+
+class TestReadCacheFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_folder = self.temp_dir.name
+        self._writeFile({1: 1.0, 2: 2.0})
+        data_gatherer._readCacheFiles(['FAKE'], self.cache_folder, 1)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _writeFile(self, price_data):
+        manifest = data_gatherer._readManifest(self.cache_folder)
+        manifest['FAKE'] = data_gatherer._writeCacheFile(
+            {'FAKE': {'name': 'FAKE Inc', 'price_data': price_data}},
+            'FAKE', self.cache_folder)
+        data_gatherer._writeManifest(manifest, self.cache_folder)
+
+    def test_store(self):
+        with mock.patch.object(data_gatherer, '_readCacheFileList', return_value={}) as read:
+            actual = data_gatherer._readCacheFiles(['FAKE'], self.cache_folder, 1)
+
+        read.assert_called_once_with([], 1, mock.ANY)
+        self.assertDictEqual(actual['FAKE'].toPriceData(), {1: 1.0, 2: 2.0})
+
+    def test_staleStore(self):
+        # As if a refresh wrote the file, then crashed before the store.
+        self._writeFile({1: 1.0, 2: 2.0, 3: 3.0})
+        actual = data_gatherer._readCacheFiles(['FAKE'], self.cache_folder, 1)
+        store_folder = data_gatherer._getStoreFolder(self.cache_folder)
+
+        self.assertDictEqual(actual['FAKE'].toPriceData(), {1: 1.0, 2: 2.0, 3: 3.0})
+        self.assertDictEqual(
+            price_store.toUniverse(
+                price_store.readStore(store_folder), ['FAKE']).toTickerData(),
+            {'FAKE': {'name': 'FAKE Inc', 'price_data': {1: 1.0, 2: 2.0, 3: 3.0}}})
+
+    def test_staleStoreSameShape(self):
+        self._writeFile({1: 1.0, 2: 4.0})
+        actual = data_gatherer._readCacheFiles(['FAKE'], self.cache_folder, 1)
+
+        self.assertDictEqual(actual['FAKE'].toPriceData(), {1: 1.0, 2: 4.0})
+
+    def test_noChecksum(self):
+        store_folder = data_gatherer._getStoreFolder(self.cache_folder)
+        price_store.updateStore(store_folder, {
+            'FAKE': {'name': 'FAKE Inc', 'price_data': {1: 1.0, 2: 2.0}}})
+        self.assertDictEqual(price_store.readChecksums(store_folder), {'FAKE': None})
+
+        data_gatherer._readCacheFiles(['FAKE'], self.cache_folder, 1)
+
+        self.assertEqual(
+            price_store.readChecksums(store_folder)['FAKE'],
+            data_gatherer._readManifest(self.cache_folder)['FAKE']['checksum'])
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_folder = self.temp_dir.name
+        self.filename = self.cache_folder + '/FAKE.json.bz2'
+        self.entry = data_gatherer._writeCacheFile(
+            {'FAKE': {'name': 'FAKE Inc', 'price_data': {3: 3.0, 1: 1.0}}},
+            'FAKE', self.cache_folder)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_entry(self):
+        with open(self.filename, 'rb') as f:
+            checksum = zlib.crc32(f.read())
+
+        self.assertEqual(self.entry['last_date'], 3)
+        self.assertEqual(self.entry['rows'], 2)
+        self.assertEqual(self.entry['checksum'], checksum)
+        self.assertEqual(self.entry['codec'], 'bz2')
+        self.assertLessEqual(self.entry['fetched'], time.time())
+
+    def test_getCachedFilesUsesFetched(self):
+        self.entry['fetched'] = time.time() - 40 * 24 * 60 * 60
+        data_gatherer._writeManifest({'FAKE': self.entry}, self.cache_folder)
+
+        self.assertListEqual(
+            data_gatherer._getCachedFiles(['FAKE'], self.cache_folder, 30), [])
+        self.assertListEqual(
+            data_gatherer._getCachedFiles(['FAKE'], self.cache_folder, 50), ['FAKE'])
+
+    def test_getCachedFilesWithoutManifest(self):
+        self.assertListEqual(
+            data_gatherer._getCachedFiles(['FAKE', 'MISSING'], self.cache_folder, 30),
+            ['FAKE'])
+
+    def test_added(self):
+        manifest = {}
+        data_gatherer._readCacheFileList([self.filename], 1, manifest)
+
+        self.entry['fetched'] = os.path.getmtime(self.filename)
+        self.assertDictEqual(manifest, {'FAKE': self.entry})
+
+    def test_otherCodec(self):
+        data_gatherer.setCacheCodec(self.cache_folder, 'binary')
+        entry = data_gatherer._writeCacheFile(
+            {'FAKE': {'name': 'FAKE Inc', 'price_data': {3: 3.0, 1: 1.0, 4: 4.0}}},
+            'FAKE', self.cache_folder)
+        manifest = {}
+        actual = data_gatherer._readCacheFileList(
+            [self.cache_folder + '/FAKE.npz'], 1, manifest)
+
+        self.assertFalse(os.path.isfile(self.filename))
+        self.assertEqual(entry['codec'], 'binary')
+        self.assertEqual(manifest['FAKE']['codec'], 'binary')
+        self.assertEqual(manifest['FAKE']['checksum'], entry['checksum'])
+        self.assertListEqual(list(actual['FAKE'].date_array), [1, 3, 4])
+
+    def test_getWriteCodec(self):
+        self.assertEqual(data_gatherer._getWriteCodec({}), 'bz2')
+        self.assertEqual(data_gatherer._getWriteCodec({}, {'codec': 'zlib'}), 'zlib')
+        self.assertEqual(
+            data_gatherer._getWriteCodec({'codec': 'binary'}, {'codec': 'zlib'}), 'binary')
+        with self.assertRaises(ValueError):
+            data_gatherer.setCacheCodec(self.cache_folder, 'csv')
+
+    def test_mismatch(self):
+        self.entry['checksum'] += 1
+        manifest = {'FAKE': dict(self.entry)}
+        data_gatherer._readCacheFileList([self.filename], 1, manifest)
+
+        self.assertEqual(manifest['FAKE']['fetched'], 0)
+        self.assertEqual(manifest['FAKE']['checksum'], self.entry['checksum'] - 1)
+
+
+class TestScheduleRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_folder = self.temp_dir.name
+        # Dates are days since Thursday 1970-01-01, so 8 is a Friday, and 11
+        # the following Monday.
+        manifest = {
+            'FRESH': {'last_date': 8},
+            'STALE': {'last_date': 2},
+            'HELD': {'last_date': 6},
+            'OLD_NAME': {'last_date': 2}}
+        data_gatherer._writeManifest(manifest, self.cache_folder)
+        data_gatherer._writeNameIndex({
+            'OLD_NAME': {'name': 'Old', 'verified': 0},
+            'NEW': {'name': 'New', 'verified': time.time()}}, self.cache_folder)
+        self.tickers = ['FRESH', 'STALE', 'HELD', 'OLD_NAME', 'NEW', 'MISSING']
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _schedule(self, api_call_budget):
+        return data_gatherer._scheduleRefresh(
+            self.tickers, self.cache_folder, api_call_budget,
+            held_tickers=['HELD'], today=11)
+
+    def test_staleness(self):
+        self.assertEqual(data_gatherer._getStaleness(7, 11), 1)
+        self.assertEqual(data_gatherer._getStaleness(8, 11), 0)
+        self.assertEqual(data_gatherer._getStaleness(11, 11), 0)
+        self.assertEqual(data_gatherer._getStaleness(2, 11), 5)
+
+    def test_uncachedFirst(self):
+        self.assertSetEqual(self._schedule(3), {'NEW', 'MISSING'})
+
+    def test_heldFirst(self):
+        self.assertSetEqual(self._schedule(4), {'NEW', 'MISSING', 'HELD'})
+
+    def test_skipsFresh(self):
+        self.assertSetEqual(
+            self._schedule(100), {'NEW', 'MISSING', 'HELD', 'STALE', 'OLD_NAME'})
+
+    def test_fitsBudget(self):
+        # OLD_NAME needs a search, so only STALE fits.
+        self.assertSetEqual(self._schedule(5), {'NEW', 'MISSING', 'HELD', 'STALE'})
+
+    def test_defaultBudget(self):
+        self.assertSetEqual(self._schedule(None), {'NEW', 'MISSING', 'HELD'})
+
+    def test_emptyRefreshBackoff(self):
+        # HELD would be worth 2 * 5, but its last 3 refreshes found nothing.
+        manifest = data_gatherer._readManifest(self.cache_folder)
+        manifest['HELD']['empty_refreshes'] = 3
+        data_gatherer._writeManifest(manifest, self.cache_folder)
+
+        self.assertSetEqual(self._schedule(4), {'NEW', 'MISSING', 'STALE'})
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate(self):
+        bucket = data_gatherer._TokenBucket(1200)
+        start = time.time()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,105 @@
+"""Tests for the price_store module."""
+
+from . import price_store
+import numpy as np
+import tempfile
+import unittest
+
+
+class TestUpdateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store_folder = self.temp_dir.name + '/store'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_create(self):
+        price_store.updateStore(self.store_folder, {
+            'fake2': {'name': 'Fake 2', 'price_data': {1: 2.0, 2: 3.0}},
+            'fake1': {'name': 'Fake 1', 'price_data': {0: 1.0, 1: 1.5}}})
+        (ticker_tuple, name_tuple, date_array, price_matrix) = price_store.readStore(
+            self.store_folder)
+
+        self.assertTupleEqual(ticker_tuple, ('fake1', 'fake2'))
+        self.assertTupleEqual(name_tuple, ('Fake 1', 'Fake 2'))
+        self.assertListEqual(list(date_array), [0, 1, 2])
+        self.assertIsInstance(price_matrix, np.memmap)
+        np.testing.assert_array_equal(
+            price_matrix, [[1.0, np.nan], [1.5, 2.0], [np.nan, 3.0]])
+
+    def test_inPlace(self):
+        price_store.updateStore(self.store_folder, {
+            'fake1': {'name': 'Fake 1', 'price_data': {0: 1.0, 1: 1.5}},
+            'fake2': {'name': 'Fake 2', 'price_data': {0: 2.0, 1: 3.0}}})
+        price_store.updateStore(self.store_folder, {
+            'fake2': {'name': 'Fake 2', 'price_data': {1: 4.0}}})
+        store = price_store.readStore(self.store_folder)
+
+        np.testing.assert_array_equal(store[3], [[1.0, np.nan], [1.5, 4.0]])
+
+    def test_inPlaceKeepsReaders(self):
+        price_store.updateStore(self.store_folder, {
+            'fake1': {'name': 'Fake 1', 'price_data': {0: 1.0, 1: 1.5}}})
+        old_store = price_store.readStore(self.store_folder)
+        price_store.updateStore(self.store_folder, {
+            'fake1': {'name': 'Fake 1', 'price_data': {1: 2.0}}})
+
+        np.testing.assert_array_equal(old_store[3], [[1.0], [1.5]])
+        np.testing.assert_array_equal(
+            price_store.readStore(self.store_folder)[3], [[np.nan], [2.0]])
+
+    def test_newDatesAndTickers(self):
+        price_store.updateStore(self.store_folder, {
+            'fake2': {'name': 'Fake 2', 'price_data': {0: 2.0, 1: 3.0}}})
+        price_store.updateStore(self.store_folder, {
+            'fake1': {'name': 'Fake 1', 'price_data': {1: 1.5, 2: 1.0}}})
+        store = price_store.readStore(self.store_folder)
+
+        self.assertTupleEqual(store[0], ('fake1', 'fake2'))
+        self.assertListEqual(list(store[2]), [0, 1, 2])
+        np.testing.assert_array_equal(
+            store[3], [[np.nan, 2.0], [1.5, 3.0], [1.0, np.nan]])
+
+    def test_checksums(self):
+        price_store.updateStore(self.store_folder, {
+            'fake1': {'name': 'Fake 1', 'price_data': {0: 1.0}},
+            'fake2': {'name': 'Fake 2', 'price_data': {0: 2.0}}},
+            {'fake1': 1, 'fake2': 2})
+        price_store.updateStore(self.store_folder, {
+            'fake2': {'name': 'Fake 2', 'price_data': {0: 3.0}}}, {'fake2': 3})
+        self.assertDictEqual(
+            price_store.readChecksums(self.store_folder), {'fake1': 1, 'fake2': 3})
+
+        price_store.updateStore(self.store_folder, {
+            'fake3': {'name': 'Fake 3', 'price_data': {1: 3.0}}})
+        self.assertDictEqual(
+            price_store.readChecksums(self.store_folder),
+            {'fake1': 1, 'fake2': 3, 'fake3': None})
+
+
+class TestToUniverse(unittest.TestCase):
+
+    def test_basic(self):
+        store = (
+            ('fake1', 'fake2'),
+            ('Fake 1', 'Fake 2'),
+            np.array((0, 1), dtype=np.int32),
+            np.array(((1.0, np.nan), (1.5, 2.0))))
+        actual = price_store.toUniverse(store, ['fake1', 'fake2'])
+
+        self.assertEqual(actual['fake2'].name, 'Fake 2')
+        self.assertListEqual(list(actual['fake1'].price_array), [1.0, 1.5])
+        self.assertListEqual(list(actual['fake2'].date_array), [1])
+
+
+class TestReadStore(unittest.TestCase):
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertIsNone(price_store.readStore(temp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
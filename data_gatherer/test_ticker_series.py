@@ -0,0 +1,58 @@
+"""Tests for the ticker_series module."""
+
+from . import ticker_series
+import numpy as np
+import pickle
+import unittest
+
+
+class TestTickerSeries(unittest.TestCase):
+
+    def test_fromPriceData(self):
+        actual = ticker_series.TickerSeries.fromPriceData(
+            'Fake', {2: 3.0, 0: 1.0, 1: 2.0}, 0.01)
+
+        self.assertEqual(actual.date_array.dtype, np.int32)
+        self.assertListEqual(list(actual.date_array), [0, 1, 2])
+        self.assertListEqual(list(actual.price_array), [1.0, 2.0, 3.0])
+        self.assertEqual(len(actual), 3)
+        self.assertDictEqual(actual.toPriceData(), {0: 1.0, 1: 2.0, 2: 3.0})
+
+    def test_compatibility(self):
+        actual = ticker_series.TickerSeries('Fake', [0, 1], [1.0, 2.0])
+        actual['expense_ratio'] = 0.01
+
+        self.assertEqual(actual['name'], 'Fake')
+        self.assertEqual(actual.expense_ratio, 0.01)
+        self.assertDictEqual(actual['price_data'], {0: 1.0, 1: 2.0})
+        self.assertIsNone(actual.get('fake'))
+        with self.assertRaises(KeyError):
+            actual['price_data'] = {}
+
+    def test_slots(self):
+        actual = ticker_series.TickerSeries('Fake', [0], [1.0])
+        with self.assertRaises(AttributeError):
+            actual.fake = 1
+        self.assertListEqual(
+            list(pickle.loads(pickle.dumps(actual)).price_array), [1.0])
+
+
+class TestUniverse(unittest.TestCase):
+
+    def test_roundTrip(self):
+        ticker_data = {
+            'fake1': {'name': 'Fake 1', 'price_data': {0: 1.0, 1: 2.0}},
+            'fake2': {
+                'name': 'Fake 2',
+                'price_data': {1: 3.0},
+                'expense_ratio': 0.01}}
+        universe = ticker_series.Universe.fromTickerData(ticker_data)
+
+        self.assertIsInstance(universe['fake1'], ticker_series.TickerSeries)
+        self.assertTrue(np.isnan(universe['fake1'].expense_ratio))
+        self.assertDictEqual(universe.toTickerData(), ticker_data)
+        self.assertIs(ticker_series.Universe.fromTickerData(universe), universe)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Hold each ticker's prices as arrays, rather than a dict per ticker.
+
+A TickerSeries is a ticker's name, expense ratio, and sorted dates with their
+prices, and a Universe maps tickers to TickerSeries. Both can still be read
+like the older ticker_data dict format, see data_gatherer._getAllApiData,
+while callers migrate:
+
+    universe[ticker]['name']
+    universe[ticker]['price_data']  # A new {date: price} dict per access.
+    universe[ticker]['expense_ratio'] = expense_ratio
+"""
+import numpy as np
+
+
+class TickerSeries(object):
+    """Prices for a single ticker.
+
+    Attributes:
+        name: Name of the ticker.
+        expense_ratio: Expense ratio, or NaN if unknown.
+        date_array: Sorted int32 array of dates, as days since epoch.
+        price_array: Float64 array of prices, one per date.
+    """
+    __slots__ = ('name', 'expense_ratio', 'date_array', 'price_array')
+
+    def __init__(self, name, date_array, price_array, expense_ratio=np.nan):
+        self.name = name
+        self.expense_ratio = expense_ratio
+        self.date_array = np.asarray(date_array, dtype=np.int32)
+        self.price_array = np.asarray(price_array, dtype=np.float64)
+
+    @classmethod
+    def fromPriceData(cls, name, price_data, expense_ratio=np.nan):
+        """Create a series from a dict of integer dates to prices."""
+        date_array = np.fromiter(price_data.keys(), dtype=np.int32, count=len(price_data))
+        price_array = np.fromiter(price_data.values(), dtype=np.float64, count=len(price_data))
+        order = np.argsort(date_array, kind='stable')
+        return cls(name, date_array[order], price_array[order], expense_ratio)
+
+    def toPriceData(self):
+        """Get a dict of integer dates to prices."""
+        return dict(zip(self.date_array.tolist(), self.price_array.tolist()))
+
+    def __len__(self):
+        return len(self.date_array)
+
+    # Compatibility with the older ticker_data dict format.
+
+    def __getitem__(self, key):
+        if key == 'price_data':
+            return self.toPriceData()
+        if key in ('name', 'expense_ratio'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in ('name', 'expense_ratio'):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class Universe(dict):
+    """Dict of tickers to TickerSeries."""
+
+    @classmethod
+    def fromTickerData(cls, ticker_data):
+        """Convert ticker data in the older dict format.
+
+        Args:
+            ticker_data: See data_gatherer._getAllApiData for format, with
+                optional 'expense_ratio'. Values already TickerSeries are
+                kept as is.
+        Returns:
+            universe: A Universe of the same tickers.
+        """
+        if isinstance(ticker_data, cls):
+            return ticker_data
+        universe = cls()
+        for ticker, data in ticker_data.items():
+            if isinstance(data, TickerSeries):
+                universe[ticker] = data
+            else:
+                universe[ticker] = TickerSeries.fromPriceData(
+                    data.get('name'),
+                    data['price_data'],
+                    data.get('expense_ratio', np.nan))
+        return universe
+
+    def toTickerData(self):
+        """Convert to the older dict format, see data_gatherer._getAllApiData.
+
+        Returns:
+            ticker_data: Nested dict, with 'expense_ratio' where known.
+        """
+        ticker_data = {}
+        for ticker, series in self.items():
+            ticker_data[ticker] = {
+                'name': series.name,
+                'price_data': series.toPriceData()}
+            if not np.isnan(series.expense_ratio):
+                ticker_data[ticker]['expense_ratio'] = series.expense_ratio
+        return ticker_data
@@ -1,5 +1,6 @@
 import argparse
 import config
+from data_gatherer import cache_codec
 from data_gatherer import data_gatherer
 import time
 
@@ -10,17 +11,52 @@ parser.add_argument(
     choices=['outdated', 'none', 'all'],
     default='all',
     help='What tickers to update.')
+parser.add_argument(
+    '--num_threads',
+    type=int,
+    default=4,
+    help='How many tickers to fetch at once.')
+parser.add_argument(
+    '--requests_per_minute',
+    type=float,
+    default=60,
+    help='API rate limit, matching the AlphaVantage plan.')
+parser.add_argument(
+    '--full_refresh',
+    action='store_true',
+    help='Fetch full history for cached tickers, rather than recent days.')
+parser.add_argument(
+    '--api_call_budget',
+    type=int,
+    help=(
+        'Max API calls for an outdated refresh, e.g. the daily quota. '
+        'Defaults to fetching uncached tickers, and refreshing 1/25 of the rest.'))
+parser.add_argument(
+    '--cache_codec',
+    choices=sorted(cache_codec.EXTENSIONS),
+    help=(
+        'How to write cache files, see data_gatherer/cache_codec.py. Saved '
+        'in the cache folder, so later refreshes by any script use it. Files '
+        'in other codecs are still read, and converted as they refresh. '
+        'Defaults to the saved codec, or otherwise each file\'s current one.'))
 
 
 def main():
     args = parser.parse_args()
+    if args.cache_codec:
+        data_gatherer.setCacheCodec('cache', args.cache_codec)
 
     start = time.time()
     ticker_data = data_gatherer.getTickerData(
         set(config.TICKER_DICT.keys()),
         config.API_KEY,
         'cache',
-        args.refresh_strategy)
+        args.refresh_strategy,
+        num_threads=args.num_threads,
+        requests_per_minute=args.requests_per_minute,
+        incremental=not args.full_refresh,
+        api_call_budget=args.api_call_budget,
+        held_tickers=config.CURRENT_ALLOCATION_DICT)
     print('Getting data took %.2fs' % (time.time() - start))
 
 
@@ -0,0 +1,171 @@
+"""Collect named timing spans and counters over a run.
+
+Spans accumulate how many times, and for how many seconds, a named piece of
+code ran. Counters accumulate integer totals, e.g. API calls or candidates
+scored. Both are module level, so every module adds to the same run, and
+getReport collects them for writing as JSON.
+
+A counter named '<span>.<what>' is also reported as a rate per second of
+that span, e.g. 'optimizer.scoring.candidates' over 'optimizer.scoring'.
+
+Counts made in worker processes are not collected, so modules count work in
+the process that hands it out.
+"""
+from collections import defaultdict
+import contextlib
+import cProfile
+import functools
+import json
+import pstats
+import threading
+import time
+
+
+_lock = threading.Lock()
+_spans = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+_counters = defaultdict(int)
+
+# See setProfiledSpan.
+_profiled_span = None
+_profile_file = None
+_profiler = None
+_profile_stats = None
+
+
+def reset():
+    """Clear all spans and counters."""
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def count(name, amount=1):
+    """Add to a counter.
+
+    Args:
+        name: Name of the counter.
+        amount: How much to add.
+    """
+    with _lock:
+        _counters[name] += amount
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time a block of code, adding to the named span.
+
+    If this is the profiled span, and it is not already being profiled, the
+    block is also run under cProfile.
+
+    Args:
+        name: Name of the span.
+    """
+    global _profiler
+
+    profiler = None
+    if name == _profiled_span and _profiler is None:
+        profiler = _profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _spans[name]['calls'] += 1
+            _spans[name]['seconds'] += seconds
+        if profiler is not None:
+            profiler.disable()
+            _profiler = None
+            _addProfile(profiler)
+
+
+def timed(name):
+    """Decorate a function to run it in a span.
+
+    Args:
+        name: Name of the span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def setProfiledSpan(name, profile_file=None):
+    """Profile every run of a span with cProfile.
+
+    Args:
+        name: Name of the span to profile, or None to stop profiling.
+        profile_file: Optional file to dump stats to, for e.g. snakeviz.
+            Stats accumulate over every run of the span, see printProfile.
+    """
+    global _profiled_span
+    global _profile_file
+    global _profile_stats
+
+    _profiled_span = name
+    _profile_file = profile_file
+    _profile_stats = None
+
+
+def _addProfile(profiler):
+    """Add one run of the profiled span to its stats, and dump them."""
+    global _profile_stats
+
+    if _profile_stats is None:
+        _profile_stats = pstats.Stats(profiler)
+    else:
+        _profile_stats.add(profiler)
+    if _profile_file:
+        _profile_stats.dump_stats(_profile_file)
+
+
+def printProfile(num_functions=20):
+    """Print the functions with the most cumulative time in the profiled span.
+
+    Args:
+        num_functions: How many functions to print.
+    """
+    if _profile_stats is None:
+        print('Span %s never ran' % _profiled_span)
+        return
+    print('Profile of %s:' % _profiled_span)
+    _profile_stats.sort_stats('cumulative').print_stats(num_functions)
+
+
+def getReport():
+    """Get everything collected so far.
+
+    Returns:
+        report: Dict of 'spans' (name to 'calls' and 'seconds'), 'counters'
+            (name to total), and 'rates' (counter name to total per second of
+            its span).
+    """
+    with _lock:
+        spans = {name: dict(values) for name, values in _spans.items()}
+        counters = dict(_counters)
+
+    rates = {}
+    for name, total in counters.items():
+        span_name = name.rsplit('.', 1)[0]
+        if span_name in spans and spans[span_name]['seconds'] > 0:
+            rates[name] = total / spans[span_name]['seconds']
+
+    return {'spans': spans, 'counters': counters, 'rates': rates}
+
+
+def writeReport(filename):
+    """Write everything collected so far as JSON.
+
+    Args:
+        filename: Where to write the report.
+    """
+    report = getReport()
+    report['time'] = time.time()
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Wrote instrumentation report %s' % filename)
@@ -0,0 +1,68 @@
+"""Tests for the instrumentation module."""
+
+from . import instrumentation
+import json
+import os
+import tempfile
+import unittest
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        instrumentation.reset()
+
+    def tearDown(self):
+        instrumentation.setProfiledSpan(None)
+        instrumentation.reset()
+
+    def test_spansAndCounters(self):
+        for _ in range(2):
+            with instrumentation.span('fake'):
+                instrumentation.count('fake.things', 3)
+        report = instrumentation.getReport()
+
+        self.assertEqual(report['spans']['fake']['calls'], 2)
+        self.assertGreater(report['spans']['fake']['seconds'], 0)
+        self.assertDictEqual(report['counters'], {'fake.things': 6})
+        self.assertAlmostEqual(
+            report['rates']['fake.things'],
+            6 / report['spans']['fake']['seconds'])
+
+    def test_spanOnError(self):
+        with self.assertRaises(ValueError):
+            with instrumentation.span('fake'):
+                raise ValueError()
+
+        self.assertEqual(instrumentation.getReport()['spans']['fake']['calls'], 1)
+
+    def test_timed(self):
+        @instrumentation.timed('fake')
+        def fake(x):
+            return x + 1
+
+        self.assertEqual(fake(1), 2)
+        self.assertEqual(instrumentation.getReport()['spans']['fake']['calls'], 1)
+
+    def test_writeReport(self):
+        instrumentation.count('fake')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = temp_dir + '/report.json'
+            instrumentation.writeReport(filename)
+            with open(filename, 'r') as f:
+                report = json.load(f)
+
+        self.assertDictEqual(report['counters'], {'fake': 1})
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = temp_dir + '/fake.prof'
+            instrumentation.setProfiledSpan('fake', filename)
+            with instrumentation.span('fake'):
+                sum(range(1000))
+
+            self.assertTrue(os.path.isfile(filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+"""Shared fixtures for the optimizer tests."""
+
+import numpy as np
+
+
+def randomProblem(num_days=60, num_tickers=5, seed=0):
+    """Get a random optimization problem.
+
+    Args:
+        num_days: Number of days of returns.
+        num_tickers: Number of tickers.
+        seed: Seed for the random returns and expense ratios.
+    Returns:
+        data_matrix: Rows = days, columns = tickers, values = daily returns.
+        ticker_tuple: Tuple of fake ticker strings.
+        expense_array: Random expense ratios, one per ticker.
+    """
+    random_state = np.random.RandomState(seed)
+    data_matrix = 1.0 + random_state.normal(0.0005, 0.01, (num_days, num_tickers))
+    expense_array = random_state.uniform(0, 0.01, num_tickers)
+    ticker_tuple = tuple('fake%d' % i for i in range(num_tickers))
+    return (data_matrix, ticker_tuple, expense_array)
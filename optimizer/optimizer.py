@@ -1,29 +1,124 @@
 """Optimize allocations for a given date.
 
 General strategy is:
-    1) Fork several worker processes with copies of the filtered data.
-    2) From some arbitrary starting point, create a queue of all potential
-        single trade deviations.
-    3) Have workers process the queue, and send results back via queue.
+    1) Share the filtered data with a pool of worker processes via shared
+        memory, starting the pool on first use and keeping it for later calls.
+    2) From some arbitrary starting point, split all potential single trade
+        deviations into chunks.
+    3) Have workers score the chunks, sending back only the best trade of each.
     4) Have the master process the results, choosing the best one.
-    5a) If a better allocation is found, restart #3 with that allocation as the
+    5a) If a better allocation is found, restart #2 with that allocation as the
         starting point.
     5b) If no better allocation is found, halve the trading amount and restart
         #2 with the current allocation and new trade amount.
     6) Once a lower limit of trade amount is found, return the allocaiton.
 """
+import atexit
 import functools
+from instrumentation import instrumentation
+import math
+import multiprocessing as mp
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
 import numpy as np
 from scipy.stats.mstats import gmean
 import time
 
 
+# Scans with fewer trades than this are scored in this process, as sending
+# them to workers costs more than it saves.
+MIN_PARALLEL_TRADES = 1000
+
+# Pool of (pool, num_processes), kept alive across findOptimalAllocation
+# calls, see _getWorkers.
+_workers = None
+
+# In the master process, the name, shape and dtype of data_matrix in shared
+# memory, see _shareData. In workers, the SharedMemory block last attached.
+_shared_data = None
+shared_block = None
+
+
 def _initializeProcess(data):
     """Initialize a process with necessary data."""
     global data_matrix
     data_matrix = data
 
 
+def _attachSharedData(name, shape, dtype):
+    """Point a worker process's data_matrix at data in shared memory.
+
+    Workers outlive each findOptimalAllocation call, so they re-attach
+    whenever the master shares new data.
+
+    Args:
+        name: Name of the SharedMemory block holding the data.
+        shape: Shape of data_matrix.
+        dtype: String dtype of data_matrix.
+    """
+    # Keep a reference, otherwise the buffer is released under the array.
+    global shared_block
+    if shared_block is not None and shared_block.name == name:
+        return
+    if shared_block is not None:
+        _initializeProcess(None)
+        shared_block.close()
+    shared_block = shared_memory.SharedMemory(name=name)
+    _initializeProcess(np.ndarray(shape, dtype=dtype, buffer=shared_block.buf))
+
+
+def _getWorkers(num_processes):
+    """Get the pool of workers, starting it if needed.
+
+    The pool is kept for later calls, so walk-forward dates and sweeps only
+    start it once. See stopWorkers.
+
+    Args:
+        num_processes: How many worker processes the pool should have.
+    Returns:
+        pool: A multiprocessing Pool.
+    """
+    global _workers
+    if _workers is not None and _workers[1] != num_processes:
+        stopWorkers()
+    if _workers is None:
+        # Forked workers share the master's resource tracker only if it is
+        # already running, otherwise each starts its own, which unlinks
+        # blocks the worker attached to when it exits.
+        resource_tracker.ensure_running()
+        _workers = (mp.Pool(num_processes), num_processes)
+    return _workers[0]
+
+
+def stopWorkers():
+    """Stop the pool of workers, if it was started."""
+    global _workers
+    if _workers is not None:
+        _workers[0].close()
+        _workers[0].join()
+        _workers = None
+
+
+atexit.register(stopWorkers)
+
+
+def _shareData(data):
+    """Copy data to shared memory, for workers to attach to.
+
+    Args:
+        data: Rows = days, columns = tickers, values = % price changes.
+    Returns:
+        shared_block: The SharedMemory block, to close and unlink once
+            scoring is done.
+    """
+    global _shared_data
+    shared_block = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    shared_array = np.ndarray(data.shape, dtype=data.dtype, buffer=shared_block.buf)
+    shared_array[:] = data
+    _shared_data = (shared_block.name, data.shape, data.dtype.str)
+    return shared_block
+
+
 def _unwrapAndScore(data_dict):
     return _scoreAllocation(
             data_dict['allocation_array'],
@@ -32,6 +127,110 @@ def _unwrapAndScore(data_dict):
             use_downside_correl = data_dict['use_downside_correl'])
 
 
+def _getDownsideCorrelation(allocation_array, daily_returns, required_return):
+    """Calculate the weighted correlation of tickers on below target days.
+
+    Args:
+        allocation_array: An array of percent allocations.
+        daily_returns: Array of daily returns for allocation_array.
+        required_return: What daily return is desired.
+    Returns:
+        downside_correl: Allocation weighted downside correlation.
+    """
+    # Unheld tickers have no weight, so only correlate held ones.
+    held = np.flatnonzero(allocation_array)
+    below_desired = daily_returns < required_return
+    filtered_returns = data_matrix[below_desired][:, held]
+    return np.matmul(
+        np.matmul(
+            allocation_array[held],
+            np.atleast_2d(np.corrcoef(filtered_returns, rowvar=False))),
+        allocation_array[held])
+
+
+def _getDownsideStats(allocation_array, below_desired):
+    """Calculate sufficient statistics of returns on below target days.
+
+    Returns are shifted by -1 before summing, which leaves correlations
+    unchanged but avoids cancellation when they are converted to covariances.
+
+    Args:
+        allocation_array: An array of percent allocations.
+        below_desired: Boolean array, True for days below the target return.
+    Returns:
+        downside_stats: Tuple of:
+            below_desired: As above.
+            held: Array of column indices with non-zero allocations.
+            num_days: Number of below target days.
+            sums: Array of each column's sum over below target days.
+            held_products: Matrix of cross-products over below target days,
+                rows = held columns, columns = all columns.
+            squares: Array of each column's sum of squares over below target
+                days.
+    """
+    held = np.flatnonzero(allocation_array)
+    filtered_returns = data_matrix[below_desired] - 1.0
+    return (
+        below_desired,
+        held,
+        len(filtered_returns),
+        filtered_returns.sum(axis=0),
+        np.matmul(filtered_returns[:, held].T, filtered_returns),
+        np.einsum('ij,ij->j', filtered_returns, filtered_returns))
+
+
+def _getTradeDownsideCorrelation(downside_stats, allocation_array, buy_id, below_desired):
+    """Calculate downside correlation for a trade from a base's statistics.
+
+    Only days whose membership differs from the base are read from
+    data_matrix, and only the traded allocation's holdings are correlated, so
+    this costs O(flipped days * holdings + holdings^2) rather than a full
+    corrcoef.
+
+    Args:
+        downside_stats: See _getDownsideStats, for the base allocation.
+        allocation_array: An array of percent allocations after the trade.
+            Must only hold tickers held by the base, plus buy_id.
+        buy_id: Column index bought by the trade.
+        below_desired: Boolean array, True for days the traded allocation is
+            below the target return.
+    Returns:
+        downside_correl: As _getDownsideCorrelation.
+    """
+    (base_below, held, num_days, sums, held_products, squares) = downside_stats
+
+    num_held = len(held)
+    if buy_id in held:
+        columns = held
+        products = held_products[:, held]
+    else:
+        columns = np.append(held, buy_id)
+        products = np.empty((num_held + 1, num_held + 1), dtype=np.float64)
+        products[:num_held, :num_held] = held_products[:, held]
+        products[:num_held, num_held] = held_products[:, buy_id]
+        products[num_held, :num_held] = held_products[:, buy_id]
+        products[num_held, num_held] = squares[buy_id]
+    sums = sums[columns]
+
+    added_rows = np.flatnonzero(below_desired & ~base_below)
+    removed_rows = np.flatnonzero(base_below & ~below_desired)
+    num_days += len(added_rows) - len(removed_rows)
+    if num_days < 2:
+        return np.nan
+    if len(added_rows):
+        added = data_matrix[np.ix_(added_rows, columns)] - 1.0
+        sums = sums + added.sum(axis=0)
+        products = products + np.matmul(added.T, added)
+    if len(removed_rows):
+        removed = data_matrix[np.ix_(removed_rows, columns)] - 1.0
+        sums = sums - removed.sum(axis=0)
+        products = products - np.matmul(removed.T, removed)
+
+    cov = (products - np.outer(sums, sums) / num_days) / (num_days - 1)
+    weights = allocation_array[columns] / np.sqrt(np.diag(cov))
+    return np.matmul(np.matmul(weights, cov), weights)
+
+
 def _scoreAllocation(allocation_array, required_return, expense_array, use_downside_correl=False):
     """Determine the score of a given allocation.
 
@@ -64,15 +263,8 @@ def _scoreAllocation(allocation_array, required_return, expense_array, use_downs
     if not use_downside_correl:
         downside_correl = 1
     elif len(allocation_array) > 1:
-        below_desired = daily_returns < required_return
-        filtered_returns = [
-            data_matrix[x]
-            for x in range(len(below_desired)) if below_desired[x]]
-        downside_correl = np.matmul(
-            np.matmul(
-                allocation_array,
-               np.corrcoef(filtered_returns, rowvar=False)),
-            allocation_array)
+        downside_correl = _getDownsideCorrelation(
+                allocation_array, daily_returns, required_return)
     else:
         downside_correl = 1
 
@@ -81,7 +273,412 @@ def _scoreAllocation(allocation_array, required_return, expense_array, use_downs
             'allocation_array': allocation_array}
 
 
-def findOptimalAllocation(data_matrix, ticker_tuple, required_return, expense_array, use_downside_correl=True):
+def _findBestAllocation(best, trading_increment, required_return, expense_array, use_downside_correl):
+    """Find the best single trade deviation by scoring each allocation.
+
+    Args:
+        best: An array of percent allocations to deviate from.
+        trading_increment: Percent allocation moved by each trade.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+    Returns:
+        best_result: Dict of the best 'score' and 'allocation_array'.
+    """
+    map_iterable = []
+    for sell_id in range(len(best)):
+        if best[sell_id] < trading_increment: continue
+
+        for buy_id in range(len(best)):
+            if buy_id == sell_id: continue
+
+            curr = np.copy(best)
+            curr[sell_id] -= trading_increment
+            curr[buy_id] += trading_increment
+
+            map_iterable.append({
+                'allocation_array': curr,
+                'required_return': required_return,
+                'use_downside_correl': use_downside_correl,
+                'expense_array': expense_array})
+    _countCandidates(trading_increment, len(map_iterable))
+
+    results = map(_unwrapAndScore, map_iterable)
+    return functools.reduce(
+        lambda x, y: x if x['score'] > y['score'] else y,
+        results,
+        {'score': -float('inf')})
+
+
+def _countCandidates(trading_increment, num_candidates):
+    """Count candidates scored, in total and for this trading increment."""
+    instrumentation.count('optimizer.scoring.candidates', num_candidates)
+    instrumentation.count(
+        'optimizer.increment_%g.candidates' % trading_increment, num_candidates)
+
+
+def _getTradePairs(allocation_array, trading_increment, buy_candidates=None):
+    """List every single trade deviation from an allocation.
+
+    Args:
+        allocation_array: An array of percent allocations.
+        trading_increment: Percent allocation moved by each trade.
+        buy_candidates: Optional sorted array of the only column indices to
+            buy, see _screenBuys.
+    Returns:
+        sell_ids: Array of column indices to sell, sorted ascending.
+        buy_ids: Array of column indices to buy, ascending within each sell.
+    """
+    if buy_candidates is None:
+        buy_candidates = np.arange(len(allocation_array))
+    sells = np.flatnonzero(allocation_array >= trading_increment)
+    buy_grid = np.tile(buy_candidates, (len(sells), 1))
+    valid = buy_grid != sells[:, np.newaxis]
+    sell_ids = np.repeat(sells, len(buy_candidates))[valid.ravel()]
+    buy_ids = buy_grid[valid]
+    return (sell_ids, buy_ids)
+
+
+def _getScoreGradient(allocation_array, required_return, expense_array, risk_floor=0.0):
+    """Score an allocation, and get the gradient of its score.
+
+    The score is as _scoreAllocation without downside correlation, and costs
+    a couple of matrix-vector products along with its gradient.
+
+    Args:
+        allocation_array: An array of percent allocations.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+        risk_floor: Added to the squared downside risk, which smooths the
+            score where there is no downside.
+    Returns:
+        score: Score of the allocation.
+        gradient: Array of the score's derivative with respect to each
+            ticker's allocation, or None where the downside risk is 0.
+    """
+    raw_returns = np.matmul(data_matrix, allocation_array)
+    expense_base = 1 - np.matmul(allocation_array, expense_array)
+    expenses = pow(expense_base, 1 / 253)
+    daily_returns = raw_returns * expenses
+    mean_return = gmean(daily_returns)
+
+    # d(daily_returns[t]) / d(allocation[j]) is
+    # data_matrix[t, j] * expenses + raw_returns[t] * expense_gradient[j].
+    expense_gradient = -expenses / (253 * expense_base) * expense_array
+    num_days = len(daily_returns)
+
+    def _meanOfGradient(weights):
+        # Mean over days of weights[t] * d(daily_returns[t]) / d(allocation).
+        return (expenses * np.matmul(weights, data_matrix)
+                + np.dot(weights, raw_returns) * expense_gradient) / num_days
+
+    mean_gradient = mean_return * _meanOfGradient(1 / daily_returns)
+    if mean_return < required_return:
+        return (mean_return - required_return, mean_gradient)
+
+    shortfall = np.clip(daily_returns - required_return, None, 0)
+    downside_risk = np.sqrt((shortfall * shortfall).mean() + risk_floor)
+    if downside_risk == 0:
+        return (float('inf'), None)
+    score = (mean_return - required_return) / downside_risk
+    risk_gradient = _meanOfGradient(shortfall) / downside_risk
+    gradient = (mean_gradient - score * risk_gradient) / downside_risk
+    return (score, gradient)
+
+
+def _screenBuys(allocation_array, num_buys, required_return, expense_array):
+    """Pick the most promising tickers to buy, by a first-order estimate.
+
+    Moving trading_increment from a sell to a buy changes the score by about
+    trading_increment * (gradient[buy] - gradient[sell]), so for any sell the
+    best buys are those with the highest gradient. Downside correlation is
+    ignored by the estimate.
+
+    Args:
+        allocation_array: An array of percent allocations.
+        num_buys: How many tickers to keep.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+    Returns:
+        buy_candidates: Sorted array of column indices to buy, or None to
+            consider every ticker.
+    """
+    if num_buys >= len(allocation_array):
+        return None
+
+    (_, gradient) = _getScoreGradient(allocation_array, required_return, expense_array)
+    if gradient is None:
+        return None
+    return np.sort(np.argpartition(-gradient, num_buys - 1)[:num_buys])
+
+
+def _getBaseDownsideStats(base_returns, base_allocation, required_return, expense_array):
+    """Calculate _getDownsideStats for a base allocation, to score its trades.
+
+    Args:
+        base_returns: Array of daily returns for base_allocation, before
+            expenses.
+        base_allocation: An array of percent allocations.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+    Returns:
+        downside_stats: See _getDownsideStats, or None if there is only one
+            column, so no correlation to correct for.
+    """
+    if len(base_allocation) <= 1:
+        return None
+    base_daily_returns = base_returns * pow(
+        1 - np.matmul(base_allocation, expense_array), 1 / 253)
+    return _getDownsideStats(base_allocation, base_daily_returns < required_return)
+
+
+def _scoreTrades(base_returns, base_allocation, sell_ids, buy_ids, trading_increment, required_return, expense_array, downside_stats=None):
+    """Score a block of single trade deviations from a base allocation at once.
+
+    Each trade moves trading_increment from sell_ids[i] to buy_ids[i], so its
+    daily returns are base_returns + trading_increment * (buy - sell), which
+    avoids a full matmul per candidate.
+
+    Args:
+        base_returns: Array of daily returns for base_allocation, before
+            expenses.
+        base_allocation: An array of percent allocations.
+        sell_ids: Array of column indices to sell.
+        buy_ids: Array of column indices to buy, same length as sell_ids.
+        trading_increment: Percent allocation moved by each trade.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+        downside_stats: Optional _getBaseDownsideStats for base_allocation,
+            to include downside correlation in the scores.
+    Returns:
+        scores: Array of scores, as _scoreAllocation, one per trade.
+    """
+    daily_returns = data_matrix[:, buy_ids] - data_matrix[:, sell_ids]
+    daily_returns *= trading_increment
+    daily_returns += base_returns[:, np.newaxis]
+    expense_ratios = np.matmul(base_allocation, expense_array) + trading_increment * (
+        expense_array[buy_ids] - expense_array[sell_ids])
+    daily_returns *= np.power(1 - expense_ratios, 1 / 253)
+    mean_returns = np.exp(np.log(daily_returns).mean(axis=0))
+
+    # Short-circuit as in _scoreAllocation.
+    scores = mean_returns - required_return
+    passing = np.flatnonzero(mean_returns >= required_return)
+    if not len(passing):
+        return scores
+
+    filtered_returns = daily_returns[:, passing]
+    filtered_returns -= required_return
+    np.clip(filtered_returns, None, 0, out=filtered_returns)
+    filtered_returns *= filtered_returns
+    downside_risk = np.sqrt(filtered_returns.mean(axis=0))
+
+    downside_correl = np.ones(len(passing), dtype=np.float64)
+    if downside_stats is not None:
+        below_desired = daily_returns[:, passing] < required_return
+        for i, trade_id in enumerate(passing):
+            allocation_array = np.copy(base_allocation)
+            allocation_array[sell_ids[trade_id]] -= trading_increment
+            allocation_array[buy_ids[trade_id]] += trading_increment
+            downside_correl[i] = _getTradeDownsideCorrelation(
+                downside_stats, allocation_array, buy_ids[trade_id],
+                below_desired[:, i])
+
+    scores[passing] /= downside_risk * downside_correl
+    return scores
+
+
+def _scoreTradeChunk(args):
+    """Score a chunk of trades, returning only the best ones.
+
+    Args:
+        args: Tuple of (allocation_array, sell_ids, buy_ids, trading_increment,
+            required_return, expense_array, use_downside_correl, block_size,
+            num_trades). See _findBestTrades.
+    Returns:
+        best_trades: List of up to num_trades (score, sell_id, buy_id)
+            tuples, best first.
+    """
+    (allocation_array, sell_ids, buy_ids, trading_increment, required_return,
+        expense_array, use_downside_correl, block_size, num_trades) = args
+    base_returns = np.matmul(data_matrix, allocation_array)
+    # Shared by every block, as it only depends on the base.
+    downside_stats = None
+    if use_downside_correl:
+        downside_stats = _getBaseDownsideStats(
+            base_returns, allocation_array, required_return, expense_array)
+
+    best_trades = []
+    for start in range(0, len(sell_ids), block_size):
+        block_sell_ids = sell_ids[start:start + block_size]
+        block_buy_ids = buy_ids[start:start + block_size]
+        scores = _scoreTrades(
+            base_returns, allocation_array, block_sell_ids, block_buy_ids,
+            trading_increment, required_return, expense_array,
+            downside_stats)
+
+        # Keep every trade tied with the last of the top num_trades, so ties
+        # are broken by _sortTrades.
+        top = range(len(scores))
+        if len(scores) > num_trades:
+            kth = len(scores) - num_trades
+            top = np.flatnonzero(scores >= np.partition(scores, kth)[kth])
+        best_trades.extend(
+            (scores[i], int(block_sell_ids[i]), int(block_buy_ids[i]))
+            for i in top)
+        best_trades = _sortTrades(best_trades)[:num_trades]
+
+    return best_trades
+
+
+def _scoreSharedTradeChunk(shared_data, args):
+    """Score a chunk of trades in a worker, against shared data.
+
+    Args:
+        shared_data: Tuple of (name, shape, dtype), see _attachSharedData.
+        args: See _scoreTradeChunk.
+    Returns:
+        best_trades: See _scoreTradeChunk.
+    """
+    _attachSharedData(*shared_data)
+    return _scoreTradeChunk(args)
+
+
+def _sortTrades(trades):
+    """Sort (score, sell_id, buy_id) tuples best first.
+
+    Trades are listed in ascending (sell_id, buy_id) order, so later trades
+    win ties, matching the unbatched reduce.
+    """
+    return sorted(trades, reverse=True)
+
+
+def _findBestTrades(allocation_array, trading_increment, required_return, expense_array, use_downside_correl, block_size, pool=None, num_processes=1, chunk_size=None, buy_candidates=None, num_trades=1):
+    """Find the best single trade deviations from an allocation.
+
+    Args:
+        allocation_array: An array of percent allocations.
+        trading_increment: Percent allocation moved by each trade.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+        block_size: Max number of trades to score at once.
+        pool: Optional Pool from _getWorkers to score chunks in parallel,
+            when there are at least MIN_PARALLEL_TRADES trades.
+        num_processes: Number of workers in pool.
+        chunk_size: Number of trades sent to a worker at once, or None to
+            split trades evenly across the pool.
+        buy_candidates: Optional sorted array of the only column indices to
+            buy.
+        num_trades: How many trades to return.
+    Returns:
+        best_trades: List of up to num_trades (score, sell_id, buy_id)
+            tuples, best first.
+    """
+    (sell_ids, buy_ids) = _getTradePairs(
+        allocation_array, trading_increment, buy_candidates)
+    _countCandidates(trading_increment, len(sell_ids))
+
+    if len(sell_ids) < MIN_PARALLEL_TRADES:
+        pool = None
+    if pool is None:
+        chunk_size = max(len(sell_ids), 1)
+    elif chunk_size is None:
+        chunk_size = max(math.ceil(len(sell_ids) / num_processes), 1)
+
+    chunks = [
+        (allocation_array, sell_ids[start:start + chunk_size],
+            buy_ids[start:start + chunk_size], trading_increment,
+            required_return, expense_array, use_downside_correl, block_size,
+            num_trades)
+        for start in range(0, max(len(sell_ids), 1), chunk_size)]
+
+    if pool is None:
+        results = map(_scoreTradeChunk, chunks)
+    else:
+        results = pool.imap(
+            functools.partial(_scoreSharedTradeChunk, _shared_data), chunks)
+
+    return _sortTrades(sum(results, []))[:num_trades]
+
+
+def _findBestBatchedAllocation(best, best_score, trading_increment, required_return, expense_array, use_downside_correl, block_size, pool, num_processes, chunk_size, buy_candidates=None, max_trades=1):
+    """Find the best allocation up to max_trades trade deviations away.
+
+    Trades are taken from one scan via _findBestTrades, best first, skipping
+    any that touch a ticker already traded. Each is kept only if the
+    combined allocation, scored exactly, still improves.
+
+    Args:
+        best: An array of percent allocations to deviate from.
+        best_score: Score of best.
+        max_trades: Max number of trades to apply.
+        See _findBestTrades for others.
+    Returns:
+        best_result: Dict of the best 'score' and 'allocation_array', as
+            _findBestAllocation.
+    """
+    # The best trades tend to share a sell, which up to len(best) trades can,
+    # so keep enough candidates to find max_trades on distinct tickers.
+    num_trades = max_trades * len(best) if max_trades > 1 else 1
+    with instrumentation.span('optimizer.scoring'):
+        trades = _findBestTrades(
+            best, trading_increment, required_return, expense_array,
+            use_downside_correl, block_size, pool, num_processes,
+            chunk_size, buy_candidates, num_trades)
+    if not trades:
+        return {'score': -float('inf')}
+
+    # Re-score exactly, so rounding in the block can't cause trades to
+    # bounce back and forth.
+    best_result = {'score': trades[0][0]}
+    traded = set()
+    for (score, sell_id, buy_id) in trades:
+        if len(traded) == 2 * max_trades or (traded and score <= best_score):
+            break
+        if sell_id in traded or buy_id in traded:
+            continue
+
+        curr = np.copy(best_result.get('allocation_array', best))
+        curr[sell_id] -= trading_increment
+        curr[buy_id] += trading_increment
+        result = _scoreAllocation(
+            curr, required_return, expense_array, use_downside_correl)
+        if not traded or result['score'] > best_result['score']:
+            best_result = result
+            traded.update((sell_id, buy_id))
+
+    instrumentation.count('optimizer.optimize.trades', len(traded) // 2)
+    return best_result
+
+
+def _getInitialAllocation(ticker_tuple, initial_allocation_map=None):
+    """Get the allocation to start searching from.
+
+    Args:
+        ticker_tuple: Tuple of tickers in the matrix, in the same order.
+        initial_allocation_map: Optional dict of percent allocations by
+            ticker, e.g. a previous result. Tickers not in ticker_tuple are
+            dropped, and their allocation given to the largest holding.
+    Returns:
+        allocation_array: An array of percent allocations.
+    """
+    allocation_array = np.zeros(len(ticker_tuple), dtype=np.float64)
+    if initial_allocation_map:
+        for i, ticker in enumerate(ticker_tuple):
+            allocation_array[i] = max(initial_allocation_map.get(ticker, 0), 0)
+
+    total = allocation_array.sum()
+    if total <= 0:
+        allocation_array[0] = 1.0
+    elif total < 1:
+        allocation_array[np.argmax(allocation_array)] += 1 - total
+    else:
+        allocation_array /= total
+
+    return allocation_array
+
+
+@instrumentation.timed('optimizer.optimize')
+def findOptimalAllocation(data_matrix, ticker_tuple, required_return, expense_array, use_downside_correl=True, use_batch_scoring=True, block_size=1024, num_processes=1, chunk_size=None, initial_allocation_map=None, start_increment=1.0, min_increment=1 / 128, max_iterations=None, time_budget=None, prune_buys=None, max_trades_per_scan=1):
     """Find the optimal allocation.
 
     Args:
@@ -89,57 +686,100 @@ def findOptimalAllocation(data_matrix, ticker_tuple, required_return, expense_ar
             Tickers are ordered alphabetically.
         ticker_tuple: Tuple of tickers in the matrix, in the same order.
         required_return: What daily return is desired.
+        use_batch_scoring: Whether to score trades in blocks via
+            _findBestTrades, rather than one allocation at a time.
+        block_size: Max number of trades to score at once when batching.
+        num_processes: How many worker processes to score batches with. 1
+            scores serially in this process, as do problems too small to
+            have MIN_PARALLEL_TRADES trades per scan.
+        chunk_size: Number of trades sent to a worker at once, or None to
+            split each pass evenly across workers.
+        initial_allocation_map: Optional dict of percent allocations by
+            ticker to start from, rather than 100% in the first ticker.
+        start_increment: Percent allocation moved by trades at first. A warm
+            start can use a small value to skip the coarse increments.
+        min_increment: Smallest percent allocation to trade before stopping.
+        max_iterations: Optional max number of neighborhood scans.
+        time_budget: Optional max number of seconds to search for.
+        prune_buys: Optional number of tickers to consider buying each
+            iteration, screened by _screenBuys, when batching. Every trade is
+            still scored before halving the trading increment.
+        max_trades_per_scan: Max number of improving trades, on distinct
+            tickers, to apply from each scan when batching. See
+            _findBestBatchedAllocation.
     Returns:
+        best_score: Score of the best allocation found.
         allocations: Dict of percent allocations by ticker.
     """
     # Initialize global data for master.
     _initializeProcess(data_matrix)
 
-    best = np.zeros(len(ticker_tuple), dtype=np.float64)
-    best[0] = 1.0
+    best = _getInitialAllocation(ticker_tuple, initial_allocation_map)
     best_score = _scoreAllocation(best, required_return, expense_array, use_downside_correl)['score']
 
-    trading_increment = 1.0
+    trading_increment = start_increment
+    num_iterations = 0
+    search_start = time.time()
     start = time.time()
 
-    # TODO: Remove magic number. Currently ~1 basis point.
-    while trading_increment >= 1 / 128:
-        map_iterable = []
-        for sell_id in range(len(ticker_tuple)):
-            if best[sell_id] < trading_increment: continue
-
-            for buy_id in range(len(ticker_tuple)):
-                if buy_id == sell_id: continue
-
-                curr = np.copy(best)
-                curr[sell_id] -= trading_increment
-                curr[buy_id] += trading_increment
-
-                map_iterable.append({
-                    'allocation_array': curr, 
-                    'required_return': required_return, 
-                    'use_downside_correl': use_downside_correl,
-                    'expense_array': expense_array})
-
-        # TODO: Test different chunksizes.
-        results = map(_unwrapAndScore, map_iterable)
-        best_result = functools.reduce(
-            lambda x, y: x if x['score'] > y['score'] else y,
-            results,
-            {'score': -float('inf')})
-        
-        if best_result['score'] > best_score:
-            best = best_result['allocation_array']
-            best_score = best_result['score']
-        else:
-            print('Trading increment %.2f%% took %.2fs, score is %.4f' % (
-                trading_increment * 100,
-                time.time() - start,
-                best_score))
-            print({ticker_tuple[i]: best[i] for i in range(len(ticker_tuple)) if best[i] > 0})
-            start = time.time()
-            trading_increment /= 2.0
-   
+    pool = None
+    num_tickers = len(ticker_tuple)
+    if (use_batch_scoring and num_processes > 1
+            and num_tickers * (num_tickers - 1) >= MIN_PARALLEL_TRADES):
+        pool = _getWorkers(num_processes)
+        shared_block = _shareData(data_matrix)
+    try:
+        while trading_increment >= min_increment:
+            if max_iterations is not None and num_iterations >= max_iterations:
+                print('Stopping after %d iterations' % num_iterations)
+                break
+            if time_budget is not None and time.time() - search_start >= time_budget:
+                print('Stopping after %.2fs' % (time.time() - search_start))
+                break
+            num_iterations += 1
+            instrumentation.count('optimizer.optimize.iterations')
+
+            if use_batch_scoring:
+                buy_candidates = None
+                if prune_buys is not None:
+                    buy_candidates = _screenBuys(
+                        best, prune_buys, required_return, expense_array)
+                best_result = _findBestBatchedAllocation(
+                    best, best_score, trading_increment, required_return,
+                    expense_array, use_downside_correl, block_size, pool,
+                    num_processes, chunk_size, buy_candidates,
+                    max_trades_per_scan)
+                if buy_candidates is not None and best_result['score'] <= best_score:
+                    # Screening is approximate, so check every trade before
+                    # giving up on this increment.
+                    instrumentation.count('optimizer.optimize.pruning_fallbacks')
+                    best_result = _findBestBatchedAllocation(
+                        best, best_score, trading_increment, required_return,
+                        expense_array, use_downside_correl, block_size, pool,
+                        num_processes, chunk_size,
+                        max_trades=max_trades_per_scan)
+            else:
+                with instrumentation.span('optimizer.scoring'):
+                    best_result = _findBestAllocation(
+                        best, trading_increment, required_return, expense_array,
+                        use_downside_correl)
+
+            if best_result['score'] > best_score:
+                best = best_result['allocation_array']
+                best_score = best_result['score']
+            else:
+                print('Trading increment %.2f%% took %.2fs, score is %.4f' % (
+                    trading_increment * 100,
+                    time.time() - start,
+                    best_score))
+                print({ticker_tuple[i]: best[i] for i in range(len(ticker_tuple)) if best[i] > 0})
+                start = time.time()
+                trading_increment /= 2.0
+    finally:
+        if pool is not None:
+            shared_block.close()
+            shared_block.unlink()
+
     allocation_map = {ticker_tuple[i]: best[i] for i in range(len(ticker_tuple))}
 
     return (best_score, allocation_map)
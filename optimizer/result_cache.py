@@ -0,0 +1,176 @@
+"""Memoize optimizer results on disk.
+
+Results are keyed by a hash of the return matrix, tickers, expenses, every
+parameter that can change the result, and the solver's code, and stored one
+JSON file per key. Parameters are normalized against the solver's defaults,
+so passing a default explicitly reuses the same result as omitting it.
+Reading a result refreshes its modification time, and the least recently used
+files are removed once there are more than max_entries.
+"""
+
+import functools
+import glob
+import hashlib
+import inspect
+from instrumentation import instrumentation
+import json
+import numpy as np
+import os
+from optimizer import optimizer
+from optimizer import solvers
+
+
+# Bump to invalidate every stored result, e.g. when their format changes.
+CACHE_VERSION = 1
+
+# Options which only change how fast a result is found, not the result.
+_EXECUTION_OPTIONS = ('num_processes', 'chunk_size', 'block_size')
+
+# Modules, beyond a solver's own, whose code can change its results.
+_SOLVER_DEPENDENCIES = {'slsqp': (optimizer,)}
+
+
+def _getSolverSources(solver):
+    """Get the source files whose code can change a solver's results.
+
+    Args:
+        solver: Name of the solver in solvers.SOLVERS.
+    Returns:
+        filenames: List of the solver's own module, then its dependencies.
+    """
+    # Unwrapped, so decorators like instrumentation.timed aren't hashed.
+    filenames = [inspect.getsourcefile(inspect.unwrap(solvers.SOLVERS[solver]))]
+    for module in _SOLVER_DEPENDENCIES.get(solver, ()):
+        filenames.append(inspect.getsourcefile(module))
+    return filenames
+
+
+@functools.lru_cache(maxsize=None)
+def _getSolverVersion(solver):
+    """Hash the source of a solver's modules, so code changes miss the cache.
+
+    Args:
+        solver: Name of the solver in solvers.SOLVERS.
+    Returns:
+        version: Hex string, or an empty string for an unknown solver.
+    """
+    if solver not in solvers.SOLVERS:
+        return ''
+    digest = hashlib.sha256()
+    for filename in _getSolverSources(solver):
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _normalizeOptions(options):
+    """Fill in a solver's defaults, and drop options which can't matter.
+
+    Args:
+        options: Dict of keyword arguments, see solvers.findOptimalAllocation.
+    Returns:
+        result_options: Dict of every option which can change the result.
+    """
+    solver = options.get(
+        'solver',
+        inspect.signature(solvers.findOptimalAllocation).parameters['solver'].default)
+    if solver not in solvers.SOLVERS:
+        return dict(options)
+
+    # Solvers ignore options they don't name, see the solvers module.
+    parameters = inspect.signature(solvers.SOLVERS[solver]).parameters
+    result_options = {'solver': solver}
+    for name, parameter in list(parameters.items())[4:]:
+        if parameter.kind == parameter.VAR_KEYWORD or name in _EXECUTION_OPTIONS:
+            continue
+        result_options[name] = options.get(name, parameter.default)
+    return result_options
+
+
+def _getKey(data_matrix, ticker_tuple, required_return, expense_array, options):
+    """Hash an optimizer problem.
+
+    Args:
+        See optimizer.findOptimalAllocation.
+        options: Dict of other keyword arguments.
+    Returns:
+        key: Hex string uniquely identifying the problem.
+    """
+    digest = hashlib.sha256()
+    for array in (data_matrix, expense_array):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        digest.update(repr(array.shape).encode())
+        digest.update(array.tobytes())
+    result_options = _normalizeOptions(options)
+    digest.update(json.dumps(
+        [
+            CACHE_VERSION,
+            _getSolverVersion(result_options.get('solver')),
+            list(ticker_tuple),
+            repr(required_return),
+            result_options],
+        sort_keys=True,
+        default=repr).encode())
+    return digest.hexdigest()
+
+
+def _evict(cache_folder, max_entries):
+    """Remove the least recently used results beyond max_entries."""
+    filenames = glob.glob(cache_folder + '/*.json')
+    if len(filenames) <= max_entries:
+        return
+
+    mtimes = []
+    for filename in filenames:
+        try:
+            mtimes.append((os.path.getmtime(filename), filename))
+        except FileNotFoundError:
+            continue
+    for _, filename in sorted(mtimes)[:len(mtimes) - max_entries]:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+def findOptimalAllocation(cache_folder, data_matrix, ticker_tuple, required_return, expense_array, max_entries=1000, **kwargs):
+    """Find the optimal allocation, reusing a stored result if possible.
+
+    Args:
+        cache_folder: Where to store results.
+        max_entries: Max number of results to keep.
+        See solvers.findOptimalAllocation for others.
+    Returns:
+        See solvers.findOptimalAllocation.
+    """
+    # A time budget makes results depend on machine load.
+    if kwargs.get('time_budget') is not None:
+        return solvers.findOptimalAllocation(
+            data_matrix, ticker_tuple, required_return, expense_array, **kwargs)
+
+    key = _getKey(data_matrix, ticker_tuple, required_return, expense_array, kwargs)
+    filename = cache_folder + '/' + key + '.json'
+    try:
+        with open(filename, 'r') as f:
+            result = json.load(f)
+        os.utime(filename)
+        instrumentation.count('optimizer.result_cache.hits')
+        print('Reusing optimizer result %s' % key[:12])
+        return (result['best_score'], result['allocation_map'])
+    except (FileNotFoundError, ValueError):
+        pass
+
+    instrumentation.count('optimizer.result_cache.misses')
+    (best_score, allocation_map) = solvers.findOptimalAllocation(
+        data_matrix, ticker_tuple, required_return, expense_array, **kwargs)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        json.dump({
+            'best_score': float(best_score),
+            'allocation_map': {k: float(v) for k, v in allocation_map.items()}}, f)
+    os.replace(temp_filename, filename)
+    _evict(cache_folder, max_entries)
+
+    return (best_score, allocation_map)
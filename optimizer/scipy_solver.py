@@ -0,0 +1,183 @@
+"""Optimize allocations for a given date with scipy.optimize.
+
+General strategy is:
+    1) Start from an equal allocation, or a given one.
+    2) Maximize the same score as the swap search, without downside
+        correlation, with SLSQP over allocations that are non-negative and
+        sum to 1. The squared downside risk gets a small floor so the score
+        stays smooth where there is no downside, and the score is scaled by
+        its starting gradient, which can be huge when downside risk is small.
+    3) Drop negligible allocations from the start, the best iterate and the
+        result, score each exactly, and keep the best. Warn if SLSQP didn't
+        converge.
+
+Unlike the swap search, allocations are not limited to multiples of a
+trading increment.
+"""
+from instrumentation import instrumentation
+from optimizer import optimizer
+import numpy as np
+from scipy import optimize
+import time
+import warnings
+
+
+# Allocations smaller than this are dropped from the result.
+MIN_ALLOCATION = 1e-4
+
+# See optimizer._getScoreGradient.
+RISK_FLOOR = 1e-12
+
+
+class ConvergenceWarning(RuntimeWarning):
+    """SLSQP stopped without converging, e.g. at its iteration limit."""
+
+
+def _getInitialAllocation(ticker_tuple, initial_allocation_map=None):
+    """Get an allocation to start from.
+
+    Args:
+        ticker_tuple: Tuple of tickers in the matrix.
+        initial_allocation_map: Optional dict of percent allocations by
+            ticker, see optimizer._getInitialAllocation.
+    Returns:
+        allocation_array: An array of percent allocations.
+    """
+    if initial_allocation_map is not None:
+        return optimizer._getInitialAllocation(ticker_tuple, initial_allocation_map)
+    return np.full(len(ticker_tuple), 1 / len(ticker_tuple), dtype=np.float64)
+
+
+def _getObjectiveScale(allocation_array, required_return, expense_array):
+    """Get how much to divide the score by, so SLSQP sees a unit gradient.
+
+    Args:
+        allocation_array: The allocation SLSQP starts from.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+    Returns:
+        scale: Norm of the score's gradient at allocation_array, or 1 if it
+            isn't usable.
+    """
+    (_, gradient) = optimizer._getScoreGradient(
+        allocation_array, required_return, expense_array, RISK_FLOOR)
+    if gradient is None:
+        return 1.0
+    scale = np.linalg.norm(gradient)
+    return scale if np.isfinite(scale) and scale > 0 else 1.0
+
+
+def _cleanAllocation(allocation_array):
+    """Drop negligible and negative allocations, and renormalize.
+
+    Args:
+        allocation_array: An array of approximately percent allocations.
+    Returns:
+        allocation_array: A new array of percent allocations.
+    """
+    allocation_array = np.clip(allocation_array, 0, None)
+    allocation_array[allocation_array < MIN_ALLOCATION] = 0
+    return allocation_array / allocation_array.sum()
+
+
+def _getBestAllocation(ticker_tuple, candidates, required_return, expense_array, use_downside_correl):
+    """Clean and score candidate allocations, and return the best.
+
+    Args:
+        ticker_tuple: Tuple of tickers, in column order.
+        candidates: List of arrays of percent allocations.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+        use_downside_correl: Whether scores include downside correlation.
+    Returns:
+        best_score: Score of the best candidate.
+        allocations: Dict of percent allocations by ticker.
+    """
+    best_score = None
+    for candidate in candidates:
+        candidate = _cleanAllocation(candidate)
+        score = optimizer._scoreAllocation(
+            candidate, required_return, expense_array, use_downside_correl)['score']
+        if best_score is None or score > best_score:
+            (best_score, best) = (score, candidate)
+
+    allocation_map = {ticker_tuple[i]: best[i] for i in range(len(ticker_tuple))}
+
+    return (best_score, allocation_map)
+
+
+def findOptimalAllocation(data_matrix, ticker_tuple, required_return, expense_array, use_downside_correl=True, initial_allocation_map=None, max_iterations=None, time_budget=None, tolerance=1e-10, **kwargs):
+    """Find the optimal allocation.
+
+    Args:
+        data_matrix: Rows = days, columns = tickers, values = % price changes.
+        ticker_tuple: Tuple of tickers in the matrix, in the same order.
+        required_return: What daily return is desired.
+        expense_array: Array of expense ratios, in column order.
+        use_downside_correl: Whether the returned score includes downside
+            correlation. The search itself ignores it.
+        initial_allocation_map: Optional dict of percent allocations by
+            ticker to start from, rather than an equal allocation.
+        max_iterations: Optional max number of SLSQP iterations, or 0 to
+            just score the starting allocation. Defaults to 1000.
+        time_budget: Optional max number of seconds to search for.
+        tolerance: SLSQP convergence tolerance.
+        kwargs: Options only used by the swap search, which are ignored.
+    Returns:
+        best_score: Score of the best allocation found, which is never worse
+            than the starting allocation.
+        allocations: Dict of percent allocations by ticker.
+    Warns:
+        ConvergenceWarning: If SLSQP stopped without converging, other than
+            for time_budget.
+    """
+    optimizer._initializeProcess(data_matrix)
+    start = time.time()
+    initial_allocation = _getInitialAllocation(ticker_tuple, initial_allocation_map)
+    if max_iterations == 0:
+        return _getBestAllocation(
+            ticker_tuple, [initial_allocation], required_return, expense_array,
+            use_downside_correl)
+    scale = _getObjectiveScale(initial_allocation, required_return, expense_array)
+    # Lowest objective value, and its allocation, of any iterate.
+    best_iterate = [np.inf, initial_allocation]
+
+    def _objective(allocation_array):
+        (score, gradient) = optimizer._getScoreGradient(
+            allocation_array, required_return, expense_array, RISK_FLOOR)
+        return (-score / scale, -gradient / scale)
+
+    def _callback(intermediate_result):
+        if intermediate_result.fun < best_iterate[0]:
+            best_iterate[:] = [intermediate_result.fun, np.copy(intermediate_result.x)]
+        if time_budget is not None and time.time() - start >= time_budget:
+            print('Stopping after %.2fs' % (time.time() - start))
+            raise StopIteration
+
+    num_tickers = len(ticker_tuple)
+    result = optimize.minimize(
+        _objective,
+        initial_allocation,
+        jac=True,
+        method='SLSQP',
+        bounds=[(0, 1)] * num_tickers,
+        constraints=[{
+            'type': 'eq',
+            'fun': lambda allocation_array: allocation_array.sum() - 1,
+            'jac': lambda allocation_array: np.ones(num_tickers)}],
+        tol=tolerance,
+        options={'maxiter': 1000 if max_iterations is None else max_iterations},
+        callback=_callback)
+    print('SLSQP took %d iterations, %.2fs: %s' % (
+        result.nit, time.time() - start, result.message))
+    stopped_early = time_budget is not None and time.time() - start >= time_budget
+    if not result.success and not stopped_early:
+        instrumentation.count('optimizer.slsqp.not_converged')
+        warnings.warn(
+            'SLSQP did not converge after %d iterations: %s' % (result.nit, result.message),
+            ConvergenceWarning)
+
+    # SLSQP can end somewhere worse than it passed through, or started.
+    return _getBestAllocation(
+        ticker_tuple, [initial_allocation, best_iterate[1], result.x],
+        required_return, expense_array, use_downside_correl)
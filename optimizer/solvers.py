@@ -0,0 +1,33 @@
+"""Choose between ways of optimizing allocations.
+
+Every solver takes (data_matrix, ticker_tuple, required_return,
+expense_array, **options), and returns (best_score, allocation_map), see
+optimizer.findOptimalAllocation. Other solvers ignore options only the swap
+search uses.
+"""
+from optimizer import optimizer
+from optimizer import scipy_solver
+
+
+SOLVERS = {
+    # Trades increments of allocation between pairs of tickers.
+    'swap': optimizer.findOptimalAllocation,
+    # Gradient based, over continuous allocations.
+    'slsqp': scipy_solver.findOptimalAllocation,
+}
+
+
+def findOptimalAllocation(data_matrix, ticker_tuple, required_return, expense_array, solver='swap', **kwargs):
+    """Find the optimal allocation with the given solver.
+
+    Args:
+        solver: Name of the solver in SOLVERS.
+        See optimizer.findOptimalAllocation for others.
+    Returns:
+        See optimizer.findOptimalAllocation.
+    """
+    if solver not in SOLVERS:
+        raise ValueError('Unknown solver %s, expected one of %s' % (
+            solver, sorted(SOLVERS)))
+    return SOLVERS[solver](
+        data_matrix, ticker_tuple, required_return, expense_array, **kwargs)
@@ -1,9 +1,11 @@
 """Tests for the optimizer module."""
 
+from . import fixtures
 from . import optimizer
 import config
 import numpy as np
 import unittest
+from unittest import mock
 
 class TestScoreAllocation(unittest.TestCase):
 
@@ -50,5 +52,288 @@ class TestScoreAllocation(unittest.TestCase):
         self.assertAlmostEqual(output['score'], expected_score, places=4)
 
 
+class TestScoreTrades(unittest.TestCase):
+
+    def _checkMatchesScoreAllocation(self, required_return, use_downside_correl):
+        (data_matrix, _, expense_array) = fixtures.randomProblem()
+        optimizer._initializeProcess(data_matrix)
+        base = np.array((0.5, 0.25, 0.25, 0, 0), dtype=np.float64)
+        (sell_ids, buy_ids) = optimizer._getTradePairs(base, 0.25)
+        base_returns = np.matmul(data_matrix, base)
+        downside_stats = None
+        if use_downside_correl:
+            downside_stats = optimizer._getBaseDownsideStats(
+                base_returns, base, required_return, expense_array)
+        actual = optimizer._scoreTrades(
+            base_returns, base, sell_ids, buy_ids, 0.25, required_return,
+            expense_array, downside_stats)
+
+        self.assertEqual(len(actual), 3 * 4)
+        for i in range(len(sell_ids)):
+            allocations = np.copy(base)
+            allocations[sell_ids[i]] -= 0.25
+            allocations[buy_ids[i]] += 0.25
+            expected = optimizer._scoreAllocation(
+                allocations, required_return, expense_array, use_downside_correl)
+            self.assertAlmostEqual(actual[i], expected['score'], places=8)
+
+    def test_positive(self):
+        self._checkMatchesScoreAllocation(0.999, False)
+
+    def test_negative(self):
+        self._checkMatchesScoreAllocation(1.01, False)
+
+    def test_downsideCorrel(self):
+        self._checkMatchesScoreAllocation(0.999, True)
+
+
+class TestTradeDownsideCorrelation(unittest.TestCase):
+
+    def test_matchesCorrcoef(self):
+        (data_matrix, _, _) = fixtures.randomProblem(num_days=200, num_tickers=12, seed=3)
+        optimizer._initializeProcess(data_matrix)
+        base = np.zeros(12, dtype=np.float64)
+        base[[1, 4, 7]] = (0.5, 0.25, 0.25)
+        downside_stats = optimizer._getDownsideStats(
+            base, np.matmul(data_matrix, base) < 1.0)
+
+        for (sell_id, buy_id) in ((1, 4), (4, 0), (7, 11), (1, 2)):
+            allocations = np.copy(base)
+            allocations[sell_id] -= 0.25
+            allocations[buy_id] += 0.25
+            daily_returns = np.matmul(data_matrix, allocations)
+            held = np.flatnonzero(allocations)
+            below = data_matrix[daily_returns < 1.0][:, held]
+            expected = np.matmul(
+                np.matmul(allocations[held], np.corrcoef(below, rowvar=False)),
+                allocations[held])
+            actual = optimizer._getTradeDownsideCorrelation(
+                downside_stats, allocations, buy_id, daily_returns < 1.0)
+            self.assertAlmostEqual(actual, expected, places=10)
+
+
+class TestFindOptimalAllocation(unittest.TestCase):
+
+    def test_batchMatchesUnbatched(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem()
+        expected = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            use_downside_correl=False, use_batch_scoring=False)
+        actual = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            use_downside_correl=False, block_size=7)
+
+        self.assertAlmostEqual(actual[0], expected[0], places=8)
+        self.assertDictEqual(actual[1], expected[1])
+
+    def test_parallelMatchesSerial(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=8)
+        expected = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array)
+        with mock.patch.object(optimizer, 'MIN_PARALLEL_TRADES', 0):
+            actual = optimizer.findOptimalAllocation(
+                data_matrix, ticker_tuple, 0.999, expense_array,
+                num_processes=2, chunk_size=5)
+
+        self.assertEqual(actual[0], expected[0])
+        self.assertDictEqual(actual[1], expected[1])
+
+    def test_workersKept(self):
+        self.addCleanup(optimizer.stopWorkers)
+        with mock.patch.object(optimizer, 'MIN_PARALLEL_TRADES', 0):
+            for seed in range(2):
+                (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+                    num_tickers=6, seed=seed)
+                expected = optimizer.findOptimalAllocation(
+                    data_matrix, ticker_tuple, 0.999, expense_array)
+                actual = optimizer.findOptimalAllocation(
+                    data_matrix, ticker_tuple, 0.999, expense_array,
+                    num_processes=2)
+                if seed == 0:
+                    pool = optimizer._workers[0]
+
+                self.assertIs(optimizer._workers[0], pool)
+                self.assertDictEqual(actual[1], expected[1])
+
+    def test_smallProblemSerial(self):
+        optimizer.stopWorkers()
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem()
+        optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array, num_processes=2)
+
+        self.assertIsNone(optimizer._workers)
+
+
+class TestScreenBuys(unittest.TestCase):
+
+    def _checkMatchesFiniteDifference(self, required_return):
+        (data_matrix, _, expense_array) = fixtures.randomProblem(num_tickers=8, seed=2)
+        optimizer._initializeProcess(data_matrix)
+        base = np.array((0.5, 0.25, 0.25, 0, 0, 0, 0, 0), dtype=np.float64)
+        base_score = optimizer._scoreAllocation(
+            base, required_return, expense_array)['score']
+        estimates = []
+        for buy_id in range(8):
+            allocations = np.copy(base)
+            allocations[buy_id] += 1e-6
+            estimates.append(optimizer._scoreAllocation(
+                allocations, required_return, expense_array)['score'] - base_score)
+        expected = np.sort(np.argsort(estimates)[-3:])
+
+        actual = optimizer._screenBuys(base, 3, required_return, expense_array)
+        self.assertListEqual(list(actual), list(expected))
+
+    def test_positive(self):
+        self._checkMatchesFiniteDifference(0.999)
+
+    def test_negative(self):
+        self._checkMatchesFiniteDifference(1.01)
+
+    def test_allTickers(self):
+        (data_matrix, _, expense_array) = fixtures.randomProblem()
+        optimizer._initializeProcess(data_matrix)
+        self.assertIsNone(optimizer._screenBuys(
+            np.full(5, 0.2), 5, 0.999, expense_array))
+
+
+class TestPruneBuys(unittest.TestCase):
+
+    def test_closeToExact(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_days=250, num_tickers=40, seed=1)
+        expected = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            use_downside_correl=False)
+        actual = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            use_downside_correl=False, prune_buys=5)
+
+        self.assertGreater(actual[0], expected[0] * 0.95)
+        self.assertAlmostEqual(sum(actual[1].values()), 1.0)
+
+
+class TestFindBestTrades(unittest.TestCase):
+
+    def test_matchesScoreTrades(self):
+        (data_matrix, _, expense_array) = fixtures.randomProblem(num_tickers=8)
+        optimizer._initializeProcess(data_matrix)
+        base = np.array((0.5, 0.25, 0.25, 0, 0, 0, 0, 0), dtype=np.float64)
+        (sell_ids, buy_ids) = optimizer._getTradePairs(base, 0.25)
+        scores = optimizer._scoreTrades(
+            np.matmul(data_matrix, base), base, sell_ids, buy_ids, 0.25,
+            0.999, expense_array)
+        expected = sorted(zip(scores, sell_ids, buy_ids), reverse=True)[:4]
+
+        actual = optimizer._findBestTrades(
+            base, 0.25, 0.999, expense_array, False, 5, num_trades=4)
+        self.assertListEqual(
+            [trade[1:] for trade in actual], [trade[1:] for trade in expected])
+        for (actual_trade, expected_trade) in zip(actual, expected):
+            self.assertAlmostEqual(actual_trade[0], expected_trade[0], places=10)
+
+
+    def test_downsideStatsOncePerChunk(self):
+        (data_matrix, _, expense_array) = fixtures.randomProblem(num_tickers=8)
+        optimizer._initializeProcess(data_matrix)
+        base = np.array((0.5, 0.25, 0.25, 0, 0, 0, 0, 0), dtype=np.float64)
+        with mock.patch.object(
+                optimizer, '_getDownsideStats',
+                wraps=optimizer._getDownsideStats) as get_stats:
+            optimizer._findBestTrades(base, 0.25, 0.999, expense_array, True, 5)
+
+        get_stats.assert_called_once()
+
+
+class TestMaxTradesPerScan(unittest.TestCase):
+
+    def test_disjointTrades(self):
+        (data_matrix, _, expense_array) = fixtures.randomProblem(num_tickers=8)
+        optimizer._initializeProcess(data_matrix)
+        base = np.array((0.5, 0.5, 0, 0, 0, 0, 0, 0), dtype=np.float64)
+        base_score = optimizer._scoreAllocation(base, 0.999, expense_array)['score']
+        actual = optimizer._findBestBatchedAllocation(
+            base, base_score, 0.125, 0.999, expense_array, False, 1024, None, 1,
+            None, max_trades=3)
+
+        changes = actual['allocation_array'] - base
+        self.assertGreater(np.count_nonzero(changes), 2)
+        self.assertTrue(np.all(np.isclose(np.abs(changes[changes != 0]), 0.125)))
+        self.assertAlmostEqual(
+            actual['score'],
+            optimizer._scoreAllocation(
+                actual['allocation_array'], 0.999, expense_array)['score'])
+        self.assertGreater(actual['score'], base_score)
+
+    def test_fewerScans(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_days=250, num_tickers=30, seed=1)
+        optimizer.instrumentation.reset()
+        expected = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            use_downside_correl=False)
+        expected_scans = optimizer.instrumentation.getReport()['counters'][
+            'optimizer.optimize.iterations']
+        optimizer.instrumentation.reset()
+        actual = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            use_downside_correl=False, max_trades_per_scan=8)
+        actual_scans = optimizer.instrumentation.getReport()['counters'][
+            'optimizer.optimize.iterations']
+
+        self.assertLess(actual_scans, expected_scans)
+        self.assertGreater(actual[0], expected[0] * 0.95)
+        self.assertAlmostEqual(sum(actual[1].values()), 1.0)
+
+
+class TestGetInitialAllocation(unittest.TestCase):
+
+    def test_default(self):
+        actual = optimizer._getInitialAllocation(('fake1', 'fake2'))
+        self.assertListEqual(list(actual), [1.0, 0.0])
+
+    def test_missingTicker(self):
+        actual = optimizer._getInitialAllocation(
+            ('fake1', 'fake2', 'fake3'),
+            {'fake0': 0.25, 'fake2': 0.5, 'fake3': 0.25})
+        self.assertListEqual(list(actual), [0.0, 0.75, 0.25])
+
+    def test_noOverlap(self):
+        actual = optimizer._getInitialAllocation(('fake1', 'fake2'), {'fake0': 1.0})
+        self.assertListEqual(list(actual), [1.0, 0.0])
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def test_fromOptimum(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem()
+        expected = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array)
+        actual = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            initial_allocation_map=expected[1])
+
+        self.assertEqual(actual[0], expected[0])
+        self.assertDictEqual(actual[1], expected[1])
+
+
+class TestConvergenceControls(unittest.TestCase):
+
+    def test_maxIterations(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem()
+        (_, actual) = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array, max_iterations=0)
+        self.assertEqual(actual['fake0'], 1.0)
+
+    def test_increments(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem()
+        (_, actual) = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            initial_allocation_map={'fake1': 1.0},
+            start_increment=0.25, min_increment=0.25)
+        for value in actual.values():
+            self.assertEqual(value % 0.25, 0)
+        self.assertAlmostEqual(sum(actual.values()), 1.0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+"""Tests for the result_cache module."""
+
+from . import fixtures
+from . import optimizer
+from . import result_cache
+from . import scipy_solver
+from . import solvers
+import inspect
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+
+class TestGetKey(unittest.TestCase):
+
+    def test_executionOptions(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=4)
+        expected = result_cache._getKey(
+            data_matrix, ticker_tuple, 0.999, expense_array, {})
+        actual = result_cache._getKey(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            {'num_processes': 4, 'chunk_size': 10})
+        self.assertEqual(actual, expected)
+
+    def test_differentProblems(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=4)
+        keys = {
+            result_cache._getKey(data_matrix, ticker_tuple, 0.999, expense_array, {}),
+            result_cache._getKey(data_matrix, ticker_tuple, 0.998, expense_array, {}),
+            result_cache._getKey(data_matrix[1:], ticker_tuple, 0.999, expense_array, {}),
+            result_cache._getKey(
+                data_matrix, ticker_tuple, 0.999, expense_array,
+                {'use_downside_correl': False}),
+            result_cache._getKey(
+                data_matrix, ticker_tuple, 0.999, expense_array,
+                {'solver': 'slsqp'})}
+        self.assertEqual(len(keys), 5)
+
+    def test_explicitDefaults(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=4)
+        for options in (
+                {'use_downside_correl': True, 'min_increment': 1 / 128},
+                {'solver': 'swap', 'max_iterations': None}):
+            expected = result_cache._getKey(
+                data_matrix, ticker_tuple, 0.999, expense_array, {})
+            actual = result_cache._getKey(
+                data_matrix, ticker_tuple, 0.999, expense_array, options)
+            self.assertEqual(actual, expected, options)
+
+    def test_ignoredOptions(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=4)
+        expected = result_cache._getKey(
+            data_matrix, ticker_tuple, 0.999, expense_array, {'solver': 'slsqp'})
+        actual = result_cache._getKey(
+            data_matrix, ticker_tuple, 0.999, expense_array,
+            {'solver': 'slsqp', 'min_increment': 0.01, 'prune_buys': 10})
+        self.assertEqual(actual, expected)
+
+    def test_versions(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=4)
+        expected = result_cache._getKey(
+            data_matrix, ticker_tuple, 0.999, expense_array, {})
+        with mock.patch.object(result_cache, 'CACHE_VERSION', result_cache.CACHE_VERSION + 1):
+            self.assertNotEqual(
+                result_cache._getKey(data_matrix, ticker_tuple, 0.999, expense_array, {}),
+                expected)
+        with mock.patch.object(result_cache, '_getSolverVersion', return_value='changed'):
+            self.assertNotEqual(
+                result_cache._getKey(data_matrix, ticker_tuple, 0.999, expense_array, {}),
+                expected)
+
+
+class TestGetSolverSources(unittest.TestCase):
+
+    def test_swap(self):
+        self.assertListEqual(
+            result_cache._getSolverSources('swap'), [inspect.getsourcefile(optimizer)])
+
+    def test_slsqp(self):
+        self.assertListEqual(
+            result_cache._getSolverSources('slsqp'),
+            [inspect.getsourcefile(scipy_solver), inspect.getsourcefile(optimizer)])
+
+
+class TestFindOptimalAllocation(unittest.TestCase):
+
+    def test_reused(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=4)
+        with tempfile.TemporaryDirectory() as cache_folder:
+            expected = result_cache.findOptimalAllocation(
+                cache_folder, data_matrix, ticker_tuple, 0.999, expense_array)
+            find = mock.create_autospec(optimizer.findOptimalAllocation)
+            with mock.patch.dict(solvers.SOLVERS, {'swap': find}):
+                actual = result_cache.findOptimalAllocation(
+                    cache_folder, data_matrix, ticker_tuple, 0.999, expense_array)
+                find.assert_not_called()
+
+        self.assertEqual(actual[0], expected[0])
+        self.assertDictEqual(actual[1], expected[1])
+
+    def test_evicted(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            for seed in range(3):
+                (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+                    num_tickers=4, seed=seed)
+                result_cache.findOptimalAllocation(
+                    cache_folder, data_matrix, ticker_tuple, 0.999,
+                    expense_array, max_entries=2)
+            self.assertEqual(len(os.listdir(cache_folder)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Tests for the scipy_solver module."""
+
+from . import fixtures
+from . import optimizer
+from . import scipy_solver
+import numpy as np
+import unittest
+from unittest import mock
+import warnings
+
+
+class TestScoreGradient(unittest.TestCase):
+
+    def _checkMatchesFiniteDifference(self, required_return):
+        (data_matrix, _, expense_array) = fixtures.randomProblem(
+            num_days=250, num_tickers=8)
+        optimizer._initializeProcess(data_matrix)
+        allocations = np.full(8, 1 / 8)
+        (score, gradient) = optimizer._getScoreGradient(
+            allocations, required_return, expense_array)
+
+        self.assertAlmostEqual(
+            score,
+            optimizer._scoreAllocation(allocations, required_return, expense_array)['score'],
+            places=10)
+        for i in range(8):
+            step = np.zeros(8)
+            step[i] = 1e-7
+            (higher, _) = optimizer._getScoreGradient(
+                allocations + step, required_return, expense_array)
+            (lower, _) = optimizer._getScoreGradient(
+                allocations - step, required_return, expense_array)
+            self.assertAlmostEqual(
+                gradient[i], (higher - lower) / 2e-7, delta=1e-4 * abs(gradient[i]) + 1e-6)
+
+    def test_positive(self):
+        self._checkMatchesFiniteDifference(0.999)
+
+    def test_negative(self):
+        self._checkMatchesFiniteDifference(1.01)
+
+
+class TestFindOptimalAllocation(unittest.TestCase):
+
+    def test_atLeastSwap(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_days=250, num_tickers=8)
+        expected = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.9995, expense_array,
+            use_downside_correl=False)
+        actual = scipy_solver.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.9995, expense_array,
+            use_downside_correl=False, start_increment=0.5)
+
+        self.assertGreaterEqual(actual[0], expected[0] - 1e-6)
+        self.assertAlmostEqual(sum(actual[1].values()), 1.0)
+        self.assertGreaterEqual(min(actual[1].values()), 0)
+
+    def test_belowRequired(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_days=250, num_tickers=8)
+        (best_score, allocation_map) = scipy_solver.findOptimalAllocation(
+            data_matrix, ticker_tuple, 1.01, expense_array,
+            use_downside_correl=False)
+
+        # Short-circuits to the highest mean return, from a single ticker.
+        self.assertLess(best_score, 0)
+        self.assertAlmostEqual(max(allocation_map.values()), 1.0, places=3)
+
+    def test_manyTickers(self):
+        # Small downside risk makes the unscaled score's gradient huge here.
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_days=400, num_tickers=200)
+        expected = optimizer.findOptimalAllocation(
+            data_matrix, ticker_tuple, 0.9995, expense_array,
+            use_downside_correl=False)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', scipy_solver.ConvergenceWarning)
+            actual = scipy_solver.findOptimalAllocation(
+                data_matrix, ticker_tuple, 0.9995, expense_array,
+                use_downside_correl=False)
+
+        self.assertGreaterEqual(actual[0], expected[0])
+        self.assertAlmostEqual(sum(actual[1].values()), 1.0)
+
+    def test_notConverged(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_days=400, num_tickers=200)
+        optimizer._initializeProcess(data_matrix)
+        start_score = optimizer._scoreAllocation(
+            np.full(200, 1 / 200), 0.9995, expense_array, False)['score']
+        with self.assertWarns(scipy_solver.ConvergenceWarning):
+            (best_score, _) = scipy_solver.findOptimalAllocation(
+                data_matrix, ticker_tuple, 0.9995, expense_array,
+                use_downside_correl=False, max_iterations=2)
+
+        self.assertGreaterEqual(best_score, start_score)
+
+    def test_zeroIterations(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(num_tickers=4)
+        optimizer._initializeProcess(data_matrix)
+        initial_allocation_map = dict(zip(ticker_tuple, (0.5, 0.5, 0, 0)))
+        expected = optimizer._scoreAllocation(
+            np.array((0.5, 0.5, 0, 0)), 0.999, expense_array, True)['score']
+        with mock.patch.object(scipy_solver.optimize, 'minimize') as minimize:
+            actual = scipy_solver.findOptimalAllocation(
+                data_matrix, ticker_tuple, 0.999, expense_array,
+                initial_allocation_map=initial_allocation_map, max_iterations=0)
+
+        minimize.assert_not_called()
+        self.assertAlmostEqual(actual[0], expected)
+        self.assertDictEqual(actual[1], initial_allocation_map)
+
+    def test_timeBudgetNoWarning(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_days=400, num_tickers=200)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', scipy_solver.ConvergenceWarning)
+            scipy_solver.findOptimalAllocation(
+                data_matrix, ticker_tuple, 0.9995, expense_array,
+                use_downside_correl=False, time_budget=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
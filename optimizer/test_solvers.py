@@ -0,0 +1,25 @@
+"""Tests for the solvers module."""
+
+from . import fixtures
+from . import solvers
+import unittest
+
+
+class TestFindOptimalAllocation(unittest.TestCase):
+
+    def test_allSolvers(self):
+        (data_matrix, ticker_tuple, expense_array) = fixtures.randomProblem(
+            num_tickers=4)
+        for solver in solvers.SOLVERS:
+            (_, allocation_map) = solvers.findOptimalAllocation(
+                data_matrix, ticker_tuple, 0.999, expense_array, solver=solver,
+                min_increment=0.25)
+            self.assertAlmostEqual(sum(allocation_map.values()), 1.0)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            solvers.findOptimalAllocation(None, (), 1.0, None, solver='fake')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,64 +1,234 @@
+"""Sweep hyperparameters over walk-forward backtests.
+
+General strategy is:
+    1) Load and align data once, in the parent process.
+    2) Split every experiment into its walk-forward dates, and dedupe
+        identical (date, window, return, correl, solver) sub-problems.
+    3) Fork workers, which inherit the aligned data read-only, to optimize
+        and backtest each sub-problem not already in the results file.
+    4) Append each result to the results file as it completes, so a crashed
+        sweep resumes where it left off.
+    5) Score each experiment from its sub-problems' results.
+"""
+import argparse
 import basicMain
+import config
 import datetime
+import json
+import math
 import multiprocessing as mp
+import numpy as np
+from optimizer import solvers
+import os
 from random import shuffle
 import time
 
 
-index = mp.Value('d', 0)
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--results_file',
+    default='sweep_results.jsonl',
+    help='Where to append sub-problem results, and resume from.')
+parser.add_argument(
+    '--num_processes',
+    type=int,
+    default=mp.cpu_count(),
+    help='How many worker processes to use.')
+parser.add_argument(
+    '--result_cache_folder',
+    default='cache/optimizer',
+    help='Where to reuse optimizer results from, or empty to disable.')
+parser.add_argument(
+    '--solver',
+    choices=sorted(solvers.SOLVERS),
+    default='swap',
+    help='How to optimize, see optimizer/solvers.py.')
+
+
+def _getExperiments():
+    """Get the experiments to run.
+
+    Returns:
+        experiment_list: List of dicts of 'desired_return', 'num_days',
+            'use_downside_correl', and 'date'.
+    """
+    num_years = 1
+    quarter = 0
+    experiment_list = []
+    while num_years < 14:
+        date_str = '%d-%d-01' % (2004 + num_years, (12 * quarter) + 1)
+        num_days = 253 * (num_years + quarter)
+        experiment_list.append({
+            'desired_return': 1.0747,
+            'num_days': num_days,
+            'use_downside_correl': False,
+            'date': date_str})
+        quarter += 0.25
+        if quarter == 1:
+            quarter = 0
+            num_years += 1
+    return experiment_list
+
+
+def _getSubProblems(experiment, today_int, solver='swap'):
+    """Split an experiment into its walk-forward dates.
+
+    Args:
+        experiment: See _getExperiments.
+        today_int: Dates on or after this are not optimized for.
+        solver: Name of the solver, see optimizer/solvers.py.
+    Returns:
+        sub_problem_list: List of (date_int, num_days, desired_return,
+            use_downside_correl, solver) tuples, in date order.
+    """
+    epoch = datetime.datetime.utcfromtimestamp(0)
+    date_int = (datetime.datetime.strptime(experiment['date'], '%Y-%m-%d') - epoch).days
+    sub_problem_list = []
+    while date_int < today_int:
+        sub_problem_list.append((
+            date_int,
+            experiment['num_days'],
+            experiment['desired_return'],
+            experiment['use_downside_correl'],
+            solver))
+        date_int += 365
+    return sub_problem_list
+
+
+def _getPending(sub_problem_lists, results):
+    """Get the distinct sub-problems without results yet.
+
+    Sub-problems that failed are retried, since errors may be transient.
+
+    Args:
+        sub_problem_lists: List of sub-problem lists, see _getSubProblems.
+        results: See _readResults.
+    Returns:
+        pending: List of sub-problems, each once, in random order.
+    """
+    finished = set(
+        sub_problem for sub_problem, result in results.items()
+        if 'error' not in result)
+    pending = list(set(sum(sub_problem_lists, [])) - finished)
+    shuffle(pending)
+    return pending
 
 
-def _poolMain(kwargs):
+def _runSubProblem(sub_problem):
+    """Optimize and backtest a single date, using the inherited data.
+
+    Args:
+        sub_problem: See _getSubProblems.
+    Returns:
+        result: Dict of 'sub_problem', and 'performance' or 'error'.
+    """
+    (date_int, num_days, desired_return, use_downside_correl, solver) = sub_problem
+    daily_return = math.pow(desired_return, 1 / config.TRADING_DAYS_PER_YEAR)
     try:
-        score = basicMain.actualMain(
-            kwargs['desired_return'],
-            'none',
-            kwargs['num_days'],
-            kwargs['date'],
-            None,
-            kwargs['use_downside_correl'])
+        allocation_map = basicMain._runSingleDay(
+            date_int,
+            ticker_data,
+            aligned_data,
+            daily_return,
+            num_days,
+            perform_trades=False,
+            use_downside_correl=use_downside_correl,
+            optimizer_options={'solver': solver},
+            result_cache_folder=result_cache_folder)
+        performance = basicMain._runBacktest(
+            allocation_map, aligned_data, date_int, date_int + 365)
+        return {'sub_problem': sub_problem, 'performance': performance}
     except Exception as e:
-        score = -100
-        print(kwargs)
+        print(sub_problem)
         print(e)
-        raise e
-    with index.get_lock():
-        index.value += 1
-        print('\n\nFinished %d' % index.value)
-    return_str = '%.4f %d %s %.4f' % (
-        kwargs['desired_return'],
-        kwargs['num_days'],
-        kwargs['use_downside_correl'],
-        score)
-    print(return_str)
-    print('\n')
-    return return_str
+        return {'sub_problem': sub_problem, 'error': repr(e)}
+
+
+def _readResults(results_file):
+    """Read results of a previous, possibly interrupted, sweep.
+
+    Args:
+        results_file: File of JSON results, one per line.
+    Returns:
+        results: Dict of sub-problem tuples to results.
+    """
+    results = {}
+    if not os.path.isfile(results_file):
+        return results
+    with open(results_file, 'r') as f:
+        for line in f:
+            # A crash can leave a partial last line.
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            results[tuple(result['sub_problem'])] = result
+    return results
+
+
+def _scoreExperiment(experiment, sub_problem_list, results):
+    """Score an experiment from its sub-problems' results.
+
+    Args:
+        experiment: See _getExperiments.
+        sub_problem_list: See _getSubProblems.
+        results: See _readResults.
+    Returns:
+        score: See basicMain._roughScore, or -100 if any sub-problem failed.
+    """
+    performance_list = []
+    for sub_problem in sub_problem_list:
+        result = results[sub_problem]
+        if 'error' in result:
+            return -100
+        if not np.isnan(result['performance']):
+            performance_list.append(result['performance'])
+    daily_return = math.pow(
+        experiment['desired_return'], 1 / config.TRADING_DAYS_PER_YEAR)
+    return basicMain._roughScore(performance_list, daily_return)
 
 
 def main():
+    global ticker_data
+    global aligned_data
+    global result_cache_folder
+
+    args = parser.parse_args()
+    result_cache_folder = args.result_cache_folder
     output = []
     start = time.time()
     try:
-        with mp.Pool() as pool:
-            num_years = 1
-            quarter = 0
-            arg_list = []
-            while num_years < 14:
-                date_str = '%d-%d-01' % (2004 + num_years, (12 * quarter) + 1)
-                num_days = 253 * (num_years + quarter)
-                arg_list.append({
-                    'desired_return': 1.0747,
-                    'num_days': num_days,
-                    'use_downside_correl': False,
-                    'date': date_str})
-                quarter += 0.25
-                if quarter == 1:
-                    quarter = 0
-                    num_years += 1
-            
-            shuffle(arg_list)
-            print('Running %d experiments.' % len(arg_list))
-            output = pool.map(_poolMain, arg_list, 1)
+        epoch = datetime.datetime.utcfromtimestamp(0)
+        today_int = (datetime.datetime.now() - epoch).days
+        experiment_list = _getExperiments()
+        sub_problem_lists = [
+            _getSubProblems(experiment, today_int, args.solver)
+            for experiment in experiment_list]
+
+        results = _readResults(args.results_file)
+        pending = _getPending(sub_problem_lists, results)
+        print('Running %d experiments, %d sub-problems left.' % (
+            len(experiment_list), len(pending)))
+
+        if pending:
+            # Workers are forked after this, so they share the data rather
+            # than re-reading it.
+            (ticker_data, aligned_data) = basicMain._loadData('none')
+            with mp.get_context('fork').Pool(args.num_processes) as pool:
+                with open(args.results_file, 'a') as f:
+                    results_iter = pool.imap_unordered(_runSubProblem, pending)
+                    for index, result in enumerate(results_iter):
+                        results[result['sub_problem']] = result
+                        f.write(json.dumps(result) + '\n')
+                        f.flush()
+                        print('\n\nFinished %d/%d' % (index + 1, len(pending)))
+
+        for experiment, sub_problem_list in zip(experiment_list, sub_problem_lists):
+            output.append('%.4f %d %s %.4f' % (
+                experiment['desired_return'],
+                experiment['num_days'],
+                experiment['use_downside_correl'],
+                _scoreExperiment(experiment, sub_problem_list, results)))
     finally:
         print('Return Years Correl Score')
         print('\n'.join(sorted(output)))
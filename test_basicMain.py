@@ -0,0 +1,49 @@
+"""Tests for the basicMain module."""
+
+import basicMain
+import contextlib
+import io
+import numpy as np
+import unittest
+
+
+def _alignedData(price_matrix, expense_array=(0.0, 0.0)):
+    price_matrix = np.array(price_matrix, dtype=np.float64)
+    return (
+        ('fake1', 'fake2'),
+        np.arange(len(price_matrix)) * 10,
+        price_matrix,
+        ~np.isnan(price_matrix),
+        np.array(expense_array, dtype=np.float64))
+
+
+class TestPrintBacktest(unittest.TestCase):
+
+    def _printBacktest(self, dated_allocation_list, aligned_data):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            basicMain._printBacktest(dated_allocation_list, aligned_data, 1.0)
+        return output.getvalue()
+
+    def test_noAllocations(self):
+        actual = self._printBacktest([], _alignedData([[1.0, 1.0]] * 3))
+
+        self.assertIn('Skipping backtest: No allocations', actual)
+
+    def test_unheldNanExpense(self):
+        actual = self._printBacktest(
+            [(0, {'fake1': 1.0, 'fake2': 0.0})],
+            _alignedData([[1.0, 1.0], [1.0, 2.0], [0.5, 2.0]], expense_array=(0.0, np.nan)))
+
+        self.assertIn('value 0.5000', actual)
+        self.assertNotIn('nan', actual)
+
+    def test_noDownside(self):
+        actual = self._printBacktest(
+            [(0, {'fake1': 1.0})], _alignedData([[1.0, 1.0], [2.0, 1.0], [3.0, 1.0]]))
+
+        self.assertIn('Sortino inf', actual)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""Tests for the testMain module."""
+
+import json
+import math
+import numpy as np
+import os
+import tempfile
+import testMain
+import unittest
+from unittest import mock
+
+
+class TestGetPending(unittest.TestCase):
+
+    def test_dedupe(self):
+        experiment = {
+            'desired_return': 1.07,
+            'num_days': 253,
+            'use_downside_correl': False,
+            'date': '2005-01-01'}
+        sub_problem_lists = [
+            testMain._getSubProblems(experiment, 13600),
+            testMain._getSubProblems(dict(experiment), 13600),
+            testMain._getSubProblems(experiment, 13600, 'slsqp')]
+        actual = testMain._getPending(sub_problem_lists, {})
+
+        self.assertEqual(len(sub_problem_lists[0]), 3)
+        self.assertEqual(len(actual), 6)
+        self.assertSetEqual(
+            set(actual), set(sub_problem_lists[0] + sub_problem_lists[2]))
+
+    def test_skipsResults(self):
+        sub_problem_lists = [[(1, 253, 1.07, False, 'swap'), (2, 253, 1.07, False, 'swap')]]
+        results = {(1, 253, 1.07, False, 'swap'): {'performance': 1.0}}
+        actual = testMain._getPending(sub_problem_lists, results)
+
+        self.assertListEqual(actual, [(2, 253, 1.07, False, 'swap')])
+
+    def test_retriesErrors(self):
+        sub_problem_lists = [[(1, 253, 1.07, False, 'swap'), (2, 253, 1.07, False, 'swap')]]
+        results = {
+            (1, 253, 1.07, False, 'swap'): {'performance': 1.0},
+            (2, 253, 1.07, False, 'swap'): {'error': 'ValueError()'}}
+        actual = testMain._getPending(sub_problem_lists, results)
+
+        self.assertListEqual(actual, [(2, 253, 1.07, False, 'swap')])
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.results_file = self.temp_dir.name + '/results.jsonl'
+        self.sub_problem_list = [
+            (1, 253, 1.07, False, 'swap'), (366, 253, 1.07, False, 'swap')]
+        self.experiment = {'desired_return': 1.07}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _writeResults(self, result_list, partial_line=''):
+        with open(self.results_file, 'w') as f:
+            for result in result_list:
+                f.write(json.dumps(result) + '\n')
+            f.write(partial_line)
+
+    def test_missingFile(self):
+        self.assertDictEqual(testMain._readResults(self.results_file), {})
+
+    def test_partialLine(self):
+        self._writeResults(
+            [{'sub_problem': self.sub_problem_list[0], 'performance': 1.001}],
+            '{"sub_problem": [366, 253')
+        actual = testMain._readResults(self.results_file)
+
+        self.assertDictEqual(actual, {self.sub_problem_list[0]: {
+            'sub_problem': list(self.sub_problem_list[0]), 'performance': 1.001}})
+        self.assertListEqual(
+            testMain._getPending([self.sub_problem_list], actual),
+            [self.sub_problem_list[1]])
+
+    def test_scoreMatches(self):
+        result_list = [
+            {'sub_problem': self.sub_problem_list[0], 'performance': 1.001},
+            {'sub_problem': self.sub_problem_list[1], 'performance': 0.9995}]
+        self._writeResults(result_list)
+        expected = testMain._scoreExperiment(
+            self.experiment, self.sub_problem_list,
+            {tuple(result['sub_problem']): result for result in result_list})
+        actual = testMain._scoreExperiment(
+            self.experiment, self.sub_problem_list,
+            testMain._readResults(self.results_file))
+
+        self.assertEqual(actual, expected)
+        self.assertFalse(math.isnan(actual))
+
+    def test_scoreSkipsNan(self):
+        self._writeResults([
+            {'sub_problem': self.sub_problem_list[0], 'performance': 1.001},
+            {'sub_problem': self.sub_problem_list[1], 'performance': np.nan}])
+        actual = testMain._scoreExperiment(
+            self.experiment, self.sub_problem_list[:1],
+            testMain._readResults(self.results_file))
+        with_nan = testMain._scoreExperiment(
+            self.experiment, self.sub_problem_list,
+            testMain._readResults(self.results_file))
+
+        self.assertEqual(with_nan, actual)
+
+    def test_scoreError(self):
+        self._writeResults([
+            {'sub_problem': self.sub_problem_list[0], 'performance': 1.001},
+            {'sub_problem': self.sub_problem_list[1], 'error': 'ValueError()'}])
+        actual = testMain._scoreExperiment(
+            self.experiment, self.sub_problem_list,
+            testMain._readResults(self.results_file))
+
+        self.assertEqual(actual, -100)
+
+    def test_retryReplacesError(self):
+        self._writeResults([
+            {'sub_problem': self.sub_problem_list[0], 'error': 'ValueError()'},
+            {'sub_problem': self.sub_problem_list[0], 'performance': 1.001}])
+        actual = testMain._readResults(self.results_file)
+
+        self.assertNotIn('error', actual[self.sub_problem_list[0]])
+
+    def test_mainSkipsFinished(self):
+        with mock.patch.object(testMain, '_getExperiments', return_value=[{
+                'desired_return': 1.07,
+                'num_days': 253,
+                'use_downside_correl': False,
+                'date': '1970-01-02'}]):
+            with mock.patch.object(testMain, '_getSubProblems', return_value=self.sub_problem_list):
+                self._writeResults([
+                    {'sub_problem': sub_problem, 'performance': 1.001}
+                    for sub_problem in self.sub_problem_list])
+                with mock.patch.object(testMain.basicMain, '_loadData') as load_data:
+                    with mock.patch('sys.argv', ['testMain.py', '--results_file', self.results_file]):
+                        testMain.main()
+
+        load_data.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
-"""Tests for the data_cleaner module."""
+"""Tests for the trader module."""
 
 from . import trader
 import config
@@ -6,23 +6,45 @@ import numpy as np
 import unittest
 
 
-class TestGetBacktestedReturns(unittest.TestCase):
+class TestGetTradeCorrelations(unittest.TestCase):
 
-    def test_basic(self):
-        allocation_map = {
-                'fake1': 0.25,
-                'fake2': 0.75
-                }
-        ticker_tuple = ('fake1', 'fake2')
-        data_matrix = np.array(
-                [
-                    [0, 1],
-                    [0, 2],
-                    [1, 2]
-                    ],
-                dtype=np.float64)
-        expected = [0.75, 1.5, 1.75]
-        actual = trader._getBacktestedAllocationReturns(allocation_map, ticker_tuple, data_matrix)
+    def test_matchesPortfolioCorrelation(self):
+        random_state = np.random.RandomState(0)
+        data_matrix = 1 + random_state.normal(0.0005, 0.01, (100, 6))
+        desired_array = np.array((0.3, 0.3, 0.2, 0.2, 0, 0))
+        actual_array = np.array((0, 0.1, 0.2, 0.2, 0.3, 0.2))
+        (sell_ids, buy_ids, deltas) = trader._getTrades(desired_array, actual_array)
+        centered = data_matrix - data_matrix.mean(axis=0)
+        actual = trader._getTradeCorrelations(
+            np.matmul(centered.T, centered), 100, desired_array, actual_array,
+            sell_ids, buy_ids, deltas)
 
-        self.assertListEqual(list(actual), expected)
+        self.assertEqual(len(actual), 4)
+        desired_returns = np.matmul(data_matrix, desired_array)
+        for i in range(len(actual)):
+            allocations = np.copy(actual_array)
+            allocations[sell_ids[i]] -= deltas[i]
+            allocations[buy_ids[i]] += deltas[i]
+            expected = trader._getPortfolioCorrelation(
+                desired_returns, np.matmul(data_matrix, allocations)).min()
+            self.assertAlmostEqual(actual[i], expected, places=10)
 
+
+class TestCalculateTrades(unittest.TestCase):
+
+    def test_plan(self):
+        random_state = np.random.RandomState(1)
+        data_matrix = 1 + random_state.normal(0.0005, 0.01, (100, 3))
+        actual = trader.calculateTrades(
+            {'fake1': 0.5, 'fake2': 0.5},
+            {'fake0': 0.97, 'fake1': 0.03},
+            ('fake0', 'fake1', 'fake2'),
+            data_matrix)
+
+        self.assertGreater(len(actual), 1)
+        correls = [trade[0] for trade in actual]
+        self.assertListEqual(correls, sorted(set(correls)))
+        for (_, sell_ticker, buy_ticker, delta) in actual:
+            self.assertEqual(sell_ticker, 'fake0')
+            self.assertIn(buy_ticker, ('fake1', 'fake2'))
+            self.assertLessEqual(delta, trader.MAX_TRADE)
@@ -6,29 +6,22 @@ General strategy is:
     2) Mark every ticker where current allocation is lower than desired as a
         potential buy.
     3) For every combination of buys and sells, check backdated correlation
-        if that trade is done.
+        if that trade is done, all at once.
         3.1) Trade amount is the lesser of how overweight the buy is, or how
-            underweight the sell is.
-    4) Return the trades in order.
+            underweight the sell is, limited to MAX_TRADE.
+    4) Make the trade with the best correlation, and repeat from #1 until no
+        trade improves correlation.
+    5) Return the trades in order.
 """
-from collections import defaultdict
-import heapq
+from instrumentation import instrumentation
 import numpy as np
 
-def _getBacktestedAllocationReturns(allocation_map, ticker_tuple, data_matrix):
-    """Create an array of backtested returns for the given allocation map.
 
-    Args:
-        allocation_map: Map of tickers to allocation percentages.
-        data_matrix: Rows = days, columns = tickers, values = % price changes.
-        ticker_tuple: Tuple of tickers in the matrix, in the same order.
-    Returns:
-        return_array: Array of backtested returns.
-    """
-    allocation_array = np.array(
-            [allocation_map[ticker] for ticker in ticker_tuple],
-            dtype=np.float64)
-    return np.matmul(data_matrix, allocation_array)
+# Max percent allocation moved by a single trade.
+MAX_TRADE = 0.01
+
+# Allocation differences smaller than this are not traded.
+MIN_TRADE = 1e-9
 
 
 def _getPortfolioCorrelation(portfolio_1_returns, portfolio_2_returns):
@@ -56,52 +49,111 @@ def _addCashToDataMatrix(ticker_tuple, data_matrix):
     return (ticker_tuple, data_matrix)
 
 
+def _getTradeCorrelations(gram, num_days, desired_array, actual_array, sell_ids, buy_ids, deltas):
+    """Calculate the correlation with the desired portfolio for many trades.
+
+    Portfolio variances and covariances are quadratic forms of the Gram
+    matrix, and each trade only moves delta between two tickers, so all
+    trades are scored without building their returns.
+
+    Args:
+        gram: Gram matrix of the mean-centered data_matrix columns.
+        num_days: Number of rows in data_matrix.
+        desired_array: Array of desired percent allocations.
+        actual_array: Array of actual percent allocations.
+        sell_ids: Array of column indices to sell.
+        buy_ids: Array of column indices to buy, same length as sell_ids.
+        deltas: Array of percent allocations moved by each trade.
+    Returns:
+        correls: Array of correlations, as _getPortfolioCorrelation(...).min()
+            of the desired and traded returns, one per trade.
+    """
+    desired_gram = np.matmul(gram, desired_array)
+    actual_gram = np.matmul(gram, actual_array)
+    desired_var = np.dot(desired_array, desired_gram)
+    covs = np.dot(desired_array, actual_gram) + deltas * (
+        desired_gram[buy_ids] - desired_gram[sell_ids])
+    trade_vars = np.dot(actual_array, actual_gram) + 2 * deltas * (
+        actual_gram[buy_ids] - actual_gram[sell_ids]) + deltas * deltas * (
+            gram[buy_ids, buy_ids] - 2 * gram[buy_ids, sell_ids]
+            + gram[sell_ids, sell_ids])
+
+    # np.cov normalizes by n - 1, and np.std by n, so the variances cancel.
+    std_squared = np.maximum(desired_var, trade_vars) * (num_days - 1) / num_days
+    return np.minimum(np.minimum(desired_var, covs), trade_vars) / std_squared
+
+
+def _getTrades(desired_array, actual_array):
+    """List every trade from overweight to underweight tickers.
+
+    Args:
+        desired_array: Array of desired percent allocations.
+        actual_array: Array of actual percent allocations.
+    Returns:
+        sell_ids: Array of column indices to sell.
+        buy_ids: Array of column indices to buy, same length as sell_ids.
+        deltas: Array of percent allocations moved by each trade.
+    """
+    sells = np.flatnonzero(actual_array - desired_array > MIN_TRADE)
+    buys = np.flatnonzero(desired_array - actual_array > MIN_TRADE)
+    sell_ids = np.repeat(sells, len(buys))
+    buy_ids = np.tile(buys, len(sells))
+    deltas = np.minimum(
+        np.minimum(
+            actual_array[sell_ids] - desired_array[sell_ids],
+            desired_array[buy_ids] - actual_array[buy_ids]),
+        MAX_TRADE)
+    return (sell_ids, buy_ids, deltas)
+
+
+@instrumentation.timed('trader.trades')
 def calculateTrades(desired_allocation_map, actual_allocation_map, ticker_tuple, data_matrix):
-    """Calculate correlation for all potential trades.
+    """Plan a sequence of trades from actual to desired allocations.
 
     Args:
         desired_allocation_map: Map of tickers to allocation percentages.
         actual_allocation_map: Map of tickers to allocation percentages.
         data_matrix: Rows = days, columns = tickers, values = % price changes.
         ticker_tuple: Tuple of tickers in the matrix, in the same order.
+    Returns:
+        trade_list: List of (correl, sell_ticker, buy_ticker, delta) tuples,
+            in the order to trade, where correl is the correlation with the
+            desired allocation after the trade.
     """
-    trade_heap = []
-
     (ticker_tuple, data_matrix) = _addCashToDataMatrix(ticker_tuple, data_matrix)
 
-    default_desired_map = defaultdict(int)
-    for k, v in desired_allocation_map.items():
-        if v > 0: default_desired_map[k] = v
-    optimal_returns = _getBacktestedAllocationReturns(default_desired_map, ticker_tuple, data_matrix)
-
-    default_actual_map = defaultdict(int)
-    for k, v in actual_allocation_map.items():
-        if v > 0: default_actual_map[k] = v
-    current_returns = _getBacktestedAllocationReturns(default_actual_map, ticker_tuple, data_matrix)
+    desired_array = np.array(
+            [max(desired_allocation_map.get(ticker, 0), 0) for ticker in ticker_tuple],
+            dtype=np.float64)
+    actual_array = np.array(
+            [max(actual_allocation_map.get(ticker, 0), 0) for ticker in ticker_tuple],
+            dtype=np.float64)
+    optimal_returns = np.matmul(data_matrix, desired_array)
+    current_returns = np.matmul(data_matrix, actual_array)
+    centered = data_matrix - data_matrix.mean(axis=0)
+    gram = np.matmul(centered.T, centered)
 
     current_correl = _getPortfolioCorrelation(optimal_returns, current_returns).min()
     print('Current correl: %.4f' % current_correl)
 
-    for sell_ticker in actual_allocation_map.keys():
-        sell_delta = default_actual_map[sell_ticker] - default_desired_map[sell_ticker]
-        if sell_delta <= 0: continue
-
-        for buy_ticker in desired_allocation_map.keys():
-            buy_delta = default_desired_map[buy_ticker] - default_actual_map[buy_ticker]
-            if buy_delta <= 0: continue
+    trade_list = []
+    while True:
+        (sell_ids, buy_ids, deltas) = _getTrades(desired_array, actual_array)
+        if not len(sell_ids): break
+        correls = _getTradeCorrelations(
+                gram, len(data_matrix), desired_array, actual_array, sell_ids, buy_ids, deltas)
+        instrumentation.count('trader.trades.candidates', len(correls))
 
-            # Limit to 1% per trade.
-            true_delta = min(buy_delta, sell_delta, 0.01)
-            trade = default_actual_map.copy()
-            trade[buy_ticker] += true_delta
-            trade[sell_ticker] -= true_delta
-            trade_returns = _getBacktestedAllocationReturns(trade, ticker_tuple, data_matrix)
+        i = np.argmax(correls)
+        if correls[i] <= current_correl: break
 
-            correl = _getPortfolioCorrelation(optimal_returns, trade_returns).min()
+        (sell_id, buy_id, delta) = (sell_ids[i], buy_ids[i], deltas[i])
+        actual_array[sell_id] -= delta
+        actual_array[buy_id] += delta
+        current_correl = correls[i]
+        trade_list.append((current_correl, ticker_tuple[sell_id], ticker_tuple[buy_id], delta))
 
-            if correl <= current_correl: continue
-    
-            trade_heap.append((correl, sell_ticker, buy_ticker, '%.1f%%' % (true_delta * 100)))
+    for (correl, sell_ticker, buy_ticker, delta) in trade_list:
+        print('%.4f %s %s %.1f%%' % (correl, sell_ticker, buy_ticker, delta * 100))
 
-    for trade in sorted(trade_heap, reverse=True):
-        print('%.4f %s %s %s' % trade)
+    return trade_list